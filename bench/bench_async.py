@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+'''
+同样的并发请求  用 db 的线程池(aget)和每个请求一个线程的吞吐量
+'''
+import time
+import threading
+
+from common import db, sqlite, create_tables, report
+
+import orm
+
+class User(orm.Model):
+    __table__ = 'users'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+
+def main(n=2000):
+    sqlite(max_size=4)
+    create_tables(User)
+    User.insert_all([User(id=i, name='u%d' % i) for i in range(1000)])
+    start = time.time()
+    for f in [User.aget(i % 1000) for i in range(n)]:
+        f.result()
+    pooled = time.time() - start
+    start = time.time()
+    threads = [threading.Thread(target=User.get, args=(i % 1000, )) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    spawned = time.time() - start
+    report('executor: %.0f req/s  thread-per-request: %.0f req/s  pool timeouts: %d',
+           n / pooled, n / spawned, db.pool_stats().timeouts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+'''
+Model(dict 子类) 和 CompactModel(__slots__) 每个实例的内存和访问字段的开销
+'''
+import sys
+import timeit
+
+from common import report
+
+import orm
+
+NAMES = ('id', 'blog_id', 'user_id', 'content', 'created_at')
+
+def define(base):
+    class Comment(base):
+        __table__ = 'comments'
+        id = orm.StringField(primary_key=True, ddl='varchar(50)')
+        blog_id = orm.StringField(ddl='varchar(50)')
+        user_id = orm.StringField(ddl='varchar(50)')
+        content = orm.TextField()
+        created_at = orm.FloatField()
+    return Comment
+
+def size(m):
+    n = sys.getsizeof(m)
+    d = getattr(m, '__dict__', None)
+    if d is not None:
+        n += sys.getsizeof(d)
+    return n
+
+def per_call(func, n):
+    return min(timeit.repeat(func, number=n, repeat=3)) / n
+
+def main():
+    row = ('c1', 'b', 'u', 'x', 1.0)
+    for base in (orm.Model, orm.CompactModel):
+        # 两个类用同样的类名  先清掉上一个
+        orm.ModelMetaclass.subclasses = {}
+        cls = define(base)
+        m = cls._from_row(NAMES, row)
+        report('%-12s %4d bytes/instance  attr %.0fns  item %.0fns  _from_row %.2fus', base.__name__, size(m),
+               per_call(lambda: m.content, 200000) * 1e9, per_call(lambda: m['content'], 200000) * 1e9,
+               per_call(lambda: cls._from_row(NAMES, row), 100000) * 1e6)
+
+if __name__ == '__main__':
+    main()
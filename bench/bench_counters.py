@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+'''
+列表页显示每个 blog 的评论数  count_by 和 CountField 的耗时  以及维护计数给 insert 增加的开销
+'''
+import time
+import random
+
+from common import sqlite, create_tables, best, report
+
+import orm
+
+class Blog(orm.Model):
+    __table__ = 'blogs'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+    comment_count = orm.CountField('Comment', 'blog_id')
+    created_at = orm.FloatField(updatable=False, default=time.time)
+
+class Comment(orm.Model):
+    __table__ = 'comments'
+    id = orm.IntegerField(primary_key=True)
+    blog_id = orm.ForeignKeyField(Blog, related_name='comments', updatable=False)
+    content = orm.TextField()
+
+def main(blogs=200, comments=50000):
+    sqlite()
+    create_tables(Blog, Comment)
+    Blog.insert_all([Blog(id=i, name='b%d' % i) for i in range(blogs)])
+    start = time.time()
+    Comment.insert_all([Comment(id=i, blog_id=random.randrange(blogs), content='c') for i in range(comments)])
+    report('insert_all %d comments with counters: %.0f rows/s', comments, comments / (time.time() - start))
+    assert sum([b.comment_count for b in Blog.find_all()]) == comments
+    def by_count():
+        return [Comment.count_by('where blog_id=?', b.id) for b in Blog.find_by('order by created_at desc limit 20')]
+    def by_column():
+        return [b.comment_count for b in Blog.find_by('order by created_at desc limit 20')]
+    assert by_count() == by_column()
+    report('20 blogs: count_by %.2fms  CountField %.2fms', best(by_count) * 1000, best(by_column) * 1000)
+    start = time.time()
+    Blog.rebuild_counters()
+    report('rebuild_counters: %.1fms', (time.time() - start) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+多个线程并发的自动提交 insert  每条单独提交和 group commit 的吞吐量与延迟
+'''
+import time
+import threading
+
+from common import db, sqlite, report
+
+def run(group, threads=16, n=100):
+    sqlite('group.db', max_size=40)
+    db.update('create table t (id int primary key, v text)')
+    if group:
+        db.enable_group_commit(max_batch=64, max_delay=0.002)
+    latencies = []
+    lock = threading.Lock()
+    def work(k):
+        L = []
+        for i in range(n):
+            start = time.time()
+            db.update('insert into t (id, v) values (?, ?)', k * n + i, 'x')
+            L.append(time.time() - start)
+        with lock:
+            latencies.extend(L)
+    start = time.time()
+    ts = [threading.Thread(target=work, args=(k, )) for k in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.time() - start
+    stats = db.group_commit_stats()
+    commits = stats.commits if stats else threads * n
+    db.disable_group_commit()
+    assert db.select_int('select count(*) from t') == threads * n
+    latencies.sort()
+    report('%-10s %.0f inserts/s  %d commits  p50 %.1fms  p99 %.1fms', 'group' if group else 'autocommit',
+           threads * n / elapsed, commits, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000)
+
+def main():
+    run(False)
+    run(True)
+
+if __name__ == '__main__':
+    main()
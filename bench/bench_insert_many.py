@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+'''
+逐行 insert() 和 insert_all() 批量插入的吞吐量
+'''
+import time
+
+from common import db, sqlite, create_tables, report
+
+import orm
+
+class Comment(orm.Model):
+    __table__ = 'comments'
+    id = orm.IntegerField(primary_key=True)
+    blog_id = orm.StringField(ddl='varchar(50)')
+    content = orm.TextField()
+    created_at = orm.FloatField(updatable=False, default=time.time)
+
+def main(n=2000):
+    sqlite()
+    create_tables(Comment)
+    start = time.time()
+    for i in range(n):
+        Comment(id=i, blog_id='b', content='x' * 100).insert()
+    single = time.time() - start
+    start = time.time()
+    Comment.insert_all([Comment(id=n + i, blog_id='b', content='x' * 100) for i in range(n * 10)], chunk_size=100)
+    batch = time.time() - start
+    assert db.select_int('select count(*) from comments') == n * 11
+    report('insert():     %8.0f rows/s', n / single)
+    report('insert_all(): %8.0f rows/s', n * 10 / batch)
+
+if __name__ == '__main__':
+    main()
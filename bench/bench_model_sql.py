@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+不访问数据库(NoopConnection)时 insert/update/get/delete 在 orm 中的开销
+'''
+import time
+
+from common import db, noop, report
+
+import orm
+
+class User(orm.Model):
+    __table__ = 'users'
+    id = orm.IntegerField(primary_key=True)
+    email = orm.StringField(updatable=False)
+    password = orm.StringField()
+    admin = orm.BooleanField()
+    name = orm.StringField()
+    image = orm.StringField()
+    created_at = orm.FloatField(updatable=False, default=time.time)
+
+def per_call(func, n=30000):
+    r = 1e9
+    for k in range(5):
+        start = time.time()
+        with db.connection():
+            for i in xrange(n):
+                func(i)
+        r = min(r, (time.time() - start) / n)
+    return r * 1e6
+
+def full_update(u):
+    # 没有读取时的快照  update 写所有可更新的字段
+    u.__dict__.pop('_loaded', None)
+    u.update()
+
+def main():
+    noop()
+    u = User(id=1, email='e', password='p', name='n', image='i')
+    report('insert       %.2fus', per_call(lambda i: User(id=i, email='e', password='p', name='n', image='i').insert()))
+    report('update(full) %.2fus', per_call(lambda i: full_update(u)))
+    report('get          %.2fus', per_call(User.get))
+    report('delete       %.2fus', per_call(lambda i: u.delete()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+'''
+next_id/next_bigint_id 的生成速度  以及不同主键格式下表和索引的大小
+'''
+import os
+import time
+import uuid
+import timeit
+import sqlite3
+
+from common import db, report, _dir
+
+def uuid_id():
+    # 原来的格式: 毫秒时间戳 + uuid4
+    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+def main(n=200000, rows=200000):
+    for name, func in (('uuid4', uuid_id), ('next_id', db.next_id), ('next_bigint_id', db.next_bigint_id)):
+        report('%-22s %9.0f ids/s', name, n / timeit.timeit(func, number=n))
+    for name, func in (('next_ids(1000)', db.next_ids), ('next_bigint_ids(1000)', db.next_bigint_ids)):
+        report('%-22s %9.0f ids/s', name, 200000 / timeit.timeit(lambda: func(1000), number=200))
+    path = os.path.join(_dir, 'ids.db')
+    for name, ddl, gen in (('varchar(50) uuid4', 'varchar(50)', lambda k: [uuid_id() for i in xrange(k)]),
+                           ('varchar(50) next_id', 'varchar(50)', db.next_ids),
+                           ('bigint', 'bigint', db.next_bigint_ids)):
+        if os.path.exists(path):
+            os.remove(path)
+        c = sqlite3.connect(path)
+        c.execute('create table comments (id %s not null, blog_id %s not null, content text, primary key(id))' % (ddl, ddl))
+        c.execute('create index idx_blog on comments (blog_id)')
+        blogs = gen(1000)
+        c.executemany('insert into comments values (?,?,?)', ((i, blogs[k % 1000], 'x') for k, i in enumerate(gen(rows))))
+        c.commit()
+        c.execute('vacuum')
+        c.close()
+        report('%-22s %6.1f MB for %d comments (pk + blog_id index)', name, os.path.getsize(path) / 1048576.0, rows)
+
+if __name__ == '__main__':
+    main()
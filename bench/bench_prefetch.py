@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''
+列表页读 blog 的作者和评论(以及评论的作者)  逐个访问关联(N+1)和 prefetch 的语句数与耗时
+'''
+import time
+
+from common import db, sqlite, create_tables, report
+
+import orm
+
+class User(orm.Model):
+    __table__ = 'users'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+
+class Blog(orm.Model):
+    __table__ = 'blogs'
+    id = orm.IntegerField(primary_key=True)
+    user_id = orm.ForeignKeyField(User, related_name='blogs', updatable=False)
+    name = orm.StringField()
+
+class Comment(orm.Model):
+    __table__ = 'comments'
+    id = orm.IntegerField(primary_key=True)
+    blog_id = orm.ForeignKeyField(Blog, related_name='comments', updatable=False)
+    user_id = orm.ForeignKeyField(User, related_name='comments', updatable=False)
+    content = orm.TextField()
+
+def page(n, prefetch):
+    blogs = Blog.find_by('order by id limit ?', n)
+    if prefetch:
+        blogs.prefetch('user', 'comments.user')
+    return [(b.user.name, [c.user.name for c in b.comments]) for b in blogs]
+
+def main():
+    sqlite()
+    create_tables(User, Blog, Comment)
+    User.insert_all([User(id=i, name='u%d' % i) for i in range(50)])
+    Blog.insert_all([Blog(id=i, user_id=i % 50, name='b%d' % i) for i in range(200)])
+    Comment.insert_all([Comment(id=i, blog_id=i % 200, user_id=(i * 7) % 50, content='c') for i in range(2000)])
+    for n in (5, 20, 100):
+        for prefetch in (False, True):
+            db.stats(reset=True)
+            start = time.time()
+            page(n, prefetch)
+            t = time.time() - start
+            count = sum([s.count for s in db.stats().itervalues()])
+            report('%3d blogs %-8s %4d statements %7.2fms', n, 'prefetch' if prefetch else 'lazy', count, t * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+'''
+读大结果集时每行的开销和占用的内存  db.select(Row) select_rows(tuple) Model.find_all
+'''
+import sys
+
+from common import db, sqlite, create_tables, best, report
+
+import orm
+
+class User(orm.Model):
+    __table__ = 'users'
+    id = orm.IntegerField(primary_key=True)
+    email = orm.StringField()
+    password = orm.StringField()
+    admin = orm.BooleanField()
+    name = orm.StringField()
+    image = orm.StringField()
+    created_at = orm.FloatField(updatable=False, default=0.0)
+
+def main(n=100000):
+    sqlite()
+    create_tables(User)
+    User.insert_all([User(id=i, email='e%d@x' % i, password='p', name='n', image='about:blank') for i in range(n)])
+    db.configure_stats(enabled=False)
+    for name, func in (('select_rows', lambda: db.select_rows('select * from users')[1]),
+                       ('select', lambda: db.select('select * from users')),
+                       ('find_all', User.find_all)):
+        t = best(func)
+        row = func()[0]
+        report('%-12s %d rows: %.3fs  %.2fus/row  %d bytes/row', name, n, t, t / n * 1e6, sys.getsizeof(row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+'''
+按语句统计(db.stats)给每次查询增加的开销
+'''
+import timeit
+
+from common import db, sqlite, best, report
+
+def run(n=20000):
+    with db.connection():
+        for i in xrange(n):
+            db.select_rows('select * from t where id=?', i % 1000)
+
+def main(n=20000):
+    sqlite()
+    db.update('create table t (id int primary key, v text)')
+    db.insert_many('t', [dict(id=i, v='x') for i in range(1000)])
+    # 开和关交替执行 各取最快的一次  机器的波动对两边的影响差不多
+    on = off = 1e9
+    for i in range(7):
+        db.configure_stats(enabled=True, slow_query=None)
+        on = min(on, best(run, 1) / n)
+        db.configure_stats(enabled=False)
+        off = min(off, best(run, 1) / n)
+    report('stats on %.2fus  off %.2fus  overhead %.2fus/query', on * 1e6, off * 1e6, (on - off) * 1e6)
+    t = min(timeit.repeat(lambda: db._metrics.record('select * from t where id=?', 0.0001, 1), number=100000, repeat=7))
+    report('record(): %.2fus', t / 100000 * 1e6)
+
+if __name__ == '__main__':
+    main()
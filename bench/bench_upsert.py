@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+'''
+一半已存在的行  逐行 find_first + insert/update 和 Model.upsert_all 的耗时
+'''
+import time
+
+from common import db, sqlite, create_tables, report
+
+import orm
+
+class Profile(orm.Model):
+    __table__ = 'profiles'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+    score = orm.IntegerField()
+    created = orm.FloatField(updatable=False, default=time.time)
+
+def find_and_write(rows):
+    with db.transaction():
+        for r in rows:
+            m = Profile.find_first('where id=?', r['id'])
+            if m is None:
+                Profile(**r).insert()
+            else:
+                m.name = r['name']
+                m.score = r['score']
+                m.update()
+
+def upsert(rows):
+    Profile.upsert_all([Profile(**r) for r in rows])
+
+def run(func, n):
+    sqlite()
+    create_tables(Profile)
+    Profile.insert_all([Profile(id=i, name='old', score=0) for i in range(0, n, 2)])
+    rows = [dict(id=i, name='n%d' % i, score=i) for i in range(n)]
+    start = time.time()
+    func(rows)
+    t = time.time() - start
+    assert db.select_int('select count(*) from profiles where name like ?', 'n%') == n
+    return t
+
+def main(n=2000):
+    for func in (find_and_write, upsert):
+        report('%-14s %d rows: %.1fms', func.__name__, n, min(run(func, n) for i in range(3)) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+性能测试的公共部分  和 tests 一样把 db 目录加到 sys.path  数据库用临时目录里的 sqlite 文件
+只测 Python 这一侧的开销时用 NoopConnection(不访问数据库的假驱动)
+运行全部:  python bench/run.py  (结果同时写到 bench_output.txt)
+'''
+import os
+import sys
+import time
+import atexit
+import shutil
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'db'))
+
+import db
+
+_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, _dir, True)
+
+def sqlite(name='bench.db', **kw):
+    '''
+    db.engine 指向一个新的 sqlite 数据库(文件已存在时先删除)  kw 传给 _Engine  返回文件路径
+    '''
+    path = os.path.join(_dir, name)
+    if db.engine is not None:
+        db.engine.dispose()
+    if os.path.exists(path):
+        os.remove(path)
+    kw.setdefault('timeout', 60)
+    timeout = kw.pop('timeout')
+    db.engine = db._Engine(lambda: sqlite3.connect(path, check_same_thread=False, timeout=timeout), placeholder='?', **kw)
+    db.configure_stats(enabled=True, slow_query=None)
+    return path
+
+class _NoopCursor(object):
+    rowcount = 1
+    description = (('id', ), ('name', ))
+
+    def execute(self, sql, args):
+        pass
+
+    def fetchall(self):
+        return [(1, 'a')]
+
+    def fetchone(self):
+        return (1, 'a')
+
+    def close(self):
+        pass
+
+class NoopConnection(object):
+    '''
+    什么也不做的驱动连接  execute 立即返回 查询总是返回一行 (1, 'a')
+    '''
+    def cursor(self, **kw):
+        return _NoopCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def noop():
+    if db.engine is not None:
+        db.engine.dispose()
+    db.engine = db._Engine(NoopConnection, ping=False)
+    db.configure_stats(enabled=False)
+
+def create_tables(*models):
+    # __sql__ 第一行是注释  建表和建索引是分开的语句
+    for model in models:
+        for sql in model().__sql__().split('\n', 1)[1].split(';'):
+            if sql.strip():
+                db.update(sql)
+
+def best(func, repeat=5):
+    '''
+    执行 repeat 次  返回最短的秒数
+    '''
+    r = 1e9
+    for i in range(repeat):
+        start = time.time()
+        func()
+        r = min(r, time.time() - start)
+    return r
+
+def report(fmt, *args):
+    print fmt % args
+    sys.stdout.flush()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+'''
+依次运行 bench 目录下所有 bench_*.py(或者命令行指定的几个)  输出同时写到仓库根目录的 bench_output.txt:
+    python bench/run.py
+    python bench/run.py bench_upsert.py bench_counters.py
+'''
+import os
+import sys
+import glob
+import subprocess
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    names = (sys.argv[1:] if argv is None else argv) or sorted(glob.glob(os.path.join(here, 'bench_*.py')))
+    failed = 0
+    with open(os.path.join(here, os.pardir, 'bench_output.txt'), 'w') as out:
+        for name in names:
+            path = os.path.join(here, os.path.basename(name))
+            title = '== %s' % os.path.basename(path)
+            print title
+            out.write(title + '\n')
+            p = subprocess.Popen([sys.executable, path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in iter(p.stdout.readline, ''):
+                sys.stdout.write(line)
+                out.write(line)
+            if p.wait():
+                failed += 1
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(main())
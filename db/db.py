@@ -23,9 +23,16 @@ with db.transactions():
 	db.select('....')
 """
 
+import os
+import re
+import sys
+import Queue
 import time
 import uuid
+import collections
+import bisect
 import functools
+import itertools
 import threading
 import logging
 
@@ -69,31 +76,283 @@ class Dict(dict):
 
 
 '''---------------------------------------------以上是Dict类的定义-----------------------------------------------------'''
+class Row(Dict):
+    '''
+    select/select_one/iter_select 返回的一行  就是一个 Dict: row.name  row['name']  可以修改  json.dumps 得到对象
+    直接用 dict 的构造函数生成  不经过 Dict.__init__ 里逐个赋值的循环  见 _make_rows
+    orm 不需要 Row  用 select_rows/iter_select_rows 拿到原始的 tuple
+    '''
+    __init__ = dict.__init__
+
+def _make_rows(names, rows):
+    '''
+    生成每行的 Row  先复制所有列名都已经在里面的模板(复制时按大小一次分配好)再填入值
+    直接逐个插入 (列名, 值) 时 dict 会在中途扩容 7 列的一行要多占一半以上的内存
+    '''
+    template = dict.fromkeys(names)
+    update = dict.update
+    izip = itertools.izip
+    for values in rows:
+        row = Row(template)
+        update(row, izip(names, values))
+        yield row
+
+
+'''
+	@method next_id 生成主键
+'''
+# 每个 id 由 (毫秒时间戳, 节点号, 序号) 组成  同一个进程里严格递增  不同进程/机器的节点号不同就不会重复
+# 同一毫秒内序号用完时借用下一毫秒  时钟回拨时继续使用上一次的毫秒数  所以不会重复也不会变小
+_ID_EPOCH = 1420070400000  # 2015-01-01 bigint id 中的时间戳从这里开始算
+_ID_SEQ_BITS = 12
+_ID_SEQ_MASK = (1 << _ID_SEQ_BITS) - 1
+_ID_NODE_BITS = 10
+_ID_NODE_MASK = (1 << _ID_NODE_BITS) - 1
+
+
+class _IdGenerator(object):
+    '''
+    node 为 None 时每个进程随机选一个 48 位的节点号(fork 以后重新选)
+    部署多个进程时用 set_node_id 指定不同的节点号可以保证不重复  bigint id 只用节点号的低 10 位
+    '''
+    def __init__(self, node=None):
+        self._lock = threading.Lock()
+        self._fixed = node is not None
+        self._pid = os.getpid()
+        self.node = node if node is not None else uuid.uuid4().int & 0xffffffffffff
+        self._ms = 0
+        self._seq = _ID_SEQ_MASK
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            if not self._fixed:
+                self.node = uuid.uuid4().int & 0xffffffffffff
+
+    def next(self, t=None):
+        '返回 (毫秒, 节点号, 序号)  节点号在锁里读 fork 以后的第一个 id 也用新的节点号'
+        now = int((time.time() if t is None else t) * 1000)
+        with self._lock:
+            self._check_fork()
+            if now > self._ms:
+                self._ms = now
+                self._seq = 0
+            elif self._seq < _ID_SEQ_MASK:
+                self._seq += 1
+            else:
+                self._ms += 1
+                self._seq = 0
+            return self._ms, self.node, self._seq
+
+    def reserve(self, n, t=None):
+        '一次取 n 个连续的 (毫秒, 序号)  返回 (节点号, [(毫秒, 序号)])'
+        now = int((time.time() if t is None else t) * 1000)
+        with self._lock:
+            self._check_fork()
+            ms, seq = self._ms, self._seq
+            if now > ms:
+                ms, seq = now, -1
+            L = []
+            for i in xrange(n):
+                if seq < _ID_SEQ_MASK:
+                    seq += 1
+                else:
+                    ms += 1
+                    seq = 0
+                L.append((ms, seq))
+            if L:
+                self._ms, self._seq = ms, seq
+            return self.node, L
+
+
+_ids = _IdGenerator()
+
+def set_node_id(node):
+    '''
+    指定本进程的节点号(非负整数)  bigint id 要求各进程节点号的低 10 位互不相同
+    '''
+    global _ids
+    _ids = _IdGenerator(node)
+
 def next_id(t=None):
     '''
-    Return next id as 50-char string
+    Return next id as 30-char string: 15位毫秒时间戳 + 12位16进制节点号 + 3位16进制序号
+    按字符串排序就是按生成时间排序  和以前 50 个字符的 id 前缀格式相同 可以混在一起排序
     args:
         t:unix timestamp,default to None and  using time.time().
 
     '''
-    if t is None:
-        t = time.time()
-    return '%015d%s000' % (int(t * 1000), uuid.uuid4.hex)
+    ms, node, seq = _ids.next(t)
+    return '%015d%012x%03x' % (ms, node, seq)
+
+def next_ids(n, t=None):
+    '''
+    一次生成 n 个字符串 id  比循环调用 next_id 快
+    '''
+    node, L = _ids.reserve(n, t)
+    node = '%012x' % node
+    return ['%015d%s%03x' % (ms, node, seq) for ms, seq in L]
+
+def next_bigint_id(t=None):
+    '''
+    返回 64 位整数 id: 41位毫秒(从 _ID_EPOCH 开始) + 10位节点号 + 12位序号  用于 bigint 主键 比字符串主键的索引小得多:
+        id = IntegerField(primary_key=True, default=next_bigint_id)
+    '''
+    ms, node, seq = _ids.next(t)
+    return ((ms - _ID_EPOCH) << 22) | ((node & _ID_NODE_MASK) << _ID_SEQ_BITS) | seq
+
+def next_bigint_ids(n, t=None):
+    node, L = _ids.reserve(n, t)
+    node = (node & _ID_NODE_MASK) << _ID_SEQ_BITS
+    return [((ms - _ID_EPOCH) << 22) | node | seq for ms, seq in L]
 
 
 '''
-	@time 2015-02-10
-	@method _profiling 记录sql 的运行状态
+	@method _metrics 记录每一种sql语句的运行状态 取代原来只打一行日志的 _profiling
 '''
-def _profiling(start, sql=''):
+# 延迟直方图的桶(秒)  最后一个桶收集所有更慢的语句
+_bisect_left = bisect.bisect_left
+_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_RE_FP_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_FP_NUMBER = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.I)
+_RE_FP_IN = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+_RE_FP_VALUES = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+_RE_FP_SPACES = re.compile(r'\s+')
+
+
+def _fingerprint(sql):
     '''
-    单下划线开头的方法名或者属性 不会再 from moduleName import * 中被导入 也就是说只有本模块中可以访问
+    把 sql 语句里的常量都换成 ?  in (?,?,...) 和多行 values 合并成一个  得到同一类语句共用的指纹
     '''
-    t = time.time() - start
-    if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s:%s' % (t, sql))
-    else:
-        logging.info('[PROFILING] [DB] %s:%s' % (t, sql))
+    fp = _RE_FP_STRING.sub('?', sql.replace('%s', '?'))
+    fp = _RE_FP_NUMBER.sub('?', fp)
+    fp = _RE_FP_IN.sub('in (...)', fp)
+    fp = _RE_FP_VALUES.sub(r'\1,...', fp)
+    return _RE_FP_SPACES.sub(' ', fp).strip().lower()
+
+
+class _StatementStats(object):
+    __slots__ = ('count', 'total', 'min', 'max', 'rows', 'errors', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.rows = 0
+        self.errors = 0
+        self.buckets = [0] * (len(_LATENCY_BUCKETS) + 1)
+
+    def percentile(self, p):
+        '按直方图估算  返回所在桶的上界(不超过最大值)'
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if n >= rank:
+                return min(_LATENCY_BUCKETS[i], self.max) if i < len(_LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return Dict(count=self.count, errors=self.errors, rows=self.rows,
+                    total=self.total, avg=self.total / self.count if self.count else 0.0,
+                    min=self.min if self.count else 0.0, max=self.max,
+                    p50=self.percentile(0.5), p95=self.percentile(0.95), p99=self.percentile(0.99),
+                    histogram=zip(_LATENCY_BUCKETS + (None,), self.buckets))
+
+
+class _Metrics(object):
+    '''
+    按指纹汇总的语句统计  次数 总/最小/最大耗时 延迟直方图 返回/影响的行数 出错次数
+    超过 slow_query 秒的语句记一条警告日志  slow_query 为 None 时不记
+    '''
+    def __init__(self, slow_query=0.1):
+        self.enabled = True
+        self.slow_query = slow_query
+        self._lock = threading.Lock()
+        self._stmts = {}
+        self._fingerprints = {}
+        # sql ==> 它的指纹的统计  record 每次只需要查一次 dict
+        self._by_sql = {}
+
+    def fingerprint(self, sql):
+        fp = self._fingerprints.get(sql)
+        if fp is None:
+            if len(self._fingerprints) > 10000:
+                self._fingerprints.clear()
+            fp = self._fingerprints[sql] = _fingerprint(sql)
+        return fp
+
+    def _stats(self, sql):
+        fp = self.fingerprint(sql)
+        with self._lock:
+            s = self._stmts.get(fp)
+            if s is None:
+                s = self._stmts[fp] = _StatementStats()
+            if len(self._by_sql) > 10000:
+                self._by_sql = {}
+            self._by_sql[sql] = s
+        return s
+
+    def record(self, sql, elapsed, rows=0, error=False):
+        # 每条语句都会调用  尽量少做事: 一次 dict 查找 一次 bisect 锁里只有计数
+        s = self._by_sql.get(sql)
+        if s is None:
+            s = self._stats(sql)
+        i = _bisect_left(_LATENCY_BUCKETS, elapsed)
+        with self._lock:
+            s.count += 1
+            s.total += elapsed
+            if elapsed < s.min:
+                s.min = elapsed
+            if elapsed > s.max:
+                s.max = elapsed
+            if rows > 0:
+                s.rows += rows
+            if error:
+                s.errors += 1
+            s.buckets[i] += 1
+        if self.slow_query is not None and elapsed > self.slow_query:
+            logging.warning('[PROFILING] [DB] slow sql %.3fs:%s' % (elapsed, self.fingerprint(sql)))
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            d = Dict()
+            for fp, s in self._stmts.iteritems():
+                d[fp] = s.to_dict()
+            if reset:
+                self._stmts = {}
+                self._by_sql = {}
+        return d
+
+
+_metrics = _Metrics()
+
+def configure_stats(enabled=None, slow_query=False):
+    '''
+    enabled: 是否记录语句统计(默认开启)
+    slow_query: 慢查询日志的阈值(秒)  None 表示不记慢查询  不传则不改变
+    '''
+    if enabled is not None:
+        _metrics.enabled = enabled
+    if slow_query is not False:
+        _metrics.slow_query = slow_query
+
+def stats(reset=False):
+    '''
+    返回 指纹 ==> 统计 的 Dict  每一项包含
+        count/errors: 执行/出错次数
+        rows: select 返回的行数 或者 insert/update/delete 影响的行数
+        total/avg/min/max: 耗时(秒)
+        p50/p95/p99: 按直方图估算的耗时分位数
+        histogram: [(桶上界, 次数)]  最后一个桶的上界是 None
+    reset=True 时返回快照以后清零
+    '''
+    return _metrics.snapshot(reset)
 
 
 class DBError(Exception):
@@ -102,19 +361,244 @@ class DBError(Exception):
 
 class MultiColumnsError(DBError):
     pass
+
+
+class PoolTimeoutError(DBError):
+    pass
+
 #模块是全局对象，模块变量是全局唯一变量，所以，有两个重要的模块变量：
 # global engine object  保存着mysql数据库的连接
 engine = None
 
-class DBError(Exception):
-    pass
+class _Pool(object):
+    '''
+    线程安全的有界连接池  _LasyConnect 从这里借出连接 用完以后归还而不是关闭
+
+    min_size: 回收空闲连接时至少保留的连接数
+    max_size: 连接总数上限 全部借出以后调用者需要等待
+    timeout: 等待连接的最长秒数 超时抛出 PoolTimeoutError  None 表示一直等
+    max_idle: 空闲超过该秒数的连接会被关闭(保留 min_size 个)
+    max_lifetime: 连接创建超过该秒数以后不再复用
+    ping: 借出之前先检测连接是否可用 不可用就丢弃并重新创建
+    ping_idle: 只检测空闲超过该秒数的连接  刚归还的连接直接借出 省掉一次往返  0 表示每次都检测
+    '''
+
+    def __init__(self, connect, min_size=0, max_size=10, timeout=30, max_idle=300, max_lifetime=3600, ping=True,
+                 ping_idle=10):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise DBError('Invalid pool size: min=%s, max=%s' % (min_size, max_size))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping = ping
+        self.ping_idle = ping_idle
+        self._cond = threading.Condition()
+        self._idle = []     # [(connection, 归还时间)] 尾部是最近归还的
+        self._created = {}  # id(connection) --> 创建时间
+        self._in_use = 0
+        self._waiters = 0
+        self._reset_counters()
+        for i in range(min_size):
+            self._idle.append((self._open(), time.time()))
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    def _reset_counters(self):
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+
+    def _open(self):
+        connection = self._connect()
+        with self._cond:
+            self._created[id(connection)] = time.time()
+        logging.info('open connection <%s>...' % hex(id(connection)))
+        return connection
+
+    def _close(self, connection):
+        with self._cond:
+            self._created.pop(id(connection), None)
+        logging.info('close connection <%s>...' % hex(id(connection)))
+        try:
+            connection.close()
+        except Exception:
+            logging.warning('close connection <%s> failed.' % hex(id(connection)))
+
+    def _expired(self, connection, now):
+        if self.max_lifetime is None:
+            return False
+        return now - self._created.get(id(connection), now) > self.max_lifetime
+
+    def _alive(self, connection):
+        try:
+            if hasattr(connection, 'ping'):
+                connection.ping()
+            else:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute('select 1')
+                finally:
+                    cursor.close()
+            return True
+        except Exception:
+            logging.warning('connection <%s> is broken, discard it.' % hex(id(connection)))
+            return False
+
+    def _evict(self, now):
+        '必须在持有锁的时候调用 返回需要在锁外关闭的连接'
+        stale = [c for c, since in self._idle if self._expired(c, now)]
+        idle = [(c, since) for c, since in self._idle if not self._expired(c, now)]
+        if self.max_idle is not None:
+            while idle and len(idle) + self._in_use > self.min_size and now - idle[0][1] > self.max_idle:
+                stale.append(idle.pop(0)[0])
+        self._idle = idle
+        return stale
+
+    def acquire(self):
+        start = time.time()
+        with self._cond:
+            stale = self._evict(start)
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = None
+                if self.timeout is not None:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError('No connection available in %s seconds.' % self.timeout)
+                self._waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            connection, since = self._idle.pop() if self._idle else (None, None)
+            self._in_use += 1
+            waited = time.time() - start
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
+        for c in stale:
+            self._close(c)
+        try:
+            if connection is not None and self.ping and start - since >= self.ping_idle \
+                    and not self._alive(connection):
+                self._close(connection)
+                connection = None
+            if connection is None:
+                connection = self._open()
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def release(self, connection, discard=False, clean=False):
+        '''
+        归还连接 先回滚掉未提交的状态 避免下一个借用者读到旧的快照
+        clean: 调用者知道上次提交(回滚)以后没有执行过语句  这时不用回滚
+        驱动提供 in_transaction(比如 mysql.connector)时 也按它判断是否需要回滚
+        '''
+        if not discard and not clean and getattr(connection, 'in_transaction', True):
+            try:
+                connection.rollback()
+            except Exception:
+                logging.warning('rollback connection <%s> failed.' % hex(id(connection)))
+                discard = True
+        now = time.time()
+        with self._cond:
+            self._in_use -= 1
+            if not discard and not self._expired(connection, now):
+                self._idle.append((connection, now))
+            else:
+                discard = True
+            self._cond.notify()
+        if discard:
+            self._close(connection)
+
+    def dispose(self):
+        '关闭所有空闲连接 借出的连接归还时照常处理'
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for c, since in idle:
+            self._close(c)
+
+    def stats(self, reset=False):
+        with self._cond:
+            d = Dict(in_use=self._in_use, idle=len(self._idle), waiters=self._waiters,
+                     size=self._in_use + len(self._idle), min_size=self.min_size, max_size=self.max_size,
+                     checkouts=self._checkouts, timeouts=self._timeouts,
+                     wait_time=self._wait_time, max_wait=self._max_wait,
+                     avg_wait=self._wait_time / self._checkouts if self._checkouts else 0.0)
+            if reset:
+                self._reset_counters()
+        return d
+
 
 class _Engine(object):
-    def __init__(self, connect):
+    '''
+    connect: 创建一个 DB-API 连接的函数  pool_kw 原样传给 _Pool
+    placeholder: 驱动使用的参数占位符 mysql.connector 是 %s  sqlite3 是 ?
+    stream_kw: 创建不缓冲结果集的游标时传给 cursor() 的参数  见 iter_select
+    replicas: 只读副本的 _Engine 列表  不在事务中 也没有写过数据时 查询语句发给副本
+    balance: 选择副本的方式  round_robin 轮流  least_busy 借出连接最少的
+    dialect: mysql 或者 sqlite  决定 upsert 等语句的写法  None 时按 placeholder 判断(? 是 sqlite)
+    '''
+    def __init__(self, connect, placeholder='%s', stream_kw=None, replicas=None, balance='round_robin',
+                 dialect=None, **pool_kw):
+        if balance not in ('round_robin', 'least_busy'):
+            raise DBError('Invalid balance: %s' % balance)
+        if dialect is None:
+            dialect = 'sqlite' if placeholder == '?' else 'mysql'
+        if dialect not in ('mysql', 'sqlite'):
+            raise DBError('Invalid dialect: %s' % dialect)
         self._connect = connect
+        self.placeholder = placeholder
+        self.dialect = dialect
+        self.stream_kw = stream_kw or {}
+        self.replicas = list(replicas or ())
+        self.balance = balance
+        self._next = itertools.count()
+        self._sql = {}
+        self.pool = _Pool(connect, **pool_kw)
+
+    def sql(self, sql):
+        '''
+        把 ? 换成驱动的占位符  结果按语句缓存 orm 预先拼好的语句每次只需要查一次 dict
+        '''
+        s = self._sql.get(sql)
+        if s is None:
+            if len(self._sql) > 10000:
+                self._sql.clear()
+            s = self._sql[sql] = sql.replace('?', self.placeholder)
+        return s
 
     def connect(self):
-        return self._connect()
+        return self.pool.acquire()
+
+    def replica(self):
+        '''
+        按 balance 选择一个只读副本  没有副本时返回自己
+        '''
+        replicas = self.replicas
+        if not replicas:
+            return self
+        if self.balance == 'least_busy':
+            return min(replicas, key=lambda r: r.pool.in_use)
+        return replicas[next(self._next) % len(replicas)]
+
+    def release(self, connection, discard=False, clean=False):
+        self.pool.release(connection, discard, clean)
+
+    def dispose(self):
+        self.pool.dispose()
+        for r in self.replicas:
+            r.dispose()
 
 
 def create_engine(user, password, database, host='192.168.21.134', port=3306, **kw):
@@ -130,41 +614,107 @@ def create_engine(user, password, database, host='192.168.21.134', port=3306, **
     for k, v in defaults.iteritems():  # 将defaults和kw中的键值对保存到params中 如果有一个key两边都存在那么保存kw的
         params[k] = kw.pop(k, v)    # pop函数会将key为k的键值对删除并且返回k对应的value 如果k在kw中不存在 那么将会返回v
 
+    # 连接池的参数 pool_xxx 对应 _Pool 的 xxx
+    pool_kw = dict((k[5:], kw.pop(k)) for k in kw.keys() if k.startswith('pool_'))
+    # 只读副本: 主机名 或者 需要覆盖的连接参数(host/port/user...)的 dict
+    replicas = kw.pop('replicas', ())
+    balance = kw.pop('balance', 'round_robin')
+
     params.update(kw)
     params['buffered'] = True
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+
+    def _mysql_engine(params, **kw):
+        # 连接默认是 buffered 的  iter_select 需要逐批读取时用 buffered=False 的游标
+        return _Engine(lambda: mysql.connector.connect(**params), stream_kw=dict(buffered=False), dialect='mysql', **kw)
+
+    replica_engines = []
+    for r in replicas:
+        p = dict(params)
+        p.update(r if isinstance(r, dict) else dict(host=r))
+        replica_engines.append(_mysql_engine(p, **pool_kw))
+    engine = _mysql_engine(params, replicas=replica_engines, balance=balance, **pool_kw)
 
     # 在这里(lambda:mysql.connector.connect(**params))返回的是一个函数而不是一个connection对象
     # test connection....
     logging.info('Init mysql engine <%s> ok' % hex(id(engine)))
     #print ('Init mysql engine <%s> ok' % hex(id(engine)))
 
+def pool_stats(reset=False):
+    '''
+    返回连接池的状态 用来确定连接池的大小:
+        in_use/idle/size: 借出/空闲/总共的连接数
+        waiters: 正在等待连接的线程数
+        checkouts/timeouts: 借出次数/等待超时次数
+        wait_time/avg_wait/max_wait: 等待连接花费的时间(秒)
+        replicas: 每个只读副本的连接池状态(配置了副本时)
+    reset=True 时清零累计的计数
+    '''
+    d = engine.pool.stats(reset)
+    if engine.replicas:
+        d.replicas = [r.pool.stats(reset) for r in engine.replicas]
+    return d
+
 #===================以上通过engine这个全局变量就可以获得一个数据库链接，重复链接抛异常=============================#
 
 '''对数据库连接以及最基本的操作进行了封装'''
 class _LasyConnect(object):
     def __init__(self):
         self.connection = None
-
-    def cursor(self):
+        self.engine = None
+        # 只读副本的连接 只用来执行查询
+        self.replica_connection = None
+        self.replica_engine = None
+        # 上次提交(回滚)以后执行过语句  归还时需要回滚
+        self.dirty = False
+
+    def cursor(self, **kw):
         if self.connection is None:
-            connection = engine.connect()
-            logging.info('open connection <%s>...' % hex(id(connection)))
-            self.connection = connection
-        return self.connection.cursor()
+            # 从连接池借出连接 记住借出的 engine 归还的时候还给它
+            self.engine = engine
+            self.connection = engine.connect()
+            logging.info('checkout connection <%s>...' % hex(id(self.connection)))
+        self.dirty = True
+        return self.connection.cursor(**kw)
+
+    def replica_cursor(self):
+        if self.replica_connection is None:
+            replica = engine.replica()
+            if replica is engine:
+                return self.cursor()
+            try:
+                self.replica_connection = replica.connect()
+            except Exception:
+                # 副本不可用时 查询改发给主库
+                logging.warning('replica <%s> is not available, use primary.' % hex(id(replica)))
+                return self.cursor()
+            self.replica_engine = replica
+            logging.info('checkout replica connection <%s>...' % hex(id(self.replica_connection)))
+        return self.replica_connection.cursor()
 
     def commit(self):
-        return self.connection.commit()
+        # 事务里的查询可能全部命中了缓存 这时还没有借出连接
+        if self.connection:
+            self.connection.commit()
+            self.dirty = False
 
     def rollback(self):
-        return self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
+            self.dirty = False
 
     def cleanup(self):
-        if self.connection:
-            connection = self.connection
-            self.connection = None
-            logging.info('colse connection <%s>...' % hex(id(connection)))
-            connection.close()
+        try:
+            if self.connection:
+                connection = self.connection
+                self.connection = None
+                logging.info('release connection <%s>...' % hex(id(connection)))
+                self.engine.release(connection, clean=not self.dirty)
+        finally:
+            if self.replica_connection:
+                connection = self.replica_connection
+                self.replica_connection = None
+                logging.info('release replica connection <%s>...' % hex(id(connection)))
+                self.replica_engine.release(connection)
 
 # 持有数据库连接的上下文对象:
 '''接下来解决对于不同的线程数据库链接应该是不一样的 于是创建一个变量  是一个threadlocal 对象'''
@@ -173,6 +723,12 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.written = set()  # 当前事务写过的表 提交以后让这些表的缓存失效
+        self.wrote = False    # 写过数据以后 查询都发给主库 保证读到自己写的数据
+        self.callbacks = []   # 事务结束以后调用 见 after_transaction
+        self.before = []      # 提交之前调用 见 before_commit
+        self.state = None     # 只在一个事务中有效的 dict 见 transaction_state
+        self.autoflush = None # 事务中每次查询之前调用 见 set_autoflush
 
     def is_init(self):
         return not self.connection is None  # 判断是否已经进行了初始化
@@ -183,6 +739,12 @@ class _DbCtx(threading.local):
         # print threading.current_thread().name
         # print id(self.connection)
         self.transactions = 0
+        self.written = set()
+        self.wrote = False
+        self.callbacks = []
+        self.before = []
+        self.state = None
+        self.autoflush = None
 
     def cleanup(self):
         self.connection.cleanup()
@@ -191,6 +753,15 @@ class _DbCtx(threading.local):
     def cursor(self):
         return self.connection.cursor()
 
+    def read_only(self):
+        '是否可以把查询发给只读副本'
+        return not self.transactions and not self.wrote
+
+    def read_cursor(self):
+        if self.read_only():
+            return self.connection.replica_cursor()
+        return self.connection.cursor()
+
 # 由于它继承threading.local 是一个threadlocal对象 所以它对于每一个线程都是不一样的。
 # 所以当需要数据库连接的时候就使用它来创建
 _db_ctx = _DbCtx()
@@ -264,19 +835,47 @@ class _TransactionCtx(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         global _db_ctx
+        failure = None
+        if _db_ctx.transactions == 1 and exc_type is None and _db_ctx.before:
+            # 还在事务中执行 before_commit 注册的函数  出错时回滚并抛出这个异常
+            try:
+                for fn in list(_db_ctx.before):
+                    fn()
+            except:
+                failure = sys.exc_info()
+                exc_type = failure[0]
         _db_ctx.transactions = _db_ctx.transactions - 1
         try:
             if _db_ctx.transactions == 0:
                 # print '----------------type:',type
                 # print '----------------value:',value
                 # print '----------------trace:',trace
-                if exc_type is None:
-                    self.commit()
-                else:
-                    self.rollback()
+                committed = False
+                try:
+                    if exc_type is None:
+                        self.commit()
+                        committed = True
+                    else:
+                        self.rollback()
+                finally:
+                    # 提交以后再让缓存失效 避免别的线程在提交前把旧数据又放回缓存
+                    if _cache is not None and _db_ctx.written:
+                        _cache.invalidate(_db_ctx.written)
+                    _db_ctx.written = set()
+                    _db_ctx.before = []
+                    _db_ctx.state = None
+                    _db_ctx.autoflush = None
+                    callbacks, _db_ctx.callbacks = _db_ctx.callbacks, []
+                    for fn in callbacks:
+                        try:
+                            fn(committed)
+                        except Exception:
+                            logging.exception('after transaction callback failed.')
         finally:
             if self.should_close_conn:
                 _db_ctx.cleanup()
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
 
     def commit(self):
         global _db_ctx
@@ -297,6 +896,48 @@ class _TransactionCtx(object):
         _db_ctx.connection.rollback()
         logging.info('rollback ok...')
 
+def in_transaction():
+    '''
+    当前线程是否在事务中
+    '''
+    return _db_ctx.transactions > 0
+
+def after_transaction(fn):
+    '''
+    当前事务结束(提交或者回滚)以后调用 fn(committed)  不在事务中时立即调用 fn(True)
+    '''
+    if _db_ctx.transactions:
+        _db_ctx.callbacks.append(fn)
+    else:
+        fn(True)
+
+def transaction_state():
+    '''
+    返回当前(最外层)事务的 dict  事务结束(提交或者回滚)时丢弃  不在事务中时返回 None
+    orm 用它保存事务内的 identity map 和 unit of work
+    '''
+    if not _db_ctx.transactions:
+        return None
+    if _db_ctx.state is None:
+        _db_ctx.state = {}
+    return _db_ctx.state
+
+def before_commit(fn):
+    '''
+    在当前事务提交之前(还在事务中)调用 fn()  fn 抛出异常时事务回滚 异常由 with transaction() 抛出
+    '''
+    if not _db_ctx.transactions:
+        raise DBError('Not in a transaction.')
+    _db_ctx.before.append(fn)
+
+def set_autoflush(fn):
+    '''
+    在当前事务中 每次执行查询之前调用 fn()  让查询能看到还没有写入数据库的修改
+    '''
+    if not _db_ctx.transactions:
+        raise DBError('Not in a transaction.')
+    _db_ctx.autoflush = fn
+
 def transaction():
     '''
     Create a transaction object so can use with statement:
@@ -330,38 +971,512 @@ def with_transaction(func):
     @functools.wraps(func)
     def wrapper(*args, **kw):
         _start = time.time()
-        with transaction():
-            return func(*args, **kw)
-        _profiling(_start)
+        error = False
+        try:
+            with transaction():
+                return func(*args, **kw)
+        except:
+            error = True
+            raise
+        finally:
+            if _metrics.enabled:
+                _metrics.record('transaction %s' % func.__name__, time.time() - _start, error=error)
 
     return wrapper
 
 # ===============================以上是事务处理======================================================================
 
-def _select(sql, first, *args):
-    'execute select SQL and return unique result or list results'
+# ================================================以下是查询缓存=======================================================
+# 默认关闭  enable_cache() 以后 select/select_one/select_int/select_rows 的结果按 (sql, 参数) 缓存
+# 每张表有一个版本号 写操作(_update 或事务提交)让表的版本号加一 依赖这张表的缓存就全部失效了
+
+# 无法识别写了哪张表时用它表示所有的表
+_ALL_TABLES = '*'
+
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:(?:insert|replace)\s+(?:ignore\s+)?into|update(?:\s+ignore)?|delete\s+from|'
+                             r'(?:create|drop|alter|truncate)\s+table(?:\s+if\s+(?:not\s+)?exists)?)\s+`?(\w+)`?', re.I)
+_RE_FROM = re.compile(r'\bfrom\s+(.+?)(?=\b(?:where|group|order|limit|having|union|for|join|left|right|inner|cross|straight_join)\b|\)|;|$)', re.I | re.S)
+_RE_JOIN = re.compile(r'\bjoin\s+(\S+)', re.I)
+_RE_SPACES = re.compile(r'\s+')
+_RE_LOCKING = re.compile(r'\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b', re.I)
+
+
+def _table_name(s):
+    s = s.strip().split(None, 1)[0] if s.strip() else ''
+    s = s.strip('`')
+    return s if re.match(r'^\w+$', s) else None
+
+def _read_tables(sql):
+    '''
+    返回查询语句用到的表  有子查询等无法识别的情况时返回 None 这样的查询不缓存
+    加锁的读(for update / lock in share mode)也返回 None
+    '''
+    if _RE_LOCKING.search(sql):
+        return None
+    tables = set()
+    for m in _RE_FROM.finditer(sql):
+        for s in m.group(1).split(','):
+            t = _table_name(s)
+            if t is None:
+                return None
+            tables.add(t)
+    for m in _RE_JOIN.finditer(sql):
+        t = _table_name(m.group(1))
+        if t is None:
+            return None
+        tables.add(t)
+    if not tables or re.search(r'\(\s*select\b', sql, re.I):
+        return None
+    return frozenset(tables)
+
+def _written_tables(sql):
+    '''
+    返回写操作修改的表  无法识别时返回 None 表示所有的表
+    '''
+    m = _RE_WRITE_TABLE.match(sql)
+    if not m:
+        return None
+    tables = set([m.group(1)])
+    for j in _RE_JOIN.finditer(sql):
+        t = _table_name(j.group(1))
+        if t is None:
+            return None
+        tables.add(t)
+    return tables
+
+
+class _QueryCache(object):
+    '''
+    按 LRU 淘汰的查询结果缓存  最多 max_size 条  每条最多保存 ttl 秒(None 表示不过期)
+    '''
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key --> (tables, versions, 过期时间, value)
+        self._versions = {}                        # 表名 --> 版本号
+        self._tables = {}                          # sql --> (规范化的 sql, 用到的表)
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def lookup(self, sql, first, args):
+        '''
+        返回 (缓存的 key, 查询用到的表)  不能缓存时表为 None
+        '''
+        t = self._tables.get(sql)
+        if t is None:
+            if len(self._tables) > 10000:
+                self._tables.clear()
+            t = self._tables[sql] = (_RE_SPACES.sub(' ', sql.strip()), _read_tables(sql))
+        key = (t[0], first, args)
+        try:
+            hash(key)
+        except TypeError:
+            return None, None
+        return key, t[1]
+
+    def versions(self, tables):
+        v = self._versions
+        return tuple([v.get(_ALL_TABLES, 0)] + [v.get(t, 0) for t in sorted(tables)])
+
+    def get(self, key, tables):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            if entry[1] != self.versions(entry[0]):
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return False, None
+            if entry[2] is not None and entry[2] < time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            # 移到末尾 表示最近使用过
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+        names, values = entry[3]
+        return True, (names, list(values) if isinstance(values, list) else values)
+
+    def put(self, key, tables, versions, value):
+        '''
+        versions 必须是执行查询之前取得的版本号 查询期间有写操作的话 这条缓存立即就是失效的
+        '''
+        names, values = value
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (tables, versions, expires, (names, tuple(values) if isinstance(values, list) else values))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tables=None):
+        '''
+        让依赖这些表的缓存失效  tables 为 None 时所有缓存失效
+        '''
+        with self._lock:
+            for t in (_ALL_TABLES,) if tables is None else tables:
+                self._versions[t] = self._versions.get(t, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self, reset=False):
+        with self._lock:
+            lookups = self.hits + self.misses
+            d = Dict(size=len(self._entries), max_size=self.max_size, ttl=self.ttl,
+                     hits=self.hits, misses=self.misses, evictions=self.evictions,
+                     expirations=self.expirations, invalidations=self.invalidations,
+                     hit_ratio=float(self.hits) / lookups if lookups else 0.0)
+            if reset:
+                self._reset_counters()
+        return d
+
+
+# 全局的查询缓存  None 表示没有启用
+_cache = None
+
+def enable_cache(max_size=1000, ttl=60):
+    '''
+    启用查询缓存  重复调用会丢弃之前缓存的结果  事务中的查询总是直接执行 不读也不写缓存
+    '''
+    global _cache
+    _cache = _QueryCache(max_size, ttl)
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+def clear_cache():
+    if _cache is not None:
+        _cache.clear()
+
+def cache_stats(reset=False):
+    '''
+    返回查询缓存的命中/未命中/淘汰/过期/失效次数  没有启用缓存时返回 None
+    '''
+    if _cache is not None:
+        return _cache.stats(reset)
+
+
+'''
+	@method _advisor 慢查询自动 EXPLAIN 和索引建议
+'''
+# 默认关闭  enable_explain() 以后超过阈值的 select 在工作线程中执行一次 EXPLAIN
+# sqlite 用 explain query plan  MySQL 用 explain  找出全表扫描和 filesort 按 where/order by 的列给出索引建议
+
+_RE_WHERE = re.compile(r'\bwhere\b(.*?)(?=\b(?:group\s+by|order\s+by|limit|having|union|for\s+update)\b|$)', re.I | re.S)
+_RE_ORDER_BY = re.compile(r'\border\s+by\b(.*?)(?=\blimit\b|\bfor\s+update\b|$)', re.I | re.S)
+_RE_CONDITION = re.compile(r'(?:`?(\w+)`?\.)?`?(\w+)`?\s*(<=>|<=|>=|<>|!=|=|<|>|\bnot\s+in\b|\bin\b|\blike\b|\bbetween\b|\bis\b)', re.I)
+_RE_ALIAS = re.compile(r'^`?(\w+)`?(?:\s+(?:as\s+)?`?(\w+)`?)?\s*$', re.I)
+_RE_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+_KEYWORDS = frozenset(['and', 'or', 'not', 'where', 'on', 'null', 'select', 'exists'])
+_EQ_OPS = frozenset(['=', '<=>', 'in', 'is'])
+_RANGE_OPS = frozenset(['<', '>', '<=', '>=', 'between', 'like'])
+
+
+def _table_aliases(sql):
+    '''
+    返回 表名或别名 ==> 表名
+    '''
+    aliases = {}
+    parts = []
+    for m in _RE_FROM.finditer(sql):
+        parts.extend(m.group(1).split(','))
+    for m in re.finditer(r'\bjoin\s+(.+?)(?=\bon\b|\busing\b|\bwhere\b|\bjoin\b|$)', sql, re.I | re.S):
+        parts.append(m.group(1))
+    for s in parts:
+        m = _RE_ALIAS.match(s.strip())
+        if m:
+            aliases[m.group(1)] = m.group(1)
+            if m.group(2):
+                aliases[m.group(2)] = m.group(1)
+    return aliases
+
+def _suggest_index(sql, table, filesort):
+    '''
+    按 where 中的等值条件 然后是排序(有 filesort 时)或者第一个范围条件的列 给出 table 上的索引列
+    没有可用的条件时返回 None
+    '''
+    aliases = _table_aliases(sql)
+    single = len(set(aliases.itervalues())) == 1
+
+    def column(prefix, name):
+        if prefix is None and not single:
+            return None
+        if prefix is not None and aliases.get(prefix) != table:
+            return None
+        return name
+
+    eq = []
+    ranges = []
+    m = _RE_WHERE.search(sql)
+    for prefix, name, op in _RE_CONDITION.findall(m.group(1) if m else ''):
+        op = _RE_SPACES.sub(' ', op.lower())
+        if name.lower() in _KEYWORDS or name.isdigit():
+            continue
+        c = column(prefix or None, name)
+        if c is None:
+            continue
+        if op in _EQ_OPS and c not in eq:
+            eq.append(c)
+        elif op in _RANGE_OPS and c not in ranges:
+            ranges.append(c)
+    order = []
+    m = _RE_ORDER_BY.search(sql)
+    if m and filesort:
+        for s in m.group(1).split(','):
+            s = s.strip().split(None, 1)[0] if s.strip() else ''
+            prefix, _, name = s.rpartition('.')
+            c = column(prefix.strip('`') or None, name.strip('`'))
+            if c is None or not re.match(r'^\w+$', c):
+                order = []
+                break
+            if c not in eq and c not in order:
+                order.append(c)
+    columns = eq + (order or [r for r in ranges if r not in eq][:1])
+    return tuple(columns) if columns else None
+
+
+class _Advisor(object):
+    '''
+    按指纹汇总慢查询的执行计划  同一个指纹至少间隔 interval 秒才再 EXPLAIN 一次
+    同时最多 max_pending 个 EXPLAIN 在工作线程中执行 避免慢的时候再给数据库加压
+    '''
+    def __init__(self, threshold, interval=300, max_pending=2):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_pending = max_pending
+        self.mysql = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._last = {}
+        self._entries = {}
+
+    def observe(self, sql, args, elapsed):
+        if not sql.lstrip()[:6].lower() == 'select':
+            return None
+        fp = _metrics.fingerprint(sql)
+        now = time.time()
+        with self._lock:
+            e = self._entries.get(fp)
+            if e is None:
+                if len(self._entries) > 10000:
+                    self._entries.clear()
+                e = self._entries[fp] = Dict(sql=fp, count=0, total=0.0, max=0.0, explained=0,
+                                             plan=[], full_scans=[], filesort=False, suggestions=[])
+            e.count += 1
+            e.total += elapsed
+            e.max = max(e.max, elapsed)
+            if fp in self._pending or len(self._pending) >= self.max_pending \
+                    or now - self._last.get(fp, 0) < self.interval:
+                return None
+            self._pending.add(fp)
+            self._last[fp] = now
+        return submit(self._explain, fp, sql, args)
+
+    def plan(self, sql, args):
+        '''
+        执行 EXPLAIN 返回 (执行计划的每一行, 全表扫描的表, 是否有 filesort, 索引建议)
+        '''
+        if self.mysql is None:
+            try:
+                rows = select('explain query plan ' + sql, *args)
+                self.mysql = False
+            except Exception:
+                rows = select('explain ' + sql, *args)
+                self.mysql = True
+        else:
+            rows = select(('explain ' if self.mysql else 'explain query plan ') + sql, *args)
+        plan, scans, filesort = self._analyze(rows)
+        aliases = _table_aliases(sql)
+        scans = [aliases.get(t, t) for t in scans]
+        suggestions = []
+        for table in scans:
+            columns = _suggest_index(sql, table, filesort)
+            if columns:
+                suggestions.append(Dict(table=table, columns=columns,
+                                        text='add index on %s(%s)' % (table, ', '.join(columns))))
+        return plan, scans, filesort, suggestions
+
+    def _explain(self, fp, sql, args):
+        try:
+            plan, scans, filesort, suggestions = self.plan(sql, args)
+            with self._lock:
+                e = self._entries.get(fp)
+                if e is not None:
+                    e.explained += 1
+                    e.plan = plan
+                    e.full_scans = scans
+                    e.filesort = filesort
+                    e.suggestions = suggestions
+        except Exception, e:
+            logging.warning('[EXPLAIN] failed: %s, %s' % (fp, e))
+        finally:
+            with self._lock:
+                self._pending.discard(fp)
+
+    def _analyze(self, rows):
+        '''
+        返回 (执行计划的每一行, 全表扫描的表, 是否有 filesort)
+        '''
+        plan = []
+        scans = []
+        filesort = False
+        if self.mysql:
+            for r in rows:
+                extra = r.get('Extra') or ''
+                plan.append('%s: type=%s key=%s rows=%s %s' % (r.get('table'), r.get('type'), r.get('key'), r.get('rows'), extra))
+                if r.get('type') == 'ALL' and r.get('table'):
+                    scans.append(r['table'])
+                if 'filesort' in extra:
+                    filesort = True
+        else:
+            for r in rows:
+                detail = r['detail']
+                plan.append(detail)
+                m = _RE_SQLITE_SCAN.match(detail)
+                if m:
+                    scans.append(m.group(1))
+                if 'TEMP B-TREE FOR ORDER BY' in detail:
+                    filesort = True
+        return plan, scans, filesort
+
+    def report(self, top=10, reset=False):
+        with self._lock:
+            entries = sorted(self._entries.itervalues(), key=lambda e: e.total, reverse=True)
+            if reset:
+                self._entries = {}
+                self._last = {}
+        return entries[:top]
+
+
+# 全局的慢查询分析  None 表示没有启用
+_advisor = None
+
+def enable_explain(threshold=None, interval=300, max_pending=2):
+    '''
+    启用慢查询自动 EXPLAIN  threshold 秒(默认和慢查询日志的阈值一样)
+    EXPLAIN 通过 submit 在工作线程中执行 不影响发出查询的线程
+    '''
+    global _advisor
+    if threshold is None:
+        threshold = _metrics.slow_query if _metrics.slow_query is not None else 0.1
+    _advisor = _Advisor(threshold, interval, max_pending)
+
+def disable_explain():
+    global _advisor
+    _advisor = None
+
+def explain(sql, *args):
+    '''
+    立即 EXPLAIN 一条查询(不需要 enable_explain)  返回的 Dict 和 explain_report 中的一项一样
+    只是没有 count/total/max  命令行工具 explain.py 用它分析慢查询日志中的语句
+    '''
+    advisor = _advisor or _Advisor(None)
+    plan, scans, filesort, suggestions = advisor.plan(sql, args)
+    return Dict(sql=_metrics.fingerprint(sql), plan=plan, full_scans=scans, filesort=filesort,
+                suggestions=suggestions)
+
+def explain_report(top=10, reset=False):
+    '''
+    返回慢查询总耗时最多的 top 个指纹  每一项是 Dict:
+        sql: 指纹  count/total/max: 超过阈值的次数和耗时
+        explained: EXPLAIN 的次数  plan: 最近一次的执行计划
+        full_scans: 全表扫描的表  filesort: 是否需要额外排序
+        suggestions: [Dict(table, columns, text)]  比如 text='add index on comments(blog_id)'
+    没有启用时返回 []
+    '''
+    if _advisor is None:
+        return []
+    return _advisor.report(top, reset)
+
+
+def _select_raw(sql, first, *args):
+    'execute select SQL and return column names with raw tuple row(s)'
     global _db_ctx
     cursor = None
-
-    sql = sql.replace('?', '%s')
-    logging.info('SQL:%s,ARGS:%s' % (sql, args))
+    if _db_ctx.autoflush is not None:
+        _db_ctx.autoflush()
+
+    # 事务中的查询不使用缓存: 要读到事务自己的修改 加锁的读(for update)也必须真正执行
+    cache = _cache if not _db_ctx.transactions else None
+    if cache is not None:
+        key, tables = cache.lookup(sql, first, args)
+        if tables:
+            hit, value = cache.get(key, tables)
+            if hit:
+                return value
+            versions = cache.versions(tables)
+    stmt = sql
+    sql = engine.sql(sql)
+    logging.info('SQL:%s,ARGS:%s', sql, args)
+    start = None
+    rows = 0
+    error = True
     try:
-        cursor = _db_ctx.connection.cursor()
+        cursor = _db_ctx.read_cursor()
+        start = time.time()
         cursor.execute(sql, args)
+        names = ()
         if cursor.description:
-            names = [x[0] for x in cursor.description]  # 返回结果集的描述 x[0] 是描述结果集的列名
+            names = tuple([x[0] for x in cursor.description])  # 返回结果集的描述 x[0] 是描述结果集的列名
 
         if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-
-        return [Dict(names, x) for x in cursor.fetchall()]
+            value = names, cursor.fetchone()
+            rows = 1 if value[1] else 0
+        else:
+            value = names, cursor.fetchall()
+            rows = len(value[1])
+        error = False
+        if cache is not None and tables:
+            cache.put(key, tables, versions, value)
+        return value
     finally:
+        if start is not None:
+            elapsed = time.time() - start
+            if _metrics.enabled:
+                _metrics.record(stmt, elapsed, rows, error)
+            if _advisor is not None and not error and elapsed > _advisor.threshold:
+                _advisor.observe(stmt, args, elapsed)
         if cursor:
             cursor.close()
 
+def _select(sql, first, *args):
+    'execute select SQL and return unique result or list results'
+    names, values = _select_raw(sql, first, *args)
+    if first:
+        if not values:
+            return None
+        return next(_make_rows(names, (values, )))
+    return list(_make_rows(names, values))
+
+@with_connection
+def select_rows(sql, *args):
+    '''
+    返回 (列名tuple, 每行一个tuple的list)  不构造 Row 对象  orm 用它直接生成 Model 实例
+    '''
+    return _select_raw(sql, False, *args)
+
+@with_connection
+def select_row(sql, *args):
+    '''
+    返回 (列名tuple, 第一行的tuple)  没有结果时是 (列名tuple, None)  orm 的 find_first 用它
+    '''
+    return _select_raw(sql, True, *args)
+
 @with_connection
 def select_one(sql, *args):
     return _select(sql, True, *args)
@@ -377,22 +1492,295 @@ def select_int(sql, *args):
 def select(sql, *args):
     return _select(sql, False, *args)
 
+def iter_select(sql, *args, **kw):
+    '''
+    逐批读取查询结果的生成器  用不缓冲的游标每次 fetchmany(batch) 行
+    大表扫描时内存占用不会随结果集增长:
+
+    for row in db.iter_select('select * from blogs where user_id=?', uid, batch=500):
+        pass
+
+    在事务中使用事务的连接  当前上下文(with db.connection())已经借出连接时也使用它
+    否则单独从连接池借一个连接 迭代结束(或生成器被关闭)时归还
+    迭代过程中同一个连接不能再执行其他语句
+    '''
+    template = None
+    for names, values in iter_select_rows(sql, *args, **kw):
+        if template is None:
+            template = dict.fromkeys(names)
+        row = Row(template)
+        dict.update(row, itertools.izip(names, values))
+        yield row
+
+def iter_select_rows(sql, *args, **kw):
+    '''
+    和 iter_select 一样  但是每行生成 (列名tuple, 值tuple)  不构造 Row  orm 用它逐行生成 Model 实例
+    '''
+    global _db_ctx
+    batch = kw.pop('batch', 1000)
+    if kw:
+        raise TypeError('Unexpected arguments: %s' % ','.join(kw.keys()))
+    if _db_ctx.autoflush is not None:
+        _db_ctx.autoflush()
+    stmt = sql
+    sql = engine.sql(sql)
+    logging.info('SQL:%s,ARGS:%s', sql, args)
+    owner = conn = cursor = None
+    discard = False
+    # 只统计花在数据库上的时间 不包括调用者处理每一行的时间
+    elapsed = None
+    count = 0
+    error = True
+    try:
+        held = _db_ctx.connection if _db_ctx.is_init() else None
+        if held is not None and (_db_ctx.transactions or held.connection or held.replica_connection):
+            # 事务中 或者 with db.connection() 已经借出了连接: 直接使用  再借一个连接在连接池满时会等自己归还
+            if held.replica_connection and _db_ctx.read_only():
+                cursor = held.replica_connection.cursor(**held.replica_engine.stream_kw)
+            else:
+                cursor = held.cursor(**engine.stream_kw)
+        else:
+            owner = engine
+            if not _db_ctx.is_init() or _db_ctx.read_only():
+                owner = engine.replica()
+            conn = owner.connect()
+            cursor = conn.cursor(**owner.stream_kw)
+        start = time.time()
+        elapsed = 0.0
+        cursor.execute(sql, args)
+        names = tuple([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(batch)
+            elapsed += time.time() - start
+            if not rows:
+                break
+            count += len(rows)
+            for x in rows:
+                yield names, x
+            start = time.time()
+        error = False
+    except GeneratorExit:
+        # 提前关闭生成器不算出错
+        error = False
+        raise
+    finally:
+        if elapsed is not None and _metrics.enabled:
+            _metrics.record(stmt, elapsed, count, error)
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                # 提前结束迭代时 还没读完的结果可能让游标无法关闭 这个连接就不再复用
+                logging.warning('close streaming cursor failed.')
+                discard = True
+        if conn:
+            owner.release(conn, discard)
+
+
+'''
+	@method _committer 事务外写操作的合并提交
+'''
+# 默认关闭  enable_group_commit() 以后事务外的 update/insert/delete 不在调用者的连接上执行和提交
+# 而是交给提交线程  并发的写操作凑成一批在一个事务里执行 只提交(刷盘)一次
+
+class _GroupCommitter(object):
+    '''
+    提交线程每次取一批: 最多 max_batch 条  第一条到达以后最多再等 max_delay 秒
+    依次执行后提交一次  每个调用者等到自己那一批提交以后拿到自己的 rowcount 或者异常
+    某一条出错时回滚这一批 这一条得到异常 其余的重新执行  不会因为别人的错误丢掉自己的写入
+    提交线程用自己单独打开的连接 不从连接池借  否则调用者占满连接池时提交线程借不到连接 大家一起等到超时
+    '''
+    def __init__(self, max_batch=64, max_delay=0.002):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._conn = None
+        self._conn_engine = None
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._reset_counters()
+        self._thread = threading.Thread(target=self._run, name='db-group-commit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _reset_counters(self):
+        self.commits = 0
+        self.statements = 0
+        self.errors = 0
+        self.retries = 0
+        self.max_size = 0
+
+    def submit(self, stmt, sql, args):
+        f = _Future()
+        self._queue.put((stmt, sql, args, f))
+        return f
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._disconnect()
+
+    def _connect(self):
+        # engine 被替换以后重新打开连接
+        if self._conn is not None and self._conn_engine is not engine:
+            self._disconnect()
+        if self._conn is None:
+            self._conn = engine._connect()
+            self._conn_engine = engine
+            logging.info('open group commit connection <%s>...' % hex(id(self._conn)))
+        return self._conn
+
+    def _disconnect(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                logging.warning('close group commit connection <%s> failed.' % hex(id(conn)))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is None:
+                    self._flush(batch)
+                    return
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        results = {}
+        pending = range(len(batch))
+        retries = 0
+        try:
+            conn = self._connect()
+            while pending:
+                done = []
+                failed = None
+                for i in pending:
+                    stmt, sql, args, f = batch[i]
+                    cursor = conn.cursor()
+                    start = time.time()
+                    try:
+                        cursor.execute(sql, args)
+                        done.append((i, cursor.rowcount, time.time() - start))
+                    except Exception:
+                        failed = i
+                        results[i] = (None, sys.exc_info())
+                        if _metrics.enabled:
+                            _metrics.record(stmt, time.time() - start, 0, True)
+                        break
+                    finally:
+                        cursor.close()
+                if failed is None:
+                    conn.commit()
+                    for i, r, elapsed in done:
+                        results[i] = (r, None)
+                        if _metrics.enabled:
+                            _metrics.record(batch[i][0], elapsed, r, False)
+                    break
+                conn.rollback()
+                retries += 1
+                pending = [i for i in pending if i != failed]
+        except Exception:
+            # 连接或者提交失败 这一批还没有结果的都得到这个异常  下一批重新打开连接
+            exc_info = sys.exc_info()
+            for i in range(len(batch)):
+                results.setdefault(i, (None, exc_info))
+            self._disconnect()
+        if _cache is not None:
+            for i, item in enumerate(batch):
+                if results[i][1] is None:
+                    _cache.invalidate(_written_tables(item[1]))
+        with self._lock:
+            self.commits += 1
+            self.statements += len(batch)
+            self.errors += len([1 for r, e in results.itervalues() if e is not None])
+            self.retries += retries
+            self.max_size = max(self.max_size, len(batch))
+        for i, item in enumerate(batch):
+            item[3]._set(*results[i])
+
+    def stats(self, reset=False):
+        with self._lock:
+            d = Dict(commits=self.commits, statements=self.statements, errors=self.errors,
+                     retries=self.retries, max_size=self.max_size, queued=self._queue.qsize(),
+                     avg_size=float(self.statements) / self.commits if self.commits else 0.0)
+            if reset:
+                self._reset_counters()
+        return d
+
+
+# 全局的合并提交线程  None 表示没有启用
+_committer = None
+
+def enable_group_commit(max_batch=64, max_delay=0.002):
+    '''
+    启用合并提交  重复调用会先关闭之前的提交线程(等它处理完已经排队的写操作)
+    事务中的写操作不受影响 仍然在事务的连接上执行 由事务提交
+    当前线程已经借出了主库的连接(比如 with db.connection() 中先执行过查询)时也直接在这个连接上执行:
+    这样不会和提交线程抢连接  之后的查询也能在同一个连接上读到自己的写入
+    提交线程另外打开一个连接 不占用连接池
+    '''
+    global _committer
+    disable_group_commit()
+    _committer = _GroupCommitter(max_batch, max_delay)
+
+def disable_group_commit():
+    global _committer
+    committer, _committer = _committer, None
+    if committer is not None:
+        committer.close()
+
+def group_commit_stats(reset=False):
+    '''
+    返回提交次数 执行的语句数 出错数 因为出错重新执行的次数 最大/平均每批语句数  没有启用时返回 None
+    '''
+    if _committer is not None:
+        return _committer.stats(reset)
+
+
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    stmt = sql
+    sql = engine.sql(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    _db_ctx.wrote = True
+    committer = _committer
+    if committer is not None and _db_ctx.transactions == 0 and _db_ctx.connection.connection is None:
+        return committer.submit(stmt, sql, args).result()
+    start = None
+    r = 0
+    error = True
     try:
         cursor = _db_ctx.connection.cursor()
+        start = time.time()
         cursor.execute(sql, args)
         r = cursor.rowcount #?????????
         if _db_ctx.transactions == 0:
             # no transaction enviroment:
             logging.info('auto commit')
             _db_ctx.connection.commit()
+            if _cache is not None:
+                _cache.invalidate(_written_tables(sql))
+        elif _cache is not None:
+            tables = _written_tables(sql)
+            _db_ctx.written.update(tables if tables is not None else (_ALL_TABLES,))
+        error = False
         return r
     finally:
+        if start is not None and _metrics.enabled:
+            _metrics.record(stmt, time.time() - start, r, error)
         if cursor:
             cursor.close()
 
@@ -402,9 +1790,302 @@ def insert(table, **kw):
     table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+def _chunk_args(chunk, cols, ordered):
+    '''
+    把一块 rows 按 cols 的顺序展开成参数列表  ordered 为 True 时 row 已经是按 cols 排好的值
+    '''
+    args = []
+    for row in chunk:
+        if len(row) != len(cols):
+            raise DBError('Expect columns %s but got %s.' % (cols, row))
+        if ordered:
+            args.extend(row)
+            continue
+        try:
+            args.extend([row[col] for col in cols])
+        except KeyError:
+            raise DBError('Expect columns %s but got %s.' % (cols, row.keys()))
+    return args
+
+def insert_many(table, rows, chunk_size=500, columns=None):
+    '''
+    批量插入 rows 是列名相同的 dict 列表  每 chunk_size 行拼成一条
+    insert into ... values (...),(...) 语句  所有的块在同一个事务里提交
+    给出 columns 时 rows 是按 columns 顺序排列的值的 tuple/list
+    返回插入的总行数
+    '''
+    rows = list(rows)
+    if not rows:
+        return 0
+    cols = list(columns) if columns is not None else rows[0].keys()
+    head = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+    mark = '(%s)' % ','.join(['?' for col in cols])
+    n = 0
+    with transaction():
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            n += _update(head + ','.join([mark] * len(chunk)), *_chunk_args(chunk, cols, columns is not None))
+    return n
+
+def upsert(table, rows, conflict_keys, update_cols=None, chunk_size=500, columns=None):
+    '''
+    批量插入 和已有的行冲突(主键或者唯一索引)时改为更新  rows/columns 和 insert_many 一样
+    conflict_keys: 判断冲突的列(主键或者唯一索引的列)  sqlite 的 on conflict 需要  MySQL 按表上的唯一索引判断
+    update_cols: 冲突时更新的列 默认是 conflict_keys 以外的所有列  为空时冲突的行保持不变
+        也可以是 列名 ==> sql表达式 的 dict 比如 dict(version='`version`+1')
+    MySQL: insert ... on duplicate key update `a`=values(`a`)
+    sqlite: insert ... on conflict(`k`) do update set `a`=excluded.`a`
+    所有的块在同一个事务里提交  返回驱动报告的影响行数(MySQL 更新的行算 2)
+    '''
+    rows = list(rows)
+    if not rows:
+        return 0
+    if isinstance(conflict_keys, basestring):
+        conflict_keys = (conflict_keys, )
+    cols = list(columns) if columns is not None else rows[0].keys()
+    if update_cols is None:
+        update_cols = [col for col in cols if col not in conflict_keys]
+    if isinstance(update_cols, dict):
+        exprs = update_cols.items()
+    else:
+        exprs = [(col, None) for col in update_cols]
+    mysql = engine.dialect == 'mysql'
+    sets = []
+    for col, expr in exprs:
+        if expr is None:
+            expr = 'values(`%s`)' % col if mysql else 'excluded.`%s`' % col
+        sets.append('`%s`=%s' % (col, expr))
+    if mysql:
+        if not sets:
+            # 没有要更新的列时把第一个冲突列设为自己 相当于忽略冲突
+            sets = ['`%s`=`%s`' % (conflict_keys[0], conflict_keys[0])]
+        tail = ' on duplicate key update ' + ','.join(sets)
+    else:
+        tail = ' on conflict(%s) do %s' % (','.join(['`%s`' % k for k in conflict_keys]),
+                                           'update set ' + ','.join(sets) if sets else 'nothing')
+    head = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+    mark = '(%s)' % ','.join(['?' for col in cols])
+    n = 0
+    with transaction():
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            n += _update(head + ','.join([mark] * len(chunk)) + tail, *_chunk_args(chunk, cols, columns is not None))
+    return n
+
 def update(sql, *args):
     return _update(sql, *args)
 
+# ================================================以下是异步调用=======================================================
+# Python 2 没有 asyncio  这里用有界的工作线程执行阻塞的数据库调用 立即返回一个 future
+# 事件循环里的代码可以用 add_done_callback 拿到结果而不阻塞  同时执行的调用数不超过工作线程数
+# 每个工作线程有自己的 _db_ctx  每次调用结束就把连接还给连接池
+
+class FutureTimeoutError(DBError):
+    pass
+
+
+class _Future(object):
+    '''
+    异步调用的结果  result() 等待并返回结果(或者抛出调用中的异常)
+    '''
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError('Result not ready in %s seconds.' % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError('Result not ready in %s seconds.' % timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, fn):
+        '''
+        完成以后调用 fn(future)  已经完成时立即在当前线程调用
+        '''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('future callback failed.')
+
+
+class _Executor(object):
+    '''
+    最多 max_workers 个工作线程  需要的时候才创建
+    '''
+    def __init__(self, max_workers):
+        if max_workers < 1:
+            raise DBError('Invalid max_workers: %s' % max_workers)
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = threading.Semaphore(0)  # 空闲工作线程的个数
+
+    def submit(self, fn, *args, **kw):
+        f = _Future()
+        with self._lock:
+            self._queue.put((f, fn, args, kw))
+            if not self._idle.acquire(False) and len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._work, name='db-worker-%d' % len(self._threads))
+                t.daemon = True
+                self._threads.append(t)
+                t.start()
+        return f
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            f, fn, args, kw = item
+            try:
+                r = fn(*args, **kw)
+            except BaseException:
+                f._set(exc_info=sys.exc_info())
+            else:
+                f._set(r)
+            finally:
+                del item, f, fn, args, kw
+            self._idle.release()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for t in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+
+# 全局的工作线程池  第一次异步调用时按主库连接池的大小创建
+_executor = None
+_executor_lock = threading.RLock()
+
+def init_executor(max_workers=None):
+    '''
+    设置执行异步调用的工作线程数  默认和主库连接池的 max_size 一样
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = _Executor(max_workers or engine.pool.max_size)
+
+def submit(func, *args, **kw):
+    '''
+    在工作线程中执行 func(*args, **kw)  返回 future:
+
+    f = db.submit(User.get, uid)
+    f.add_done_callback(lambda f: ...)
+    u = f.result()
+    '''
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                init_executor()
+    return _executor.submit(func, *args, **kw)
+
+def aselect(sql, *args):
+    return submit(select, sql, *args)
+
+def aselect_one(sql, *args):
+    return submit(select_one, sql, *args)
+
+def aselect_int(sql, *args):
+    return submit(select_int, sql, *args)
+
+def aupdate(sql, *args):
+    return submit(update, sql, *args)
+
+def atransaction(func, *args, **kw):
+    '''
+    在工作线程的一个事务中执行 func  func 正常返回就提交 抛出异常就回滚
+    '''
+    return submit(with_transaction(func), *args, **kw)
+
+def gather(*calls, **kw):
+    '''
+    并发执行互相独立的查询  每个查询在自己的工作线程中用单独从连接池借的连接执行
+    按参数的顺序返回结果  总耗时接近最慢的一个 而不是所有查询的和:
+
+    blog, comments, user, n = db.gather(
+        Blog.aget(blog_id),
+        Comment.query().where(blog_id=blog_id).order_by('-created_at').aall(),
+        User.aget(user_id),
+        lambda: db.select_int('select count(*) from blogs where user_id=?', user_id))
+
+    calls: submit/aselect/Model.aget 等返回的 future  或者没有参数的函数(由 submit 执行)
+    有一个出错时立即抛出最先出错的异常 不等其他的完成
+    timeout: 最多等待的秒数  超时抛出 FutureTimeoutError
+    注意工作线程不在调用者的事务中 看不到事务里还没提交的修改
+    '''
+    timeout = kw.pop('timeout', None)
+    if kw:
+        raise TypeError('Unexpected arguments: %s' % ','.join(kw.keys()))
+    # 在工作线程中再 gather 时直接执行函数  避免所有工作线程都在等待 线程池里没有线程执行
+    executor = _executor
+    inline = executor is not None and threading.current_thread() in executor._threads
+    futures = []
+    for c in calls:
+        if isinstance(c, _Future):
+            futures.append(c)
+        elif inline:
+            f = _Future()
+            try:
+                f._set(c())
+            except Exception:
+                f._set(exc_info=sys.exc_info())
+            futures.append(f)
+        else:
+            futures.append(submit(c))
+    if not futures:
+        return []
+    lock = threading.Lock()
+    finished = threading.Event()
+    state = dict(remaining=len(futures), failed=None)
+
+    def on_done(f):
+        with lock:
+            state['remaining'] -= 1
+            if f._exc_info and state['failed'] is None:
+                state['failed'] = f
+            if state['remaining'] == 0 or state['failed'] is not None:
+                finished.set()
+
+    for f in futures:
+        f.add_done_callback(on_done)
+    if not finished.wait(timeout):
+        raise FutureTimeoutError('Results not ready in %s seconds.' % timeout)
+    if state['failed'] is not None:
+        state['failed'].result()
+    return [f.result() for f in futures]
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     # Dict()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+命令行分析慢查询: 从慢查询日志(或者每行一条语句的文件)读出查询 逐条 EXPLAIN 输出执行计划和索引建议
+
+    python db/explain.py --sqlite app.db slow.sql
+    python db/explain.py --mysql www-data:www-data@localhost/awesome --models model app.log
+    grep 'slow sql' app.log | python db/explain.py --sqlite app.db
+
+日志中的语句是指纹(常量都换成了 ?)  limit/offset 的 ? 换成 1  其他的 ? 绑定 NULL(MySQL 是空字符串)
+--models 导入定义 Model 的模块  索引建议会对应到 Model 的字段 并标出已经声明但还没有 sync_indexes 的索引
+'''
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import importlib
+
+import db
+import orm
+
+# db 记录的慢查询日志:  [PROFILING] [DB] slow sql 0.123s:select ...
+_RE_SLOW = re.compile(r'slow sql [\d.]+s:\s*(.*)$')
+_RE_LIMIT = re.compile(r'\b(limit|offset)\s+\?(\s*,\s*\?)?', re.I)
+_RE_MYSQL = re.compile(r'^(\w+)(?::(.*))?@([\w.-]+)(?::(\d+))?/(\w+)$')
+
+
+def statements(lines, null=None):
+    '''
+    从日志或者 sql 文件的行中取出查询  去掉重复的  返回 [(sql, args)]
+    '''
+    seen = set()
+    L = []
+    for line in lines:
+        m = _RE_SLOW.search(line)
+        sql = (m.group(1) if m else line).strip().rstrip(';')
+        if not sql.lower().startswith('select') or sql in seen:
+            continue
+        seen.add(sql)
+        sql = _RE_LIMIT.sub(lambda m: '%s 1%s' % (m.group(1), ',1' if m.group(2) else ''), sql)
+        L.append((sql, (null, ) * sql.count('?')))
+    return L
+
+def import_models(names):
+    '''
+    导入定义 Model 的模块(从仓库根目录查找)  应用的模块用 from db.orm import ... 导入
+    db 目录不是 package  这里把 db.db / db.orm 指向已经导入的 db / orm  否则会再导入一份 orm
+    Model 注册到另一份 _models 中 索引建议就对应不到 Model 的字段
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    sys.modules.setdefault('db.db', db)
+    sys.modules.setdefault('db.orm', orm)
+    for name in names:
+        importlib.import_module(name)
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(description='EXPLAIN slow queries and suggest indexes.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--sqlite', metavar='PATH', help='sqlite database file')
+    group.add_argument('--mysql', metavar='USER:PASSWORD@HOST[:PORT]/DATABASE', help='MySQL database')
+    parser.add_argument('--models', metavar='MODULE', action='append', default=[],
+                        help='module defining the Models, to map suggestions to fields')
+    parser.add_argument('files', nargs='*', help='slow query log or sql files (default: stdin)')
+    args = parser.parse_args(argv)
+
+    if args.sqlite:
+        path = args.sqlite
+        db.engine = db._Engine(lambda: sqlite3.connect(path), placeholder='?')
+        null = None
+    else:
+        m = _RE_MYSQL.match(args.mysql)
+        if not m:
+            parser.error('invalid --mysql: %s' % args.mysql)
+        user, password, host, port, database = m.groups()
+        db.create_engine(user, password or '', database, host, int(port or 3306))
+        null = ''
+    import_models(args.models)
+
+    lines = []
+    for f in args.files or ['-']:
+        if f == '-':
+            lines.extend(sys.stdin)
+        else:
+            with open(f) as fp:
+                lines.extend(fp)
+    return orm.explain_statements(statements(lines, null), out)
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,26 @@
 # -*-encoding:utf-8 -*-
 import logging
 
+import atexit
+import collections
+import errno
+import functools
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import threading
 import time
 
 import db
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
-def _gen_sql(table_name, mappings):
+def _gen_sql(table_name, mappings, indexes=()):
     """
-    类 ==> 表时 生成创建表的sql
+    类 ==> 表时 生成创建表的sql  以及声明的索引(见 _index_sql)
     """
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
@@ -25,8 +36,45 @@ def _gen_sql(table_name, mappings):
         sql.append('  `%s` %s,' % (f.name, ddl) if nullable else '  `%s` %s not null,' % (f.name, ddl))
     sql.append('  primary key(`%s`)' % pk)
     sql.append(');')
+    for name, columns, unique in indexes:
+        sql.append(_index_sql(table_name, name, columns, unique) + ';')
     return '\n'.join(sql)
 
+def _index_sql(table_name, name, columns, unique):
+    return 'create %sindex `%s` on `%s` (%s)' % (
+        'unique ' if unique else '', name, table_name, ','.join(['`%s`' % c for c in columns]))
+
+def _gen_indexes(name, table_name, mappings, attrs):
+    """
+    收集 Field(index=True/unique=True) 和类属性 __indexes__/__unique_indexes__ 声明的索引
+    返回 [(索引名, 列名tuple, 是否unique)]  是其他普通索引前缀的普通索引不再单独创建
+    """
+    declared = []
+    for k, f in sorted(mappings.iteritems(), key=lambda kv: kv[1]._order):
+        if f.primary_key:
+            continue
+        if f.unique:
+            declared.append(((k, ), True))
+        elif f.index:
+            declared.append(((k, ), False))
+    for unique, attr in ((False, '__indexes__'), (True, '__unique_indexes__')):
+        for keys in attrs.get(attr, ()):
+            if isinstance(keys, basestring):
+                keys = (keys, )
+            for k in keys:
+                if k not in mappings:
+                    raise TypeError('Index on undefined field %s in class: %s' % (k, name))
+            declared.append((tuple(keys), unique))
+    indexes = []
+    for keys, unique in declared:
+        columns = tuple([mappings[k].name for k in keys])
+        if not unique and [1 for other, u in declared if len(other) > len(keys) and other[:len(keys)] == keys]:
+            continue
+        if [1 for n, c, u in indexes if c == columns and u == unique]:
+            continue
+        indexes.append(('%s_%s_%s' % ('uk' if unique else 'idx', table_name, '_'.join(columns)), columns, unique))
+    return indexes
+
 # 封装的字段类型
 # StringField \ IntegerField \ FloatField \ BoolField \ TextField \ BlobField \ VersionField
 class Field(object):
@@ -70,6 +118,9 @@ class Field(object):
         self.nullable = kw.get('nullable', False)
         self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
+        self.lazy = kw.get('lazy', False)  # 查询时默认不读取 第一次访问时再批量读取
+        self.index = kw.get('index', False)
+        self.unique = kw.get('unique', False)
         self.ddl = kw.get('ddl', '')
         self._order = Field._count
         Field._count += 1
@@ -161,13 +212,493 @@ class BlobField(Field):
 
 class VersionField(Field):
     """
-    保存Version类型字段的属性
+    保存Version类型字段的属性  用于乐观锁:
+        每次 update 执行 set `version`=`version`+1 ... where `id`=? and `version`=?
+        没有匹配的行(被别人改过或者删除了)时抛出 ConflictError  见 retry_on_conflict
+    一个Model最多一个 VersionField  它的值由 orm 维护 不要自己修改
     """
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
+class CountField(Field):
+    """
+    由 orm 维护的计数字段  保存另一个Model中外键指向这一行的行数:
+        comment_count = CountField('Comment', 'blog_id')
+    Comment 的 insert/delete(包括批量和 unit of work)在同一个事务中执行 update `blogs` set `comment_count`=`comment_count`+1 ...
+    读计数只是读一个字段 不用 count(*) 扫描  计数不对时用 Blog.rebuild_counters() 重新统计
+    to 可以是Model子类或者类名  key 必须是 to 中 updatable=False 的外键字段  计数字段不能 update
+    给已有的表增加 CountField 时先执行 sync_counters() 加上这一列并统计
+    """
+    def __init__(self, to, key, **kw):
+        kw.setdefault('default', 0)
+        kw.setdefault('ddl', 'bigint')
+        kw['updatable'] = False
+        super(CountField, self).__init__(**kw)
+        self.to = to if isinstance(to, basestring) else to.__name__
+        self.key = key
+
+class ForeignKeyField(Field):
+    """
+    保存另一个Model主键的字段 ModelMetaclass 会根据它建立两个方向的关联:
+        blog_id = ForeignKeyField('Blog', related_name='comments')
+        comment.blog     ==> 对应的Blog实例  关联名默认是字段名去掉 _id  也可以用 relation= 指定
+        blog.comments    ==> 所有 blog_id 等于 blog.id 的 Comment  related_name 为空时没有这个方向
+    to 可以是Model子类或者类名(还没定义的类)  外键默认建索引 不需要时传 index=False
+    """
+    def __init__(self, to, related_name=None, relation=None, **kw):
+        kw.setdefault('index', True)
+        if not isinstance(to, basestring):
+            pk = to.__primary_key__
+            kw.setdefault('ddl', pk.ddl)
+            if not callable(pk._default):
+                kw.setdefault('default', pk._default)
+            to = to.__name__
+        if 'default' not in kw:
+            kw['default'] = ''
+        if 'ddl' not in kw:
+            kw['ddl'] = 'varchar(50)'
+        super(ForeignKeyField, self).__init__(**kw)
+        self.to = to
+        self.related_name = related_name
+        self.relation = relation
+
+
+################################################################
+# 类名 ==> Model子类  用于按名字查找 ForeignKeyField 指向的类
+_models = {}
+
+# (类名, related_name) ==> (定义外键的类名, 外键字段)  即一对多的反向关联
+_reverse_relations = {}
+
+# 类名 ==> [(计数字段所在的类名, 计数字段, 外键字段)]  即这个类的 insert/delete 要维护的计数
+_counters = {}
+
+def _model(name):
+    try:
+        return _models[name]
+    except KeyError:
+        raise TypeError('Model not defined: %s' % name)
+
+class ConflictError(db.DBError):
+    """
+    有 VersionField 的实例 update 时数据库中的行已经被别人修改(或删除)
+    """
+    pass
+
+def retry_on_conflict(func=None, retries=3):
+    """
+    出现 ConflictError 时重新调用 func  最多再试 retries 次 每次之前随机等待一小段时间
+    func 要自己重新读取实例 在新的版本上修改:
+
+    @retry_on_conflict
+    def rename(blog_id, name):
+        b = Blog.get(blog_id)
+        b.name = name
+        b.update()
+
+    也可以 @retry_on_conflict(retries=5)
+    需要事务时在 func 里面开始事务  每次重试都是一个新的事务
+    不能在事务中调用: 事务中重新读到的还是同一个快照(和 identity map 中的同一个实例) 重试不会成功
+    """
+    if func is None:
+        return lambda f: retry_on_conflict(f, retries)
+
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        if db.in_transaction():
+            raise db.DBError('Cannot retry %s on conflict inside a transaction.' % func.__name__)
+        for i in xrange(retries + 1):
+            try:
+                return func(*args, **kw)
+            except ConflictError:
+                if i == retries:
+                    raise
+                logging.info('[CONFLICT] retry %s (%d)' % (func.__name__, i + 1))
+                time.sleep(random.uniform(0, 0.005 * (i + 1)))
+    return _wrapper
 
 ################################################################
+# 主键对象缓存  默认关闭  Model.enable_object_cache() 或者类属性 __cache__ = dict(ttl=...) 启用
+# get/get_many 先查缓存  insert/update/delete 以后更新缓存(写穿)  事务中的写操作在事务结束以后让缓存失效
+# enable_invalidation() 以后 写操作还会通知同一台机器上的其他进程丢掉这个主键的缓存
+
+class _ObjectCache(object):
+    '''
+    主键 ==> (过期时间, 行)  行是查询结果的 (列名, 值) 每次 get 用它构造新的实例 调用者修改实例不影响缓存
+    行为 None 表示数据库中没有这个主键(负缓存)  保存 negative_ttl 秒  negative_ttl 为 0 时不缓存
+    generation 在每次失效时加一  查询之前取得的 generation 已经变化的话 查询结果不放入缓存
+    '''
+    def __init__(self, max_size=10000, ttl=60, negative_ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, pk):
+        '''
+        返回 (是否命中, 行)
+        '''
+        with self._lock:
+            entry = self._entries.get(pk)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            if entry[0] < time.time():
+                del self._entries[pk]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            # 移到末尾 表示最近使用过
+            del self._entries[pk]
+            self._entries[pk] = entry
+            if entry[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[1]
+
+    def put(self, pk, row, generation=None):
+        ttl = self.ttl if row is not None else self.negative_ttl
+        if not ttl:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(pk, None)
+            self._entries[pk] = (time.time() + ttl, row)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def written(self, pk, row):
+        '''
+        写操作提交以后  让正在进行的查询结果作废 再放入写入的行(不完整时只让缓存失效)
+        '''
+        self.invalidate(pk)
+        if row is not None:
+            self.put(pk, row)
+
+    def invalidate(self, pk):
+        with self._lock:
+            self.generation += 1
+            if self._entries.pop(pk, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self, reset=False):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            d = db.Dict(size=len(self._entries), hits=self.hits, negative_hits=self.negative_hits,
+                     misses=self.misses, evictions=self.evictions, expirations=self.expirations,
+                     invalidations=self.invalidations,
+                     hit_ratio=float(self.hits + self.negative_hits) / lookups if lookups else 0.0)
+            if reset:
+                self._reset_counters()
+        return d
+
+
+class _Invalidator(object):
+    '''
+    同一台机器上的进程在 path 目录下各自绑定一个 unix datagram socket(文件名是进程号)
+    写操作以后给目录下其他的 socket 发送 [类名, 主键]  收到的进程丢掉这个主键的缓存
+    消息可能丢失(对方缓冲区满) 这时由缓存的 ttl 保证最终一致
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        self.name = os.path.join(path, '%d.sock' % self.pid)
+        if os.path.exists(self.name):
+            os.unlink(self.name)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.name)
+        self._out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._out.setblocking(False)
+        self._peers = []
+        self._scanned = 0
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._listen, name='orm-invalidator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            try:
+                name, pk = json.loads(data)
+            except ValueError:
+                continue
+            self.received += 1
+            model = _models.get(name)
+            if model is not None and model.__object_cache__ is not None:
+                # 主键是 None 表示按条件更新了多行  清空这个类的缓存
+                if pk is None:
+                    model.__object_cache__.clear()
+                else:
+                    model.__object_cache__.invalidate(pk)
+
+    def peers(self):
+        # 每秒重新扫描一次目录  发现新启动的进程
+        now = time.time()
+        if now - self._scanned > 1.0:
+            self._peers = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                           if f.endswith('.sock') and f != os.path.basename(self.name)]
+            self._scanned = now
+        return self._peers
+
+    def send(self, name, pk):
+        msg = json.dumps([name, pk])
+        for peer in self.peers():
+            try:
+                self._out.sendto(msg, peer)
+                self.sent += 1
+            except socket.error, e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # 进程已经退出
+                    try:
+                        os.unlink(peer)
+                    except OSError:
+                        pass
+                    self._scanned = 0
+                else:
+                    self.dropped += 1
+
+    def close(self):
+        # fork 出的子进程关闭继承来的 socket 时 不能删除父进程的 socket 文件
+        if self.pid == os.getpid():
+            try:
+                os.unlink(self.name)
+            except OSError:
+                pass
+        self._sock.close()
+        self._out.close()
+
+
+_invalidator = None
+
+def enable_invalidation(path='/tmp/orm-object-cache'):
+    '''
+    启用进程间的缓存失效通知  使用同一个 path 的进程互相通知
+    多进程的服务器要在每个工作进程(fork 以后)中调用
+    '''
+    global _invalidator
+    disable_invalidation()
+    _invalidator = _Invalidator(path)
+    # 正常退出时删除自己的 socket 文件  异常退出留下的文件由其他进程发送失败时删除
+    atexit.register(_invalidator.close)
+
+def disable_invalidation():
+    global _invalidator
+    invalidator, _invalidator = _invalidator, None
+    if invalidator is not None:
+        invalidator.close()
+
+def _broadcast(name, pk):
+    invalidator = _invalidator
+    if invalidator is not None and invalidator.pid == os.getpid():
+        invalidator.send(name, pk)
+
+def object_cache_stats(reset=False):
+    '''
+    返回 类名 ==> 缓存统计 的 Dict  包括 hits/negative_hits/misses/hit_ratio/size 等  只包括启用了缓存的Model
+    '''
+    d = db.Dict()
+    for name, model in _models.iteritems():
+        if model.__object_cache__ is not None:
+            d[name] = model.__object_cache__.stats(reset)
+    return d
+
+
+################################################################
+# 事务内的 identity map 和 unit of work  都保存在 db.transaction_state() 中 事务结束(提交或回滚)时丢弃
+# identity map: 事务中 get/find_*/query 读出的同一个主键总是同一个实例  get 命中时不查询数据库
+# unit of work: with unit_of_work() 中的 insert/update/delete 先记下来 提交之前按外键依赖的顺序批量写入
+#               事务中执行查询之前会先写入(autoflush) 保证查询能读到这些修改
+
+def _identity_map():
+    state = db.transaction_state()
+    if state is None:
+        return None
+    identity = state.get('identity')
+    if identity is None:
+        identity = state['identity'] = {}
+    return identity
+
+def _restore(saved, committed):
+    '''
+    事务回滚以后 把实例的快照和版本恢复成事务开始前的值  见 _ModelBase._remember
+    '''
+    if committed:
+        return
+    for m, loaded, version in saved.itervalues():
+        object.__setattr__(m, '_loaded', loaded)
+        if version is not None:
+            m[m.__version__] = version
+
+def _current_unit_of_work():
+    '''
+    当前事务的 unit of work  正在写入时返回 None 让写操作直接执行
+    '''
+    state = db.transaction_state()
+    if state is None:
+        return None
+    uow = state.get('uow')
+    if uow is None or uow.flushing:
+        return None
+    return uow
+
+def _dependency_order(models):
+    '''
+    按外键排序: 被引用的Model在前  有循环依赖时剩下的按原来的顺序
+    '''
+    models = list(models)
+    names = set([m.__name__ for m in models])
+    done = []
+    done_names = set()
+    while len(done) < len(models):
+        ready = [m for m in models if m.__name__ not in done_names and
+                 not [1 for fk, to in m.__relations__.itervalues()
+                      if to in names and to not in done_names and to != m.__name__]]
+        if not ready:
+            ready = [m for m in models if m.__name__ not in done_names]
+        for m in ready:
+            done.append(m)
+            done_names.add(m.__name__)
+    return done
+
+
+class _UnitOfWork(object):
+    '''
+    待写入的 insert/update/delete  同一个实例只记一次:
+        insert 以后再 update  只需要 insert 最新的值
+        insert 以后再 delete  都不执行
+        update 以后再 delete  只执行 delete
+    '''
+    def __init__(self):
+        self.flushing = False
+        self.inserts = collections.OrderedDict()
+        self.updates = collections.OrderedDict()
+        self.deletes = collections.OrderedDict()
+        self.flushes = 0
+
+    def insert(self, m):
+        pk = m.__primary_key__
+        if pk.name not in m:
+            m[pk.name] = pk.default
+        self.inserts[id(m)] = m
+        identity = _identity_map()
+        identity[(m.__class__, m[pk.name])] = m
+
+    def update(self, m):
+        if id(m) not in self.inserts and id(m) not in self.deletes:
+            self.updates[id(m)] = m
+
+    def delete(self, m):
+        identity = _identity_map()
+        identity.pop((m.__class__, m._value(m.__primary_key__.name)), None)
+        if self.inserts.pop(id(m), None) is not None:
+            return
+        self.updates.pop(id(m), None)
+        self.deletes[id(m)] = m
+
+    def deleted(self, cls, pk):
+        for m in self.deletes.itervalues():
+            if m.__class__ is cls and m._value(cls.__primary_key__.name) == pk:
+                return True
+        return False
+
+    def flush(self):
+        if self.flushing or not (self.inserts or self.updates or self.deletes):
+            return
+        self.flushing = True
+        try:
+            inserts, self.inserts = self._group(self.inserts), collections.OrderedDict()
+            updates, self.updates = self._group(self.updates), collections.OrderedDict()
+            deletes, self.deletes = self._group(self.deletes), collections.OrderedDict()
+            order = _dependency_order(set(inserts.keys() + updates.keys() + deletes.keys()))
+            for model in order:
+                if model in inserts:
+                    model.insert_all(inserts[model])
+            for model in order:
+                if model in updates:
+                    model._update_all(updates[model])
+            for model in reversed(order):
+                if model in deletes:
+                    model._delete_all(deletes[model])
+            self.flushes += 1
+        finally:
+            self.flushing = False
+
+    def _group(self, instances):
+        groups = collections.OrderedDict()
+        for m in instances.itervalues():
+            groups.setdefault(m.__class__, []).append(m)
+        return groups
+
+
+class _UnitOfWorkCtx(object):
+    def __enter__(self):
+        self._tx = db.transaction()
+        self._tx.__enter__()
+        state = db.transaction_state()
+        uow = state.get('uow')
+        if uow is None:
+            uow = state['uow'] = _UnitOfWork()
+            db.before_commit(uow.flush)
+            db.set_autoflush(uow.flush)
+        return uow
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self._tx.__exit__(exc_type, exc_val, exc_tb)
+
+def unit_of_work():
+    '''
+    开始(或者加入)一个事务  其中 Model 的 insert/update/delete 在提交之前才批量写入数据库:
+
+    with orm.unit_of_work():
+        u = User.get(uid)        # 同一个事务中再 get 返回同一个实例 不查询
+        u.name = name
+        u.update()
+        Blog(user_id=uid, ...).insert()
+    # 退出时: 先 insert 再 update(被引用的表在前) 最后 delete(反过来) 然后提交  出错时全部回滚
+    '''
+    return _UnitOfWorkCtx()
+
+def flush():
+    '''
+    立即写入当前 unit of work 中待写入的修改
+    '''
+    state = db.transaction_state()
+    if state is not None and state.get('uow') is not None:
+        state['uow'].flush()
+
 class ModelMetaclass(type):
     """
     对类对象完成以下操作
@@ -182,7 +713,7 @@ class ModelMetaclass(type):
         2. 新增“__table__”属性， 保存提取出来的表名
     """
     def __new__(cls, name, bases, attrs):
-        if name == 'Model':
+        if name in ('_ModelBase', 'Model', 'CompactModel'):
             return type.__new__(cls, name, bases, attrs)
 
         # store all subclasses info: ——> 存储所有子类信息
@@ -224,18 +755,1180 @@ class ModelMetaclass(type):
         if not '__table__' in attrs:
             attrs['__table__'] = name.lower()
 
+        # 外键对应的关联 关联名 ==> (外键字段, 指向的类名)
+        relations = {}
+        for k, v in mappings.iteritems():
+            if isinstance(v, ForeignKeyField):
+                rel = v.relation or (k[:-3] if k.endswith('_id') else None)
+                if not rel:
+                    raise TypeError('Cannot name the relation of field %s, use relation=...' % k)
+                if rel in mappings:
+                    raise TypeError('Relation %s conflicts with field in class: %s' % (rel, name))
+                relations[rel] = (k, v.to)
+                if v.related_name:
+                    _reverse_relations[(v.to, v.related_name)] = (name, k)
+            elif isinstance(v, CountField):
+                counters = [c for c in _counters.get(v.to, ()) if c[:2] != (name, k)]
+                _counters[v.to] = counters + [(name, k, v.key)]
+
+        # 默认查询的字段  lazy 的字段不在其中
+        if [v for v in mappings.itervalues() if v.lazy and not v.primary_key]:
+            attrs['__select__'] = ','.join(['`%s`' % f.name for f in sorted(mappings.values(), key=lambda f: f._order)
+                                            if not f.lazy or f.primary_key])
+        else:
+            attrs['__select__'] = '*'
+
+        # 预先拼好常用的SQL 调用时只需要绑定参数
+        table = attrs['__table__']
+        pk = primary_key.name
+        fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)
+        attrs['__fields__'] = tuple([k for k, v in fields])
+        attrs['__insert_fields__'] = tuple([(k, v) for k, v in fields if v.insertable])
+        attrs['__insert_columns__'] = tuple([v.name for k, v in fields if v.insertable])
+        versions = [k for k, v in fields if isinstance(v, VersionField)]
+        if len(versions) > 1:
+            raise TypeError('Cannot define more than 1 VersionField in class: %s' % name)
+        attrs['__version__'] = versions[0] if versions else None
+        attrs['__update_keys__'] = tuple([k for k, v in fields if v.updatable and k not in versions])
+        attrs['__count_fields__'] = tuple([k for k, v in fields if isinstance(v, CountField)])
+        attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (
+            table, ','.join(['`%s`' % c for c in attrs['__insert_columns__']]),
+            ','.join(['?'] * len(attrs['__insert_columns__'])))
+        attrs['__update_sqls__'] = {}  # 只更新部分字段时的SQL 按字段缓存
+        attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?' % (table, pk)
+        attrs['__get_sql__'] = 'select %s from `%s` where `%s`=?' % (attrs['__select__'], table, pk)
+        attrs['__count_sql__'] = 'select count(`%s`) from `%s`' % (pk, table)
+
         # 给cls增加一些字段：
+        attrs['__relations__'] = relations
         attrs['__mappings__'] = mappings
         # attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
         # attrs['__table__'] = __table__
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        indexes = attrs['__index_defs__'] = _gen_indexes(name, attrs['__table__'], mappings, attrs)
+        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings, indexes)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls, name, bases, attrs)
+        # CompactModel 的子类 每个字段一个 slot 实例没有 __dict__
+        if [b for b in bases if getattr(b, '__compact__', False)]:
+            attrs['__slots__'] = attrs['__fields__']
+            attrs['__setters__'] = {}
+        else:
+            # Model 的字段保存在 dict 中  子类也不要每个实例一个 __dict__
+            attrs.setdefault('__slots__', ())
+        attrs['__object_cache__'] = None
+        model = _models[name] = type.__new__(cls, name, bases, attrs)
+        if attrs.get('__cache__') is not None:
+            model.enable_object_cache(**attrs['__cache__'])
+        if '__setters__' in attrs:
+            model.__getters__ = dict([(k, model.__dict__[k].__get__) for k in mappings])
+        return model
+
+class ModelList(list):
+    """
+    find_all/find_by 返回的列表  可以预先批量加载关联的对象:
+        Blog.find_by('order by created_at desc limit ?', 10).prefetch('user', 'comments.user')
+    """
+    def __init__(self, model, iterable=()):
+        super(ModelList, self).__init__(iterable)
+        self.model = model
 
-class Model(dict):
+    def prefetch(self, *paths):
+        self.model.prefetch(self, *paths)
+        return self
+
+class Query(object):
+    """
+    可以链式组合的查询 每次调用返回一个新的Query 原来的不变:
+        q = Blog.query().where(user_id=uid).order_by('-created_at').limit(20)
+        page = q.all()
+    where 的关键字参数: 值是 None 时生成 is null  是 list/tuple 时生成 in (...)  其他生成 =
+    也可以直接写条件 where('created_at > ?', t)
+
+    按游标翻页(keyset pagination)  用上一页最后一个实例的排序字段作为条件 深翻页和第一页的代价一样:
+        next_page = q.after(q.cursor(page[-1])).all()
+    排序字段里没有主键时会自动加上主键 保证顺序是确定的
+
+    相同形状的查询(条件/排序/分页的结构相同 参数不同)只拼一次SQL 缓存在 Query._compiled 中
+    """
+    _compiled = {}
+
+    def __init__(self, model):
+        self.model = model
+        self._where = ()   # ((形状, 参数tuple), ...)
+        self._order = ()   # ((字段, 是否降序), ...)
+        self._limit = None
+        self._offset = None
+        self._after = None
+        self._columns = None  # only/defer 指定的字段 None 表示 Model 默认的字段
+
+    def _clone(self, **kw):
+        q = Query.__new__(Query)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(kw)
+        return q
+
+    def _check(self, key):
+        if key not in self.model.__mappings__:
+            raise AttributeError('%s has no field: %s' % (self.model.__name__, key))
+        return key
+
+    def where(self, clause=None, *args, **kw):
+        L = list(self._where)
+        if clause is not None:
+            L.append((('raw', clause), args))
+        for k in sorted(kw):
+            v = kw[k]
+            self._check(k)
+            if v is None:
+                L.append((('null', k), ()))
+            elif isinstance(v, (list, tuple, set, frozenset)):
+                v = tuple(v)
+                L.append((('in', k, len(v)), v))
+            else:
+                L.append((('eq', k), (v,)))
+        return self._clone(_where=tuple(L))
+
+    def only(self, *keys):
+        """
+        只读取这些字段(总是包括主键和排序字段)  其他字段在第一次访问时批量读取
+        """
+        pk = self.model.__primary_key__.name
+        keys = [self._check(k) for k in keys]
+        return self._clone(_columns=tuple([pk] + [k for k in keys if k != pk]))
+
+    def defer(self, *keys):
+        """
+        不读取这些字段 它们在第一次访问时批量读取
+        """
+        keys = [self._check(k) for k in keys]
+        pk = self.model.__primary_key__.name
+        fields = sorted(self.model.__mappings__.values(), key=lambda f: f._order)
+        return self._clone(_columns=tuple([f.name for f in fields if f.name == pk or (f.name not in keys and not f.lazy)]))
+
+    def order_by(self, *keys):
+        """
+        字段名前面加 - 表示降序
+        """
+        order = []
+        for k in keys:
+            desc = k.startswith('-')
+            order.append((self._check(k[1:] if desc else k), desc))
+        return self._clone(_order=tuple(order))
+
+    def limit(self, n, offset=None):
+        return self._clone(_limit=n, _offset=offset)
+
+    def after(self, cursor):
+        """
+        只返回排在 cursor 之后的行  cursor 由 Query.cursor() 得到
+        """
+        cursor = tuple(cursor)
+        if len(cursor) != len(self._full_order()):
+            raise ValueError('Cursor does not match order: %s' % (cursor,))
+        return self._clone(_after=cursor)
+
+    def cursor(self, instance):
+        """
+        返回实例在当前排序下的位置 用于 after()
+        实例没有读取的排序字段(比如来自另一个 only() 查询)先读出来  不是从数据库读出的实例缺少字段时抛出 ValueError
+        """
+        values = []
+        for k, desc in self._full_order():
+            if k not in instance:
+                if instance._loaded is None:
+                    raise ValueError('Cursor field %s is missing in %r' % (k, instance))
+                instance._load_deferred(k)
+            values.append(instance[k])
+        return tuple(values)
+
+    def _full_order(self):
+        pk = self.model.__primary_key__.name
+        order = self._order
+        if pk not in [k for k, desc in order]:
+            order = order + ((pk, order[-1][1] if order else False),)
+        return order
+
+    def _compile(self, select, count):
+        where = []
+        for shape, args in self._where:
+            kind = shape[0]
+            if kind == 'raw':
+                where.append('(%s)' % shape[1])
+            elif kind == 'null':
+                where.append('`%s` is null' % shape[1])
+            elif kind == 'in':
+                where.append('`%s` in (%s)' % (shape[1], ','.join(['?'] * shape[2])) if shape[2] else '1=0')
+            else:
+                where.append('`%s`=?' % shape[1])
+        order = () if count else self._full_order()
+        refs = []
+        if self._after is not None:
+            # c1 >= ? and ((c1 > ?) or (c1 = ? and c2 > ?) or ...)  各个字段可以有不同的方向
+            # 开头对第一个字段的范围条件让数据库可以直接在索引上定位
+            L = []
+            for i, (k, desc) in enumerate(order):
+                cond = ['`%s`=?' % c for c, d in order[:i]] + ['`%s`%s?' % (k, '<' if desc else '>')]
+                refs.extend(range(i + 1))
+                L.append('(%s)' % ' and '.join(cond))
+            k, desc = order[0]
+            where.append('`%s`%s? and (%s)' % (k, '<=' if desc else '>=', ' or '.join(L)))
+            refs.insert(0, 0)
+        sql = ['select %s from `%s`' % (select, self.model.__table__)]
+        if where:
+            sql.append('where %s' % ' and '.join(where))
+        if order:
+            sql.append('order by %s' % ','.join(['`%s`%s' % (key, ' desc' if d else '') for key, d in order]))
+        if self._limit is not None:
+            sql.append('limit ?')
+            if self._offset is not None:
+                sql.append('offset ?')
+        return ' '.join(sql), tuple(refs)
+
+    def _sql(self, count=False):
+        key = (self.model, self._columns, count, tuple([s for s, a in self._where]), self._order,
+               self._limit is not None, self._offset is not None, self._after is not None)
+        compiled = Query._compiled.get(key)
+        if compiled is None:
+            if len(Query._compiled) > 10000:
+                Query._compiled.clear()
+            if count:
+                select = 'count(*)'
+            elif self._columns is None:
+                select = self.model.__select__
+            else:
+                # 排序字段也要读出来  cursor() 需要它们
+                columns = self._columns + tuple([k for k, d in self._full_order() if k not in self._columns])
+                select = ','.join(['`%s`' % k for k in columns])
+            compiled = Query._compiled[key] = self._compile(select, count)
+        sql, refs = compiled
+        args = [a for s, L in self._where for a in L]
+        args.extend([self._after[i] for i in refs])
+        if self._limit is not None:
+            args.append(self._limit)
+            if self._offset is not None:
+                args.append(self._offset)
+        return sql, args
+
+    def all(self):
+        sql, args = self._sql()
+        names, rows = db.select_rows(sql, *args)
+        return self.model._from_rows(names, rows)
+
+    def first(self):
+        L = self.limit(1, self._offset).all()
+        return L[0] if L else None
+
+    def iter(self, batch=1000):
+        sql, args = self._sql()
+        for names, values in db.iter_select_rows(sql, *args, batch=batch):
+            yield self.model._from_row(names, values)
+
+    def count(self):
+        sql, args = self._clone(_order=(), _limit=None, _offset=None, _after=None)._sql(count=True)
+        return db.select_int(sql, *args)
+
+    def aall(self):
+        """
+        异步的 all/first/count  返回 future  可以交给 db.gather 和其他查询一起执行
+        """
+        return db.submit(self.all)
+
+    def afirst(self):
+        return db.submit(self.first)
+
+    def acount(self):
+        return db.submit(self.count)
+
+    def __iter__(self):
+        return iter(self.all())
+
+class _ModelBase(object):
+    """
+    Model 和 CompactModel 共用的方法  实例只通过 [] / in / iterkeys 等 dict 风格的接口读写字段
+    """
+    __metaclass__ = ModelMetaclass
+    __slots__ = ()
+
+    # 从数据库读出(或者写入)时的 (列名, 值) 快照  和同一次查询得到的实例列表  加载过的关联对象
+    # Model 和 CompactModel 把它们保存在 slot 中  没有赋值时读到的是 None(见 __getattr__)
+    _loaded = None
+    _group = None
+    _related_objects = None
+    _instance_slots = ('_loaded', '_group', '_related_objects')
+
+    @classmethod
+    def _relation(cls, name):
+        """
+        返回 ('one', 指向的类, 本类的外键字段) 或者 ('many', 关联的类, 关联类的外键字段)
+        没有这个关联时返回 None
+        """
+        r = cls.__relations__.get(name)
+        if r is not None:
+            return 'one', _model(r[1]), r[0]
+        r = _reverse_relations.get((cls.__name__, name))
+        if r is not None:
+            return 'many', _model(r[0]), r[1]
+        return None
+
+    @classmethod
+    def prefetch(cls, instances, *paths):
+        """
+        批量加载 instances 的关联对象  每个关联每一层只用一次(分块的) in 查询 然后在内存中拼接
+        路径可以用 . 连接多层 比如 'comments.user'
+        """
+        for path in paths:
+            model = cls
+            level = [m for m in instances if m is not None]
+            for name in path.split('.'):
+                if not level:
+                    break
+                model, level = model._prefetch_level(level, name)
+        return instances
+
+    @classmethod
+    def _prefetch_level(cls, instances, name):
+        rel = cls._relation(name)
+        if rel is None:
+            raise AttributeError('%s has no relation: %s' % (cls.__name__, name))
+        kind, target, fk = rel
+        todo = [m for m in instances if name not in m._related()]
+        if kind == 'one':
+            if todo:
+                keys = [m._value(fk) for m in todo]
+                found = target.get_many([k for k in keys if k is not None])
+                for m, k in zip(todo, keys):
+                    m._related()[name] = found.get(k)
+            related = [m._related()[name] for m in instances if m._related()[name] is not None]
+        else:
+            if todo:
+                pk = cls.__primary_key__.name
+                groups = {}
+                for x in target._find_in(fk, [m[pk] for m in todo]):
+                    groups.setdefault(x[fk], []).append(x)
+                for m in todo:
+                    m._related()[name] = ModelList(target, groups.get(m[pk], ()))
+            related = [x for m in instances for x in m._related()[name]]
+        return target, related
+
+    @classmethod
+    def _find_in(cls, key, values, chunk_size=500, select=None, raw=False):
+        """
+        去掉重复值以后 分块执行 where key in (...) 返回所有实例
+        raw=True 时返回 (列名, 所有行的tuple)
+        """
+        keys = []
+        seen = set()
+        for v in values:
+            if v not in seen:
+                seen.add(v)
+                keys.append(v)
+        names = None
+        rows = []
+        with db.connection():
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                names, L = db.select_rows('select %s from `%s` where `%s` in (%s)' % (
+                    select or cls.__select__, cls.__table__, key, ','.join(['?'] * len(chunk))), *chunk)
+                rows.extend(L)
+        if raw:
+            return names, rows
+        return cls._from_rows(names, rows)
+
+    def _load_deferred(self, key):
+        """
+        读取没有加载的字段  和同一次查询得到的其他实例一起 用主键批量读取
+        """
+        pk = self.__primary_key__.name
+        group = [m for m in self._group or (self,) if key not in m]
+        names, rows = self._find_in(pk, [m[pk] for m in group], select='`%s`,`%s`' % (pk, key), raw=True)
+        values = dict(rows)
+        for m in group:
+            v = values.get(m[pk], self.__mappings__[key].default)
+            m[key] = v
+            if m._loaded is not None:
+                names, loaded = m._loaded
+                # 加入快照 读出来的值不算修改
+                object.__setattr__(m, '_loaded', (tuple(names) + (key,), tuple(loaded) + (v,)))
+
+    def _related(self):
+        """
+        已经加载的关联对象 关联名 ==> 对象(或者 ModelList)
+        """
+        related = self._related_objects
+        if related is None:
+            related = {}
+            object.__setattr__(self, '_related_objects', related)
+        return related
+
+    @classmethod
+    def _from_rows(cls, names, rows):
+        """
+        构造一次查询得到的实例列表  有字段没有读取时 这些实例以后一起读取缺少的字段
+        """
+        L = ModelList(cls, [cls._from_row(names, x) for x in rows])
+        if len(L) > 1 and len(names) < len(cls.__mappings__):
+            for m in L:
+                object.__setattr__(m, '_group', L)
+        return L
+
+    def _remember(self):
+        """
+        事务中修改快照(和版本)之前记下原来的值  事务回滚时恢复 否则实例以为自己和数据库一致
+        """
+        state = db.transaction_state()
+        if state is None:
+            return
+        saved = state.get('saved')
+        if saved is None:
+            saved = state['saved'] = {}
+            db.after_transaction(functools.partial(_restore, saved))
+        if id(self) not in saved:
+            version = self.__version__
+            saved[id(self)] = (self, self._loaded, self._value(version) if version else None)
+
+    def _mark_clean(self):
+        """
+        记下当前的值 之后 update 只写入和它不同的字段  事务回滚时恢复成原来的快照
+        """
+        self._remember()
+        # Model 的 __setattr__ 写的是字段 这里绕过它
+        object.__setattr__(self, '_loaded', (tuple(self.iterkeys()), tuple(self.itervalues())))
+
+    def _changed(self):
+        """
+        返回和从数据库读出(或者写入)时相比 值有变化的可更新字段  没有快照时返回 None
+        """
+        loaded = self._loaded
+        if loaded is None:
+            return None
+        snapshot = dict(itertools.izip(*loaded))
+        L = []
+        for k in self.__update_keys__:
+            if k in self:
+                if k not in snapshot or snapshot[k] != self[k]:
+                    L.append(k)
+        return L
+
+    @classmethod
+    def _update_sql(cls, keys):
+        if keys == cls.__update_keys__:
+            keys = None
+        sql = cls.__update_sqls__.get(keys)
+        if sql is None:
+            sets = ['`%s`=?' % k for k in keys or cls.__update_keys__]
+            where = '`%s`=?' % cls.__primary_key__.name
+            version = cls.__version__
+            if version:
+                sets.append('`%s`=`%s`+1' % (version, version))
+                where = '%s and `%s`=?' % (where, version)
+            sql = cls.__update_sqls__[keys] = 'update `%s` set %s where %s' % (cls.__table__, ','.join(sets), where)
+        return sql
+
+    @classmethod
+    def _existing_indexes(cls):
+        """
+        数据库中这个表已有的索引 返回 [(索引名, 列名tuple, 是否unique)]  不包括主键
+        MySQL 用 show index  sqlite 用 pragma index_list/index_info
+        """
+        if db.engine.dialect == 'mysql':
+            rows = db.select_rows('show index from `%s`' % cls.__table__)[1]
+            found = {}
+            for r in sorted(rows, key=lambda r: (r[2], r[3])):
+                # Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+                if r[2] != 'PRIMARY':
+                    found.setdefault(r[2], [r[2], (), not int(r[1])])[1] += (r[4], )
+            return [tuple(v) for v in found.itervalues()]
+        indexes = []
+        for r in db.select_rows('pragma index_list(`%s`)' % cls.__table__)[1]:
+            # seq, name, unique, origin, partial
+            if len(r) > 3 and r[3] == 'pk':
+                continue
+            info = sorted(db.select_rows('pragma index_info(`%s`)' % r[1])[1])
+            indexes.append((r[1], tuple([x[2] for x in info]), bool(r[2])))
+        return indexes
+
+    @classmethod
+    def sync_indexes(cls):
+        """
+        对比声明的索引和数据库中已有的索引 创建缺少的  返回执行的SQL
+        已经有相同列(同样顺序)的索引时不再创建  unique 索引也可以当作普通索引  不会删除多出来的索引
+        """
+        existing = cls._existing_indexes()
+        executed = []
+        for name, columns, unique in cls.__index_defs__:
+            if [1 for n, c, u in existing if c == columns and (u or not unique)]:
+                continue
+            sql = _index_sql(cls.__table__, name, columns, unique)
+            db.update(sql)
+            executed.append(sql)
+        return executed
+
+    @classmethod
+    def _existing_columns(cls):
+        """
+        数据库中这个表已有的列名  MySQL 用 show columns  sqlite 用 pragma table_info
+        """
+        if db.engine.dialect == 'mysql':
+            return set([r[0] for r in db.select_rows('show columns from `%s`' % cls.__table__)[1]])
+        return set([r[1] for r in db.select_rows('pragma table_info(`%s`)' % cls.__table__)[1]])
+
+    @classmethod
+    def sync_counters(cls):
+        """
+        给已有的表加上缺少的计数字段(见 CountField) 然后统计一次  返回执行的 alter table 语句
+        新增 CountField 以后 部署新代码之前执行  否则 insert 会因为没有这一列失败:
+            Blog.sync_counters()
+        """
+        existing = cls._existing_columns()
+        executed = []
+        for k in cls.__count_fields__:
+            field = cls.__mappings__[k]
+            if field.name in existing:
+                continue
+            sql = 'alter table `%s` add column `%s` %s not null default %d' % (
+                cls.__table__, field.name, field.ddl, field.default)
+            db.update(sql)
+            executed.append(sql)
+            cls.rebuild_counters(k)
+        return executed
+
+    @classmethod
+    def _mapped(cls, m):
+        """
+        事务中读出的实例放入 identity map  这个主键已经有实例时返回已有的实例(可能有还没写入的修改)
+        """
+        identity = _identity_map()
+        if identity is None:
+            return m
+        pk = m._value(cls.__primary_key__.name)
+        if pk is None:
+            return m
+        return identity.setdefault((cls, pk), m)
+
+    @classmethod
+    def enable_object_cache(cls, max_size=10000, ttl=60, negative_ttl=5):
+        """
+        启用主键对象缓存(见 _ObjectCache)  也可以在类中声明 __cache__ = dict(max_size=..., ttl=..., negative_ttl=...)
+        """
+        cls.__object_cache__ = _ObjectCache(max_size, ttl, negative_ttl)
+
+    @classmethod
+    def disable_object_cache(cls):
+        cls.__object_cache__ = None
+
+    def _cache_written(self, inserted=False):
+        """
+        写操作以后更新对象缓存 并通知其他进程  事务中的写操作先让缓存失效 事务结束以后再失效一次
+        只有 insert 写入了整行 可以把实例放入缓存  update 只写入变化的字段 实例中其他字段可能已经过期 只让缓存失效
+        """
+        cache = self.__object_cache__
+        if cache is None and _invalidator is None:
+            return
+        name = self.__class__.__name__
+        pk = self[self.__primary_key__.name]
+        if db.in_transaction():
+            if cache is not None:
+                cache.invalidate(pk)
+
+            def after(committed):
+                if cache is not None:
+                    cache.invalidate(pk)
+                committed and _broadcast(name, pk)
+            db.after_transaction(after)
+            return
+        if cache is not None:
+            row = None
+            # 实例中的计数可能已经过期(计数只在数据库中增减)  有计数字段时只让缓存失效
+            if inserted and not self.__count_fields__ and len(self) == len(self.__mappings__):
+                row = (tuple(self.iterkeys()), tuple(self.itervalues()))
+            cache.written(pk, row)
+        _broadcast(name, pk)
+
+    @classmethod
+    def query(cls):
+        """
+        返回这个Model的 Query 见 Query 类
+        """
+        return Query(cls)
+
+    @classmethod
+    def only(cls, *keys):
+        """
+        只读取指定字段的 Query  比如列表页: Blog.only('id', 'name', 'summary').order_by('-created_at').all()
+        """
+        return Query(cls).only(*keys)
+
+    @classmethod
+    def defer(cls, *keys):
+        """
+        不读取指定字段的 Query  比如 Blog.defer('content').where(user_id=uid).all()
+        """
+        return Query(cls).defer(*keys)
+
+    @classmethod
+    def get(cls, pk):
+        """
+        Get by primary key.
+        启用了对象缓存时先查缓存  事务中不使用缓存 先查 identity map
+        """
+        identity = _identity_map()
+        if identity is not None:
+            m = identity.get((cls, pk))
+            if m is not None:
+                return m
+            uow = _current_unit_of_work()
+            if uow is not None and uow.deleted(cls, pk):
+                return None
+        cache = cls.__object_cache__
+        if cache is not None and identity is None:
+            hit, row = cache.get(pk)
+            if hit:
+                return cls._from_row(*row) if row is not None else None
+            generation = cache.generation
+            names, rows = db.select_rows(cls.__get_sql__, pk)
+            cache.put(pk, (names, rows[0]) if rows else None, generation)
+        else:
+            names, rows = db.select_rows(cls.__get_sql__, pk)
+        return cls._from_row(names, rows[0]) if rows else None
+
+    @classmethod
+    def get_many(cls, pks, chunk_size=500, ordered=False):
+        """
+        按主键批量查询 去掉重复的主键以后每 chunk_size 个拼成一条 where pk in (...) 语句
+        返回 主键 ==> 实例 的dict(查不到的主键不在其中)
+        ordered=True 时返回和 pks 顺序一致的列表 查不到的位置是 None
+        """
+        pks = list(pks)
+        keys = set(pks)
+        pk_name = cls.__primary_key__.name
+        found = {}
+        cache = cls.__object_cache__
+        if cache is not None and len(keys) > 1 and not db.in_transaction():
+            missing = []
+            for pk in keys:
+                hit, row = cache.get(pk)
+                if not hit:
+                    missing.append(pk)
+                elif row is not None:
+                    found[pk] = cls._from_row(*row)
+            generation = cache.generation
+            names, rows = cls._find_in(pk_name, missing, chunk_size, raw=True)
+            if rows:
+                i = list(names).index(pk_name)
+                for x in rows:
+                    cache.put(x[i], (names, x), generation)
+                for m in cls._from_rows(names, rows):
+                    found[m[pk_name]] = m
+            for pk in missing:
+                if pk not in found:
+                    cache.put(pk, None, generation)
+        elif len(keys) == 1:
+            m = cls.get(pks[0])
+            if m is not None:
+                found[pks[0]] = m
+        elif keys:
+            for m in cls._find_in(pk_name, pks, chunk_size):
+                found[m[pk_name]] = m
+        if ordered:
+            return [found.get(pk) for pk in pks]
+        return found
+
+    @classmethod
+    def find_first(cls, where, *args):
+        """
+        通过where语句进行条件查询，返回1个查询结果。如果有多个查询结果
+        仅取第一个，如果没有结果，则返回None
+        """
+        names, row = db.select_row('select %s from `%s` %s' % (cls.__select__, cls.__table__, where), *args)
+        return cls._from_row(names, row) if row is not None else None
+    @classmethod
+    def find_all(cls, *args):
+        """
+        查询所有字段， 将结果以一个列表返回
+        """
+        names, rows = db.select_rows('select %s from `%s` ' % (cls.__select__, cls.__table__))
+        return cls._from_rows(names, rows)
+
+    @classmethod
+    def find_by(cls, where, *args):
+        """
+        通过where语句进行条件查询，将结果以一个列表返回
+        """
+        names, rows = db.select_rows('select %s from `%s` %s' % (cls.__select__, cls.__table__, where), *args)
+        return cls._from_rows(names, rows)
+
+    @classmethod
+    def iter_all(cls, batch=1000):
+        """
+        和find_all一样 但是逐批读取 每次生成一个实例 适合扫描大表
+        """
+        for names, values in db.iter_select_rows('select %s from `%s`' % (cls.__select__, cls.__table__), batch=batch):
+            yield cls._from_row(names, values)
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        """
+        和find_by一样 但是逐批读取 每次生成一个实例  kw 可以传入 batch
+        """
+        for names, values in db.iter_select_rows('select %s from `%s` %s' % (cls.__select__, cls.__table__, where),
+                                                 *args, **kw):
+            yield cls._from_row(names, values)
+
+    @classmethod
+    def aget(cls, pk):
+        """
+        异步的get  返回 future 见 db.submit
+        """
+        return db.submit(cls.get, pk)
+
+    @classmethod
+    def afind_first(cls, where, *args):
+        return db.submit(cls.find_first, where, *args)
+
+    @classmethod
+    def afind_all(cls):
+        return db.submit(cls.find_all)
+
+    @classmethod
+    def afind_by(cls, where, *args):
+        return db.submit(cls.find_by, where, *args)
+
+    @classmethod
+    def aget_many(cls, pks, chunk_size=500, ordered=False):
+        return db.submit(cls.get_many, pks, chunk_size, ordered)
+
+    @classmethod
+    def acount_all(cls):
+        return db.submit(cls.count_all)
+
+    @classmethod
+    def acount_by(cls, where, *args):
+        return db.submit(cls.count_by, where, *args)
+
+    @classmethod
+    def count_all(cls):
+        """
+        执行 select count(pk) from table语句，返回一个数值
+        """
+        return db.select_int(cls.__count_sql__)
+
+    @classmethod
+    def count_by(cls, where, *args):
+        """
+        通过select count(pk) from table where ...语句进行查询， 返回一个数值
+        """
+        return db.select_int('%s %s' % (cls.__count_sql__, where), *args)
+
+    def update(self, E=None, **F):
+        """
+        如果改行的字段属性有 updatable, 代表该字段可以被更新
+        用于定义的表（继承Model的类）是一个Dict对象，键值会变成实例的属性
+        所以可以通过属性来判断 用户是否定义了该字段的值
+            如果有属性， 就使用用户传入的值
+            如果无属性， 则调用字段对象的 default属性传入
+            具体见 Field类 的 default 属性
+
+        通过的db对象的update接口执行SQL
+            SQL: update `user` set `passwd`=%s,`last_modified`=%s,`name`=%s where id=%s,
+                 ARGS: (u'******', 1441878476.202391, u'Michael', 10190
+
+        从数据库读出(get/find_*)或者insert过的实例只写入值有变化的字段 没有变化时不执行SQL
+        有 VersionField 时只在数据库中的版本和实例的版本相同时更新 否则抛出 ConflictError
+        """
+        uow = _current_unit_of_work()
+        if uow is not None:
+            uow.update(self)
+            return self
+        keys = self._update_keys()
+        if keys is not None:
+            self._write_update(keys)
+        return self
+
+    def _update_keys(self):
+        """
+        执行 pre_update 返回需要写入的字段(没有值的字段填入缺省值)  没有变化时返回 None
+        """
+        self.pre_update and self.pre_update()
+        changed = self._changed()
+        if changed == []:
+            return None
+        keys = self.__update_keys__ if changed is None else tuple(changed)
+        if not keys:
+            return None
+        for k in keys:
+            if k not in self:
+                self[k] = self.__mappings__[k].default
+        version = self.__version__
+        if version and version not in self:
+            raise db.DBError('Cannot update %s(%s) without its version.' % (
+                self.__class__.__name__, self[self.__primary_key__.name]))
+        return keys
+
+    def _write_update(self, keys):
+        pk = self[self.__primary_key__.name]
+        args = [self[k] for k in keys]
+        args.append(pk)
+        version = self.__version__
+        if version:
+            args.append(self[version])
+        r = db.update(self._update_sql(keys), *args)
+        if version and r == 0:
+            self._forget()
+            raise ConflictError('%s(%s) was changed or deleted since version %s.' % (
+                self.__class__.__name__, pk, self[version]))
+        self._updated()
+
+    def _updated(self):
+        """
+        update 写入以后: 版本加一 记下新的快照 更新对象缓存
+        """
+        version = self.__version__
+        if version:
+            # 事务中的后续 update 要用新的版本  回滚时由 _remember 恢复
+            self._remember()
+            self[version] += 1
+        self._mark_clean()
+        self._cache_written()
+
+    def _forget(self):
+        """
+        版本冲突以后 从 identity map 中去掉这个实例  同一个事务中再 get 会重新读取
+        """
+        identity = _identity_map()
+        if identity:
+            key = (self.__class__, self._value(self.__primary_key__.name))
+            if identity.get(key) is self:
+                del identity[key]
+
+    @classmethod
+    def _update_all(cls, instances, chunk_size=500):
+        """
+        unit of work 写入时批量更新  修改的字段相同的实例每 chunk_size 个一条语句:
+            update `t` set `a`=case `id` when ? then ? ... end,... where `id` in (...)
+        有 VersionField 时 where 中按主键比较各自的版本  更新的行数不对时抛出 ConflictError
+        """
+        groups = collections.OrderedDict()
+        for m in instances:
+            keys = m._update_keys()
+            if keys is not None:
+                groups.setdefault(keys, []).append(m)
+        pk = cls.__primary_key__.name
+        version = cls.__version__
+        for keys, L in groups.iteritems():
+            if len(L) == 1:
+                L[0]._write_update(keys)
+                continue
+            for i in range(0, len(L), chunk_size):
+                chunk = L[i:i + chunk_size]
+                when = 'case `%s` %s end' % (pk, ' '.join(['when ? then ?'] * len(chunk)))
+                sets = ['`%s`=%s' % (k, when) for k in keys]
+                args = []
+                for k in keys:
+                    for m in chunk:
+                        args.extend((m[pk], m[k]))
+                where = '`%s` in (%s)' % (pk, ','.join(['?'] * len(chunk)))
+                args.extend([m[pk] for m in chunk])
+                if version:
+                    sets.append('`%s`=`%s`+1' % (version, version))
+                    where = '%s and `%s`=%s' % (where, version, when)
+                    for m in chunk:
+                        args.extend((m[pk], m[version]))
+                r = db.update('update `%s` set %s where %s' % (cls.__table__, ','.join(sets), where), *args)
+                if version and r != len(chunk):
+                    for m in chunk:
+                        m._forget()
+                    raise ConflictError('%d of %d %s rows were changed or deleted since they were read.' % (
+                        len(chunk) - r, len(chunk), cls.__name__))
+                for m in chunk:
+                    m._updated()
+
+    def delete(self):
+        """
+        通过db对象的 update接口 执行SQL
+            SQL: delete from `user` where `id`=%s, ARGS: (10190,)
+        """
+        uow = _current_unit_of_work()
+        if uow is not None:
+            uow.delete(self)
+            return self
+        self.pre_delete and self.pre_delete()
+        counters = self._counters()
+        if counters:
+            with db.transaction():
+                self._count_deleted(counters, [self])
+                db.update(self.__delete_sql__, self[self.__primary_key__.name])
+        else:
+            db.update(self.__delete_sql__, self[self.__primary_key__.name])
+        self._cache_written()
+        return self
+
+    @classmethod
+    def _cache_cleared(cls):
+        """
+        按条件更新了多行以后  清空这个类的对象缓存 丢掉 identity map 中这个类的实例 并通知其他进程清空
+        """
+        identity = _identity_map()
+        if identity:
+            for key in [key for key in identity if key[0] is cls]:
+                del identity[key]
+        cache = cls.__object_cache__
+        if cache is None and _invalidator is None:
+            return
+        name = cls.__name__
+        if cache is not None:
+            cache.clear()
+        if db.in_transaction():
+            def after(committed):
+                if cache is not None:
+                    cache.clear()
+                committed and _broadcast(name, None)
+            db.after_transaction(after)
+        else:
+            _broadcast(name, None)
+
+    @classmethod
+    def _cache_invalidated(cls, pks):
+        """
+        计数字段变化以后 让这些主键的缓存和 identity map 中的实例失效  pks 是 None 时清空这个类的缓存
+        """
+        if pks is None:
+            return cls._cache_cleared()
+        identity = _identity_map()
+        if identity:
+            for pk in pks:
+                identity.pop((cls, pk), None)
+        cache = cls.__object_cache__
+        if cache is None and _invalidator is None:
+            return
+        name = cls.__name__
+        for pk in pks:
+            if cache is not None:
+                cache.invalidate(pk)
+
+            def after(committed, pk=pk):
+                if cache is not None:
+                    cache.invalidate(pk)
+                committed and _broadcast(name, pk)
+            db.after_transaction(after)
+
+    @classmethod
+    def _counters(cls):
+        """
+        这个类的 insert/delete 要维护的计数 返回 [(计数字段所在的类, 计数字段, 外键字段)]
+        """
+        L = []
+        for model, column, key in _counters.get(cls.__name__, ()):
+            field = cls.__mappings__.get(key)
+            if field is None or field.updatable:
+                raise TypeError('CountField %s.%s needs a non-updatable field %s in class: %s' % (
+                    model, column, key, cls.__name__))
+            L.append((_model(model), column, key))
+        return L
+
+    @classmethod
+    def _count_inserted(cls, counters, instances):
+        """
+        插入以后在同一个事务中增加计数  同一个外键值插入几行就加几  加的数相同的外键值合成一条 update
+        """
+        for model, column, key in counters:
+            n = collections.Counter([m[key] for m in instances])
+            groups = {}
+            for value, delta in n.iteritems():
+                groups.setdefault(delta, []).append(value)
+            pk = model.__primary_key__.name
+            for delta, values in groups.iteritems():
+                for i in range(0, len(values), 500):
+                    chunk = values[i:i + 500]
+                    db.update('update `%s` set `%s`=`%s`+? where `%s` in (%s)' % (
+                        model.__table__, column, column, pk, ','.join(['?'] * len(chunk))), delta, *chunk)
+            model._cache_invalidated(n.keys())
+
+    @classmethod
+    def _count_deleted(cls, counters, instances):
+        """
+        删除之前在同一个事务中减少计数  按数据库中还存在的行计算 已经删除过的行不会重复减
+        """
+        pk = cls.__primary_key__.name
+        keys = [m._value(pk) for m in instances]
+        for model, column, key in counters:
+            mpk = model.__primary_key__.name
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ','.join(['?'] * len(chunk))
+                db.update('update `%s` set `%s`=`%s`-(select count(*) from `%s` where `%s`.`%s`=`%s`.`%s` and `%s` in (%s)) '
+                          'where `%s` in (select `%s` from `%s` where `%s` in (%s))' % (
+                              model.__table__, column, column, cls.__table__, cls.__table__, key, model.__table__, mpk,
+                              pk, marks, mpk, key, cls.__table__, pk, marks), *(chunk + chunk))
+            values = [m._value(key) for m in instances]
+            model._cache_invalidated(None if None in values else set(values))
+
+    @classmethod
+    def rebuild_counters(cls, *columns, **kw):
+        """
+        重新统计这个类的计数字段(默认全部)  只更新和统计结果不同的行 返回修正的行数
+        keys=[...] 时只统计这些主键  计数和实际行数不一致(比如直接执行SQL修改过)时使用:
+            Blog.rebuild_counters()
+            Blog.rebuild_counters('comment_count', keys=[blog_id])
+        """
+        keys = kw.get('keys')
+        if keys is not None:
+            keys = list(keys)
+            if not keys:
+                return 0
+        pk = cls.__primary_key__.name
+        n = 0
+        with db.transaction():
+            for k, v in cls.__mappings__.iteritems():
+                if not isinstance(v, CountField) or (columns and k not in columns):
+                    continue
+                other = _model(v.to)
+                count = '(select count(*) from `%s` where `%s`.`%s`=`%s`.`%s`)' % (
+                    other.__table__, other.__table__, v.key, cls.__table__, pk)
+                sql = 'update `%s` set `%s`=%s where `%s`<>%s' % (cls.__table__, k, count, k, count)
+                if keys is None:
+                    n += db.update(sql)
+                    continue
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    n += db.update('%s and `%s` in (%s)' % (sql, pk, ','.join(['?'] * len(chunk))), *chunk)
+        if n:
+            cls._cache_invalidated(keys)
+        return n
+
+    @classmethod
+    def update_where(cls, where, *args, **values):
+        """
+        按条件批量更新 一条 update `table` set ... where ... 语句  where 和 find_by 一样包括 where 关键字:
+            User.update_where('where `last_login`<?', time.time() - 86400 * 365, status='inactive')
+        不读出实例 也不执行 pre_update  有 VersionField 时所有更新的行版本加一
+        返回更新的行数  这个类的对象缓存会被清空(其他进程也一样)
+        """
+        if not values:
+            raise db.DBError('No values to update.')
+        sets = []
+        for k in values:
+            field = cls.__mappings__.get(k)
+            if field is None or field.primary_key or not field.updatable or k == cls.__version__:
+                raise db.DBError('Cannot update field %s of %s.' % (k, cls.__name__))
+            sets.append('`%s`=?' % k)
+        version = cls.__version__
+        if version:
+            sets.append('`%s`=`%s`+1' % (version, version))
+        # 先写入 unit of work 中的修改  否则条件可能匹配不到它们
+        flush()
+        r = db.update('update `%s` set %s %s' % (cls.__table__, ','.join(sets), where), *(values.values() + list(args)))
+        cls._cache_cleared()
+        return r
+
+    @classmethod
+    def _delete_all(cls, instances, chunk_size=500):
+        """
+        unit of work 写入时批量删除  每 chunk_size 个主键一条 delete ... where pk in (...)
+        """
+        for m in instances:
+            m.pre_delete and m.pre_delete()
+        pk = cls.__primary_key__.name
+        keys = [m[pk] for m in instances]
+        counters = cls._counters()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            counters and cls._count_deleted(counters, instances[i:i + chunk_size])
+            db.update('delete from `%s` where `%s` in (%s)' % (cls.__table__, pk, ','.join(['?'] * len(chunk))), *chunk)
+        for m in instances:
+            m._cache_written()
+
+    def _insert_values(self):
+        """
+        执行 pre_insert 并填入缺省值 返回按 __insert_columns__ 顺序排列的值
+        """
+        self.pre_insert and self.pre_insert()
+        values = []
+        for k, v in self.__insert_fields__:
+            if k in self:
+                values.append(self[k])
+            else:
+                arg = v.default
+                self[k] = arg
+                values.append(arg)
+        return values
+
+    def insert(self):
+        """
+        通过db对象的insert接口执行SQL
+            SQL: insert into `user` (`passwd`,`last_modified`,`id`,`name`,`email`) values (%s,%s,%s,%s,%s),
+            　　　　　 ARGS: ('******', 1441878476.202391, 10190, 'Michael', 'orm@db.org')
+        """
+        uow = _current_unit_of_work()
+        if uow is not None:
+            uow.insert(self)
+            return self
+        args = self._insert_values()
+        counters = self._counters()
+        if counters:
+            with db.transaction():
+                db.update(self.__insert_sql__, *args)
+                self._count_inserted(counters, [self])
+        else:
+            db.update(self.__insert_sql__, *args)
+        self._mark_clean()
+        self._cache_written(inserted=True)
+        return self
+
+    @classmethod
+    def insert_all(cls, instances, chunk_size=500):
+        """
+        批量插入 每个实例和insert一样执行 pre_insert 并填入缺省值
+        然后通过db.insert_many 分块在一个事务中插入 返回插入的实例列表
+        """
+        instances = list(instances)
+        uow = _current_unit_of_work()
+        if uow is not None:
+            for m in instances:
+                uow.insert(m)
+            return instances
+        rows = [m._insert_values() for m in instances]
+        counters = cls._counters()
+        with db.transaction():
+            db.insert_many(cls.__table__, rows, chunk_size, cls.__insert_columns__)
+            counters and cls._count_inserted(counters, instances)
+        for m in instances:
+            m._mark_clean()
+            m._cache_written(inserted=True)
+        return instances
+
+    @classmethod
+    def upsert_all(cls, instances, chunk_size=500):
+        """
+        批量写入 主键已经存在的行更新 __update_keys__ 中的字段 不存在的插入  通过 db.upsert 分块在一个事务中执行
+        代替 先 get/find_first 再 insert 或者 update 的写法  每个实例执行 pre_insert 并填入缺省值
+        有 VersionField 时已经存在的行版本加一  实例中的版本不再可靠 需要重新读出以后才能 update
+        返回写入的实例列表
+        """
+        instances = list(instances)
+        if not instances:
+            return instances
+        flush()
+        update_cols = dict.fromkeys([k for k in cls.__update_keys__ if k in cls.__insert_columns__])
+        version = cls.__version__
+        if version:
+            update_cols[version] = '`%s`+1' % version
+        pk = cls.__primary_key__.name
+        rows = [m._insert_values() for m in instances]
+        with db.transaction():
+            db.upsert(cls.__table__, rows, pk, update_cols, chunk_size, cls.__insert_columns__)
+            # 不知道哪些行是新插入的  重新统计涉及到的计数
+            for model, column, key in cls._counters():
+                model.rebuild_counters(column, keys=set([m[key] for m in instances]))
+        identity = _identity_map()
+        for m in instances:
+            if identity and identity.get((cls, m[pk])) not in (None, m):
+                del identity[(cls, m[pk])]
+            m._cache_written()
+        return instances
+
+class Model(_ModelBase, dict):
     """
     这是一个基类，用户在子类中 定义映射关系， 因此我们需要动态扫描子类属性 ，
     从中抽取出类属性， 完成 类 <==> 表 的映射， 这里使用 metaclass 来实现。
@@ -292,7 +1985,7 @@ class Model(dict):
       primary key(`id`)
     );
     """
-    __metaclass__ = ModelMetaclass
+    __slots__ = _ModelBase._instance_slots
 
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -301,121 +1994,258 @@ class Model(dict):
         """
         get时生效，比如 a[key],  a.get(key)
         get时 返回属性的值
+        没有prefetch过的关联在第一次访问时查询  加载的对象保存在 _related_objects 中
         """
         # print key
         try:
             return self[key]
         except KeyError:
+            if key in self._instance_slots:
+                return None
+            if key in self.__mappings__ and self._loaded is not None:
+                self._load_deferred(key)
+                return self[key]
+            if not key.startswith('_') and self._relation(key) is not None:
+                related = self._related()
+                if key not in related:
+                    self.prefetch([self], key)
+                return related[key]
             raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
-    @classmethod
-    def get(cls, pk):
-        """
-        Get by primary key.
-        """
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+    # Model.get 是按主键查询  不加载字段时取值用 _value
+    _value = dict.get
+
+    def __getstate__(self):
+        # 字段由 pickle 按 dict 的内容保存  slot 中只保留快照  不能经过 __setattr__ 写成字段
+        return self._loaded
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_loaded', state)
 
     @classmethod
-    def find_first(cls, where, *args):
-        """
-        通过where语句进行条件查询，返回1个查询结果。如果有多个查询结果
-        仅取第一个，如果没有结果，则返回None
-        """
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
-    @classmethod
-    def find_all(cls, *args):
+    def _from_row(cls, names, values):
         """
-        查询所有字段， 将结果以一个列表返回
+        直接用查询结果的列名和值(tuple)构造实例 不经过中间的 Dict
+        先复制已经有全部列名的模板(一次分配好大小) 再填入值  逐个插入时 dict 中途扩容 要多占一半以上的内存
         """
-        L = db.select('select * from `%s` ' % cls.__table__)
-        return [cls(**d) for d in L]
+        m = dict.__new__(cls)
+        dict.update(m, _template(names))
+        dict.update(m, itertools.izip(names, values))
+        object.__setattr__(m, '_loaded', (names, values))
+        return cls._mapped(m)
 
-    @classmethod
-    def find_by(cls, where, *args):
+# 列名tuple ==> 值都是 None 的 dict  见 Model._from_row
+_templates = {}
+
+def _template(names):
+    t = _templates.get(names)
+    if t is None:
+        if len(_templates) > 10000:
+            _templates.clear()
+        t = _templates[names] = dict.fromkeys(names)
+    return t
+
+class CompactModel(_ModelBase):
+    """
+    和 Model 用法一样 但是实例不是 dict: 每个字段一个 slot(由 ModelMetaclass 生成)  没有 __dict__
+    占用的内存只有 Model 的几分之一 读字段是 slot 描述符的直接访问  适合在缓存中保存大量实例:
+
+        class Comment(CompactModel):
+            id = StringField(primary_key=True, ddl='varchar(50)')
+            ...
+
+    仍然支持 c['content'], 'content' in c, c.keys()/items() 等 dict 风格的读写  json 序列化用 to_dict()
+    和 Model 不同的是只能保存定义过的字段  给其他属性赋值会抛出 AttributeError
+    """
+    __compact__ = True
+    __slots__ = _ModelBase._instance_slots
+
+    def __init__(self, **kw):
+        for k, v in kw.iteritems():
+            setattr(self, k, v)
+
+    def __getattr__(self, key):
         """
-        通过where语句进行条件查询，将结果以一个列表返回
+        只有 slot 没有赋值(或者不是字段)时才会调用  处理延迟加载的字段和关联
         """
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+        if key in self._instance_slots:
+            return None
+        if key in self.__mappings__:
+            if self._loaded is not None:
+                self._load_deferred(key)
+                return self[key]
+        elif not key.startswith('_') and self._relation(key) is not None:
+            related = self._related()
+            if key not in related:
+                self.prefetch([self], key)
+            return related[key]
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
 
-    @classmethod
-    def count_all(cls):
+    def __getitem__(self, key):
+        try:
+            return self.__getters__[key](self)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__mappings__:
+            raise KeyError(key)
+        object.__setattr__(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            object.__delattr__(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__getters__ and self._has(key)
+
+    def _has(self, key):
+        try:
+            self.__getters__[key](self)
+            return True
+        except AttributeError:
+            return False
+
+    def _value(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iterkeys(self):
+        return (k for k in self.__fields__ if self._has(k))
+
+    def itervalues(self):
+        return (self[k] for k in self.iterkeys())
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self.iterkeys())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
         """
-        执行 select count(pk) from table语句，返回一个数值
+        转换成 dict  比如 json.dumps(c.to_dict())
         """
-        return db.select('select count(`%s`) from `%s`' % (cls.__primay_key__.name, cls.__table__))
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, CompactModel):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(['%s=%r' % kv for kv in self.iteritems()]))
 
     @classmethod
-    def count_by(cls, where, *args):
+    def _from_row(cls, names, values):
         """
-        通过select count(pk) from table where ...语句进行查询， 返回一个数值
+        按列名把值直接写入 slot  没有对应字段的列只保留在快照中
         """
-        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        setters = cls.__setters__.get(names)
+        if setters is None:
+            setters = tuple([cls.__dict__[n].__set__ if n in cls.__mappings__ else _ignore for n in names])
+            if len(cls.__setters__) > 10000:
+                cls.__setters__.clear()
+            cls.__setters__[names] = setters
+        m = object.__new__(cls)
+        for set_value, v in itertools.izip(setters, values):
+            set_value(m, v)
+        m._loaded = (names, values)
+        return cls._mapped(m)
 
-    def update(self, E=None, **F):
-        """
-        如果改行的字段属性有 updatable, 代表该字段可以被更新
-        用于定义的表（继承Model的类）是一个Dict对象，键值会变成实例的属性
-        所以可以通过属性来判断 用户是否定义了该字段的值
-            如果有属性， 就使用用户传入的值
-            如果无属性， 则调用字段对象的 default属性传入
-            具体见 Field类 的 default 属性
+def _ignore(m, v):
+    pass
 
-        通过的db对象的update接口执行SQL
-            SQL: update `user` set `passwd`=%s,`last_modified`=%s,`name`=%s where id=%s,
-                 ARGS: (u'******', 1441878476.202391, u'Michael', 10190
-        """
-        self.pre_update and self.pre_update()
+def rebuild_counters(*models):
+    '''
+    重新统计所有(或者指定的)Model的计数字段(见 CountField)  返回 类名 ==> 修正的行数  用于修复计数的偏差
+    '''
+    d = db.Dict()
+    for model in models or _models.values():
+        if [v for v in model.__mappings__.itervalues() if isinstance(v, CountField)]:
+            d[model.__name__] = model.rebuild_counters()
+    return d
 
-        L = []
-        args = []
-        for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
-                L.append('`%s`=?' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
-        return self
+def slow_query_report(top=10, reset=False, out=sys.stdout):
+    """
+    输出 db.explain_report() 中慢查询总耗时最多的 top 个  索引建议对应到 Model 和字段:
+        suggestion.model / suggestion.fields   比如 'Comment' / ['Comment.blog_id']
+        suggestion.declared  Model 已经声明了这个索引 只是数据库中还没有 执行 sync_indexes() 即可
+    out 为 None 时不输出  返回 db.explain_report() 的结果
+    """
+    entries = db.explain_report(top, reset)
+    _annotate_suggestions(entries)
+    if out is not None:
+        for i, e in enumerate(entries):
+            out.write('%d. %d slow, total %.3fs, max %.3fs\n' % (i + 1, e.count, e.total, e.max))
+            _write_plan(e, out)
+    return entries
 
-    def delete(self):
-        """
-        通过db对象的 update接口 执行SQL
-            SQL: delete from `user` where `id`=%s, ARGS: (10190,)
-        """
-        self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
+def _annotate_suggestions(entries):
+    """
+    给 explain 结果中的索引建议加上 model/fields/declared
+    """
+    tables = dict([(m.__table__, m) for m in _models.itervalues()])
+    for e in entries:
+        for s in e.suggestions:
+            model = tables.get(s.table)
+            s.model = model and model.__name__
+            s.declared = False
+            if model is not None:
+                keys = dict([(f.name, k) for k, f in model.__mappings__.iteritems()])
+                s.fields = ['%s.%s' % (model.__name__, keys.get(c, c)) for c in s.columns]
+                s.declared = bool([1 for n, c, u in model.__index_defs__ if c[:len(s.columns)] == s.columns])
+            else:
+                s.fields = []
 
-        args = (getattr(self, pk), )
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
-        return self
+def _write_plan(e, out):
+    out.write('   %s\n' % e.sql)
+    if e.plan:
+        out.write('   plan: %s\n' % ' | '.join(e.plan))
+    for s in e.suggestions:
+        out.write('   -> %s%s%s\n' % (s.text, ' [%s]' % ', '.join(s.fields) if s.fields else '',
+                                      ' (declared, run %s.sync_indexes())' % s.model if s.declared else ''))
 
-    def insert(self):
-        """
-        通过db对象的insert接口执行SQL
-            SQL: insert into `user` (`passwd`,`last_modified`,`id`,`name`,`email`) values (%s,%s,%s,%s,%s),
-            　　　　　 ARGS: ('******', 1441878476.202391, 10190, 'Michael', 'orm@db.org')
-        """
-        self.pre_insert and self.pre_insert()
-        params = {}
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-
-        db.insert('%s' % self.__table__, **params)
-        return self
+def explain_statements(statements, out=sys.stdout):
+    """
+    逐条 EXPLAIN statements(每一项是 (sql, args))  输出执行计划和对应到 Model 字段的索引建议  见 explain.py
+    返回 db.explain() 的结果列表  出错的语句只输出错误
+    """
+    entries = []
+    for i, (sql, args) in enumerate(statements):
+        try:
+            e = db.explain(sql, *args)
+        except Exception, ex:
+            out.write('%d. failed: %s\n   %s\n' % (i + 1, ex, sql))
+            continue
+        _annotate_suggestions([e])
+        out.write('%d.%s\n' % (i + 1, ' full scan: %s' % ', '.join(e.full_scans) if e.full_scans else ''))
+        _write_plan(e, out)
+        entries.append(e)
+    return entries
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
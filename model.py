@@ -7,14 +7,14 @@ Models for user, blog, comment.
 import time
 
 from db.db import next_id
-from db.orm import Model, StringField, BooleanField, FloatField, TextField
+from db.orm import Model, StringField, BooleanField, FloatField, TextField, ForeignKeyField, CountField
 
 
 class User(Model):
     __table__ = "users"
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updatable=False, ddl='varchar(50)')
+    email = StringField(updatable=False, unique=True, ddl='varchar(50)')
     password = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
@@ -26,20 +26,23 @@ class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    user_id = ForeignKeyField(User, related_name='blogs', updatable=False)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    # 已有的 blogs 表没有这一列  部署前先执行一次 Blog.sync_counters() 加上这一列并统计
+    comment_count = CountField('Comment', 'blog_id')
     created_at = FloatField(updatable=False, default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(updatable=False, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    blog_id = ForeignKeyField(Blog, related_name='comments', updatable=False)
+    user_id = ForeignKeyField(User, related_name='comments', updatable=False)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
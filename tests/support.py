@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''
+测试用的公共部分  db/orm 是平铺的模块 所以把 db 目录加到 sys.path
+每个测试用临时目录里的 sqlite 文件作为数据库  运行:  python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'db'))
+
+import db
+
+
+class SqliteTestCase(unittest.TestCase):
+    '''
+    setUp 时 db.engine 指向一个新的 sqlite 数据库  engine_kw 传给 _Engine(比如连接池的参数)
+    '''
+    engine_kw = {}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.db')
+        db.engine = self.make_engine()
+
+    def tearDown(self):
+        db.engine.dispose()
+        db.engine = None
+        shutil.rmtree(self.dir)
+
+    def make_engine(self, path=None, **kw):
+        path = path or self.path
+        kw = dict(self.engine_kw, **kw)
+        return db._Engine(lambda: sqlite3.connect(path, check_same_thread=False), placeholder='?', **kw)
+
+    def execute(self, *sqls):
+        for sql in sqls:
+            db.update(sql)
+
+    def create_tables(self, *models):
+        # __sql__ 第一行是注释  建表和建索引是分开的语句
+        for model in models:
+            for sql in model().__sql__().split('\n', 1)[1].split(';'):
+                if sql.strip():
+                    db.update(sql)
+
+    def statements(self):
+        '''
+        上次调用以后执行的语句数
+        '''
+        return sum([s.count for s in db.stats(reset=True).itervalues()])
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+import sqlite3
+import threading
+import time
+import unittest
+
+from support import db, SqliteTestCase
+
+
+class FakeConnection(object):
+    '''
+    记录调用次数的假连接  broken 以后 ping 失败
+    '''
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+        self.pings = 0
+        self.rollbacks = 0
+
+    def ping(self):
+        self.pings += 1
+        if self.broken:
+            raise IOError('gone away')
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class CountingConnection(object):
+    '''
+    包装 sqlite3 连接 记录 rollback 的次数
+    '''
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def rollback(self):
+        self._counter.append(1)
+        return self._connection.rollback()
+
+    def __getattr__(self, key):
+        return getattr(self._connection, key)
+
+
+class IdTest(unittest.TestCase):
+
+    def test_unique_and_sorted(self):
+        ids = [db.next_id() for i in range(5000)] + db.next_ids(5000)
+        self.assertEqual(len(set(ids)), 10000)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(ids[0]), 30)
+        big = [db.next_bigint_id() for i in range(5000)] + db.next_bigint_ids(5000)
+        self.assertEqual(big, sorted(set(big)))
+
+    def test_fork_uses_new_node(self):
+        # 子进程的第一批 id 就要用新的节点号
+        r, w = os.pipe()
+        db.next_id()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(w, ','.join([db.next_ids(1)[0], str(db.next_bigint_ids(1)[0])]))
+            finally:
+                os._exit(0)
+        os.close(w)
+        os.waitpid(pid, 0)
+        child, child_big = os.read(r, 1024).split(',')
+        os.close(r)
+        parent = db.next_id()
+        self.assertNotEqual(child[15:27], parent[15:27])
+        node = int(child[15:27], 16) & db._ID_NODE_MASK
+        self.assertEqual((int(child_big) >> db._ID_SEQ_BITS) & db._ID_NODE_MASK, node)
+
+
+class PoolTest(unittest.TestCase):
+
+    def pool(self, **kw):
+        self.opened = []
+
+        def connect():
+            c = FakeConnection()
+            self.opened.append(c)
+            return c
+        return db._Pool(connect, **kw)
+
+    def test_timeout(self):
+        pool = self.pool(max_size=1, timeout=0.05)
+        c = pool.acquire()
+        start = time.time()
+        self.assertRaises(db.PoolTimeoutError, pool.acquire)
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(pool.stats().timeouts, 1)
+        pool.release(c)
+        self.assertTrue(pool.acquire() is c)
+
+    def test_reuse_without_ping(self):
+        pool = self.pool(ping_idle=60)
+        c = pool.acquire()
+        pool.release(c)
+        self.assertTrue(pool.acquire() is c)
+        self.assertEqual(c.pings, 0)
+
+    def test_ping_discard(self):
+        pool = self.pool(ping_idle=0)
+        c = pool.acquire()
+        pool.release(c)
+        c.broken = True
+        d = pool.acquire()
+        self.assertTrue(d is not c)
+        self.assertEqual(c.pings, 1)
+        self.assertTrue(c.closed)
+
+    def test_eviction(self):
+        pool = self.pool(max_idle=0.01)
+        c = pool.acquire()
+        pool.release(c)
+        time.sleep(0.02)
+        d = pool.acquire()
+        self.assertTrue(d is not c)
+        self.assertTrue(c.closed)
+
+    def test_min_size_kept(self):
+        pool = self.pool(min_size=1, max_idle=0)
+        c = pool.acquire()
+        pool.release(c)
+        self.assertTrue(pool.acquire() is c)
+
+    def test_max_lifetime(self):
+        pool = self.pool(max_lifetime=0.01)
+        c = pool.acquire()
+        time.sleep(0.02)
+        pool.release(c)
+        self.assertTrue(c.closed)
+        self.assertEqual(pool.stats().idle, 0)
+
+    def test_release_rollback(self):
+        pool = self.pool()
+        c = pool.acquire()
+        pool.release(c)
+        self.assertEqual(c.rollbacks, 1)
+        c = pool.acquire()
+        pool.release(c, clean=True)
+        self.assertEqual(c.rollbacks, 1)
+        c.in_transaction = False
+        pool.release(pool.acquire())
+        self.assertEqual(c.rollbacks, 1)
+
+
+class ReleaseTest(SqliteTestCase):
+
+    def make_engine(self, path=None, **kw):
+        self.rollbacks = []
+        path = path or self.path
+        return db._Engine(lambda: CountingConnection(sqlite3.connect(path, check_same_thread=False), self.rollbacks),
+                          placeholder='?', **kw)
+
+    def test_skip_rollback_after_commit(self):
+        db.update('create table t (id bigint)')
+        db.update('insert into t values (1)')
+        self.assertEqual(self.rollbacks, [])
+        self.assertEqual(db.select_int('select count(*) from t'), 1)
+        self.assertEqual(self.rollbacks, [1])
+
+
+class RowTest(SqliteTestCase):
+
+    def setUp(self):
+        super(RowTest, self).setUp()
+        self.execute('create table t (id bigint, name varchar(50), `count` bigint, `index` bigint)',
+                     "insert into t values (1, 'a', 10, 100)",
+                     "insert into t values (2, 'b', 20, 200)")
+
+    def test_json(self):
+        rows = db.select('select id,name from t order by id')
+        self.assertEqual(json.loads(json.dumps(rows)), [dict(id=1, name='a'), dict(id=2, name='b')])
+        self.assertEqual(json.loads(json.dumps(db.select_one('select id from t where id=?', 2))), dict(id=2))
+
+    def test_mutable(self):
+        row = db.select_one('select id,name from t where id=?', 1)
+        row.x = 1
+        row.name = 'c'
+        self.assertEqual(row, dict(id=1, name='c', x=1))
+        self.assertTrue(isinstance(row, db.Dict))
+
+    def test_column_names(self):
+        row = db.select_one('select * from t where id=?', 1)
+        self.assertEqual((row.count, row.index), (10, 100))
+        self.assertEqual(row['count'], 10)
+        self.assertRaises(AttributeError, getattr, row, 'missing')
+
+    def test_compact(self):
+        # 和一次分配好大小的 dict 一样大  逐个插入 7 列时 dict 会扩容到两倍多
+        self.execute('alter table t add column a', 'alter table t add column b', 'alter table t add column c')
+        for row in db.select('select * from t') + [db.select_one('select * from t')] + list(db.iter_select('select * from t')):
+            self.assertEqual(len(row), 7)
+            self.assertEqual(sys.getsizeof(row) - sys.getsizeof(db.Row()), sys.getsizeof(dict(row)) - sys.getsizeof({}))
+
+    def test_iter_select(self):
+        rows = list(db.iter_select('select id,name from t order by id', batch=1))
+        self.assertEqual(rows, [dict(id=1, name='a'), dict(id=2, name='b')])
+        names, rows = db.select_rows('select id,name from t order by id')
+        self.assertEqual((names, rows), (('id', 'name'), [(1, 'a'), (2, 'b')]))
+        self.assertEqual(db.select_row('select id from t where id>?', 5), (('id',), None))
+
+
+class QueryCacheTest(SqliteTestCase):
+
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        self.execute('create table t (id bigint, name varchar(50))', "insert into t values (1, 'a')")
+        db.enable_cache()
+
+    def tearDown(self):
+        db.disable_cache()
+        super(QueryCacheTest, self).tearDown()
+
+    def change_behind(self, name):
+        # 不经过 db 修改数据  缓存命中时读不到
+        c = sqlite3.connect(self.path)
+        c.execute('update t set name=?', (name,))
+        c.commit()
+        c.close()
+
+    def name(self, sql='select name from t where id=?'):
+        return db.select_one(sql, 1).name
+
+    def test_hit_and_invalidate(self):
+        self.assertEqual(self.name(), 'a')
+        self.change_behind('b')
+        self.assertEqual(self.name(), 'a')
+        self.assertEqual(db.cache_stats().hits, 1)
+        db.update("update t set name='c' where id=?", 1)
+        self.assertEqual(self.name(), 'c')
+
+    def test_transaction_invalidates_on_commit(self):
+        self.assertEqual(self.name(), 'a')
+        with db.transaction():
+            db.update("update t set name='d' where id=?", 1)
+            self.assertEqual(self.name(), 'd')
+        self.assertEqual(self.name(), 'd')
+
+    def test_no_cache_in_transaction(self):
+        self.assertEqual(self.name(), 'a')
+        self.change_behind('e')
+        with db.transaction():
+            self.assertEqual(self.name(), 'e')
+        self.assertEqual(self.name(), 'a')
+
+    def test_locking_read_not_cached(self):
+        self.assertEqual(db._read_tables('select * from t where id=1 for update'), None)
+        self.assertEqual(db._read_tables('select * from t where id=1 lock in share mode'), None)
+        self.assertEqual(db._read_tables('select * from t where id=1'), frozenset(['t']))
+
+
+class GroupCommitTest(SqliteTestCase):
+    engine_kw = dict(max_size=1, timeout=0.5)
+
+    def setUp(self):
+        super(GroupCommitTest, self).setUp()
+        self.execute('create table t (id bigint primary key, name varchar(50))')
+        db.enable_group_commit(max_delay=0.01)
+
+    def tearDown(self):
+        db.disable_group_commit()
+        super(GroupCommitTest, self).tearDown()
+
+    def test_concurrent_writes(self):
+        def write(i):
+            db.update('insert into t values (?, ?)', i, 'n%d' % i)
+        threads = [threading.Thread(target=write, args=(i, )) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(db.select_int('select count(*) from t'), 20)
+        stats = db.group_commit_stats()
+        self.assertEqual(stats.statements, 20)
+        self.assertTrue(stats.commits <= 20)
+
+    def test_failure_is_isolated(self):
+        db.update('insert into t values (1, ?)', 'a')
+        self.assertRaises(sqlite3.IntegrityError, db.update, 'insert into t values (1, ?)', 'b')
+        db.update('insert into t values (2, ?)', 'b')
+        self.assertEqual(db.select_int('select count(*) from t'), 2)
+
+    def test_bypass_with_held_connection(self):
+        # 连接池只有一个连接 并且已经被当前线程借出
+        with db.connection():
+            self.assertEqual(db.select('select * from t'), [])
+            db.update('insert into t values (1, ?)', 'a')
+            self.assertEqual(db.select_int('select count(*) from t'), 1)
+        self.assertEqual(db.group_commit_stats().statements, 0)
+        self.assertEqual(db.pool_stats().in_use, 0)
+
+
+
+class BulkTest(SqliteTestCase):
+
+    def setUp(self):
+        super(BulkTest, self).setUp()
+        self.execute('create table t (id bigint primary key, name varchar(50), n bigint)')
+        self.statements()
+
+    def rows(self):
+        return [tuple(r) for r in db.select_rows('select * from t order by id')[1]]
+
+    def test_insert_many(self):
+        self.assertEqual(db.insert_many('t', [dict(id=i, name='n%d' % i, n=0) for i in range(5)], chunk_size=2), 5)
+        db.insert_many('t', [(5, 'n5', 0)], columns=('id', 'name', 'n'))
+        self.assertEqual(self.statements(), 4)
+        self.assertEqual(len(self.rows()), 6)
+        self.assertEqual(db.insert_many('t', []), 0)
+
+    def test_insert_many_rolls_back(self):
+        rows = [dict(id=i, name='n', n=0) for i in (1, 2, 3, 1)]
+        self.assertRaises(sqlite3.IntegrityError, db.insert_many, 't', rows, 2)
+        self.assertEqual(self.rows(), [])
+
+    def test_upsert(self):
+        db.insert_many('t', [dict(id=1, name='a', n=1)])
+        db.upsert('t', [dict(id=1, name='b', n=5), dict(id=2, name='c', n=2)], 'id')
+        self.assertEqual(self.rows(), [(1, 'b', 5), (2, 'c', 2)])
+        db.upsert('t', [(1, 'x', 1), (3, 'd', 3)], 'id', dict(n='`n`+excluded.`n`'), columns=('id', 'name', 'n'))
+        self.assertEqual(self.rows(), [(1, 'b', 6), (2, 'c', 2), (3, 'd', 3)])
+        db.upsert('t', [dict(id=2, name='y', n=0)], 'id', [])
+        self.assertEqual(self.rows()[1], (2, 'c', 2))
+
+
+class StreamTest(SqliteTestCase):
+    engine_kw = dict(max_size=1, timeout=0.2)
+
+    def setUp(self):
+        super(StreamTest, self).setUp()
+        self.execute('create table t (id bigint primary key)')
+        db.insert_many('t', [dict(id=i) for i in range(5)])
+
+    def ids(self):
+        return [r.id for r in db.iter_select('select id from t order by id', batch=2)]
+
+    def test_reuse_held_connection(self):
+        # 连接池只有一个连接 已经被当前上下文借出
+        db.pool_stats(reset=True)
+        with db.connection():
+            self.assertEqual(db.select_int('select count(*) from t'), 5)
+            self.assertEqual(self.ids(), range(5))
+            db.update('delete from t where id=?', 0)
+            self.assertEqual(self.ids(), range(1, 5))
+            self.assertEqual(db.pool_stats().checkouts, 1)
+        self.assertEqual(db.pool_stats().in_use, 0)
+
+    def test_borrow_without_held_connection(self):
+        self.assertEqual(self.ids(), range(5))
+        with db.connection():
+            it = db.iter_select('select id from t')
+            next(it)
+            self.assertEqual(db.pool_stats().in_use, 1)
+            it.close()
+        self.assertEqual(db.pool_stats().in_use, 0)
+        with db.transaction():
+            self.assertEqual(self.ids(), range(5))
+
+
+
+class StatsTest(SqliteTestCase):
+
+    def setUp(self):
+        super(StatsTest, self).setUp()
+        self.execute('create table t (id bigint primary key, name varchar(50))')
+        db.stats(reset=True)
+
+    def test_fingerprint_and_counts(self):
+        db.insert_many('t', [(i, 'n') for i in range(3)], columns=('id', 'name'))
+        db.select('select * from t where id in (1, 2)')
+        db.select("select * from t where id in (3) and name='x'")
+        self.assertRaises(Exception, db.select, 'select * from missing')
+        stats = db.stats(reset=True)
+        s = stats['select * from t where id in (...)']
+        self.assertEqual((s.count, s.rows, s.errors), (1, 2, 0))
+        self.assertTrue(0 < s.min <= s.max)
+        self.assertEqual(stats["select * from t where id in (...) and name=?"].rows, 0)
+        self.assertEqual(stats['select * from missing'].errors, 1)
+        self.assertEqual(stats['insert into `t` (`id`,`name`) values (?,?),...'].rows, 3)
+        self.assertEqual(db.stats(), {})
+        db.select('select * from t where id in (1, 2)')
+        self.assertEqual(db.stats()['select * from t where id in (...)'].count, 1)
+
+    def test_disabled(self):
+        db.configure_stats(enabled=False)
+        try:
+            db.select('select * from t')
+        finally:
+            db.configure_stats(enabled=True)
+        self.assertEqual(db.stats(), {})
+
+
+
+class ReplicaTest(SqliteTestCase):
+
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        self.execute('create table t (name varchar(50))', "insert into t values ('primary')")
+        replicas = []
+        for name in ('r1', 'r2'):
+            path = os.path.join(self.dir, name + '.db')
+            c = sqlite3.connect(path)
+            c.execute('create table t (name varchar(50))')
+            c.execute('insert into t values (?)', (name, ))
+            c.commit()
+            c.close()
+            replicas.append(self.make_engine(path))
+        db.engine.dispose()
+        db.engine = self.make_engine(replicas=replicas)
+
+    def name(self):
+        return db.select_one('select name from t').name
+
+    def test_round_robin(self):
+        self.assertEqual([self.name() for i in range(4)], ['r1', 'r2', 'r1', 'r2'])
+        self.assertEqual([r.checkouts for r in db.pool_stats().replicas], [2, 2])
+
+    def test_transaction_uses_primary(self):
+        with db.transaction():
+            self.assertEqual(self.name(), 'primary')
+
+    def test_read_your_writes(self):
+        with db.connection():
+            self.assertEqual(self.name(), 'r1')
+            db.update("update t set name='written'")
+            self.assertEqual(self.name(), 'written')
+        self.assertEqual(self.name(), 'r2')
+        self.assertEqual(db.pool_stats().in_use, 0)
+
+
+
+class AsyncTest(SqliteTestCase):
+
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        self.execute('create table t (id bigint primary key, name varchar(50))', "insert into t values (1, 'a')")
+        db.init_executor(2)
+
+    def tearDown(self):
+        db._executor.shutdown()
+        db._executor = None
+        super(AsyncTest, self).tearDown()
+
+    def test_results(self):
+        self.assertEqual(db.aselect_one('select name from t where id=?', 1).result(1).name, 'a')
+        self.assertEqual(db.aupdate("insert into t values (2, 'b')").result(1), 1)
+        self.assertEqual(db.aselect_int('select count(*) from t').result(1), 2)
+        self.assertEqual(db.pool_stats().in_use, 0)
+
+    def test_exception(self):
+        f = db.aselect('select * from missing')
+        self.assertTrue(isinstance(f.exception(1), sqlite3.OperationalError))
+        self.assertRaises(sqlite3.OperationalError, f.result)
+
+    def test_callbacks(self):
+        done = []
+        f = db.submit(time.sleep, 0.05)
+        f.add_done_callback(lambda f: done.append(threading.current_thread().name))
+        f.result(1)
+        f.add_done_callback(lambda f: done.append(threading.current_thread().name))
+        self.assertEqual(len(done), 2)
+        self.assertTrue(done[0].startswith('db-worker-'))
+        self.assertEqual(done[1], threading.current_thread().name)
+
+    def test_timeout(self):
+        f = db.submit(time.sleep, 0.2)
+        self.assertRaises(db.FutureTimeoutError, f.result, 0.01)
+        self.assertFalse(f.done())
+        f.result(1)
+
+    def test_transaction(self):
+        def write():
+            db.update("update t set name='x'")
+            raise ValueError('rollback')
+        self.assertRaises(ValueError, db.atransaction(write).result, 1)
+        self.assertEqual(db.select_one('select name from t').name, 'a')
+
+    def test_bounded_workers(self):
+        lock = threading.Lock()
+        state = dict(running=0, peak=0)
+
+        def work():
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+        for f in [db.submit(work) for i in range(10)]:
+            f.result(1)
+        self.assertEqual(state['peak'], 2)
+        self.assertEqual(len(db._executor._threads), 2)
+
+    def test_gather(self):
+        results = db.gather(db.aselect_int('select count(*) from t'),
+                            lambda: time.sleep(0.05) or 'slow',
+                            lambda: 'fast')
+        self.assertEqual(results, [1, 'slow', 'fast'])
+        self.assertEqual(db.gather(), [])
+        self.assertRaises(TypeError, db.gather, lambda: 1, wait=True)
+
+    def test_gather_error(self):
+        # 最先出错的异常立即抛出 不等还在执行的查询
+        start = time.time()
+        self.assertRaises(sqlite3.OperationalError, db.gather,
+                          lambda: time.sleep(0.5), db.aselect('select * from missing'))
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_gather_timeout(self):
+        self.assertRaises(db.FutureTimeoutError, db.gather, lambda: time.sleep(0.2), timeout=0.01)
+
+    def test_nested_gather(self):
+        # 两个工作线程都在 gather 时 内层的函数在当前线程直接执行  不会互相等待
+        def outer(i):
+            return sum(db.gather(lambda: i, lambda: db.select_int('select count(*) from t'), timeout=1))
+        self.assertEqual(db.gather(lambda: outer(1), lambda: outer(2), timeout=1), [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import pickle
+import sqlite3
+import unittest
+from StringIO import StringIO
+
+from support import db, SqliteTestCase
+
+import orm
+import explain
+
+
+class Doc(orm.Model):
+    __table__ = 'docs'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+    body = orm.TextField(lazy=True)
+    version = orm.VersionField()
+
+
+class Entry(orm.Model):
+    __table__ = 'entries'
+    __indexes__ = [('feed_id', 'created_at')]
+    id = orm.IntegerField(primary_key=True)
+    feed_id = orm.StringField(ddl='varchar(50)')
+    created_at = orm.FloatField()
+
+
+class Profile(orm.Model):
+    __table__ = 'profiles'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+    image = orm.StringField()
+
+
+class Post(orm.Model):
+    __table__ = 'posts'
+    id = orm.IntegerField(primary_key=True)
+    title = orm.StringField()
+    reply_count = orm.CountField('Reply', 'post_id')
+
+
+class Reply(orm.Model):
+    __table__ = 'replies'
+    id = orm.IntegerField(primary_key=True)
+    post_id = orm.ForeignKeyField(Post, related_name='replies', updatable=False)
+
+
+class Author(orm.Model):
+    __table__ = 'authors'
+    id = orm.IntegerField(primary_key=True)
+    name = orm.StringField()
+
+
+class Book(orm.Model):
+    __table__ = 'books'
+    id = orm.IntegerField(primary_key=True)
+    author_id = orm.ForeignKeyField(Author, related_name='books', updatable=False)
+    title = orm.StringField()
+
+
+class Review(orm.Model):
+    __table__ = 'reviews'
+    id = orm.IntegerField(primary_key=True)
+    book_id = orm.ForeignKeyField(Book, related_name='reviews', updatable=False)
+    author_id = orm.ForeignKeyField(Author, related_name='reviews', updatable=False)
+
+
+class Note(orm.CompactModel):
+    __table__ = 'notes'
+    id = orm.IntegerField(primary_key=True)
+    author_id = orm.ForeignKeyField(Author, related_name='notes', updatable=False)
+    title = orm.StringField()
+    body = orm.TextField(lazy=True)
+
+
+class ModelTest(SqliteTestCase):
+
+    def setUp(self):
+        super(ModelTest, self).setUp()
+        self.create_tables(Doc)
+        Doc.insert_all([Doc(id=i, name='d%d' % i, body='b%d' % i) for i in range(1, 4)])
+        self.statements()
+
+    def test_unchanged_update_is_noop(self):
+        d = Doc.find_first('where id=?', 1)
+        self.assertEqual(d._loaded[0], ('id', 'name', 'version'))
+        d.update()
+        for d in Doc.iter_by('where id<?', 3):
+            d.update()
+        for d in Doc.query().where(id=3).iter():
+            d.update()
+        self.assertEqual(self.statements(), 3)
+
+    def test_deferred_snapshot(self):
+        docs = Doc.find_by('where id<? order by id', 3)
+        self.assertEqual(docs[0].body, 'b1')
+        self.assertEqual(docs[1]._loaded, (('id', 'name', 'version', 'body'), (2, 'd2', 0, 'b2')))
+        self.statements()
+        docs[1].update()
+        self.assertEqual(self.statements(), 0)
+
+    def test_changed_fields_only(self):
+        d = Doc.get(1)
+        d.name = 'x'
+        self.statements()
+        d.update()
+        self.assertEqual(db.stats().keys(), ['update `docs` set `name`=?,`version`=`version`+? where `id`=? and `version`=?'])
+        self.assertEqual(Doc.get(1).version, 1)
+
+    def test_rollback_restores_snapshot_and_version(self):
+        d = Doc.get(1)
+        try:
+            with db.transaction():
+                d.name = 'x'
+                d.update()
+                d.name = 'y'
+                d.update()
+                self.assertEqual(d.version, 2)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual((d.version, d._changed()), (0, ['name']))
+        d.update()
+        self.assertEqual((Doc.get(1).name, Doc.get(1).version), ('y', 1))
+        d.name = 'z'
+        d.update()
+        self.assertEqual(Doc.get(1).name, 'z')
+
+    def test_insert_all(self):
+        docs = Doc.insert_all([Doc(id=i, name='n%d' % i, body='') for i in range(10, 15)], chunk_size=2)
+        self.assertEqual(self.statements(), 3)
+        self.assertEqual(docs[0].version, 0)
+        self.assertEqual(docs[0]._changed(), [])
+        self.assertEqual(Doc.count_all(), 8)
+        self.assertEqual(Doc.insert_all([]), [])
+
+    def test_upsert_all(self):
+        Doc.upsert_all([Doc(id=1, name='x', body='b'), Doc(id=9, name='n', body='')])
+        self.assertEqual([(d.id, d.name, d.version) for d in Doc.find_by('where id in (?,?) order by id', 1, 9)],
+                         [(1, 'x', 1), (9, 'n', 0)])
+        self.assertEqual(Doc.update_where('where id<?', 3, name='y'), 2)
+        self.assertEqual([(d.name, d.version) for d in Doc.find_by('where id<? order by id', 3)], [('y', 2), ('y', 1)])
+        self.assertRaises(db.DBError, Doc.update_where, 'where id=?', 1, version=5)
+
+    def test_instance_storage(self):
+        d = Doc.get(1)
+        self.assertFalse(hasattr(d, '__dict__'))
+        self.assertEqual(sys.getsizeof(d) - sys.getsizeof(Doc()), sys.getsizeof(dict(d)) - sys.getsizeof({}))
+        self.assertEqual(d._group, None)
+        for protocol in (0, 2):
+            e = pickle.loads(pickle.dumps(d, protocol))
+            self.assertEqual((e, e._loaded), (d, d._loaded))
+            self.statements()
+            e.update()
+            self.assertEqual(self.statements(), 0)
+
+    def test_async(self):
+        try:
+            self.assertEqual(Doc.aget(1).result(1).name, 'd1')
+            self.assertEqual([d.id for d in Doc.afind_by('where id>? order by id', 1).result(1)], [2, 3])
+            self.assertEqual(Doc.query().where(id=3).aall().result(1)[0].name, 'd3')
+            self.assertEqual(Doc.acount_all().result(1), 3)
+        finally:
+            db._executor.shutdown()
+            db._executor = None
+
+    def test_get_many(self):
+        found = Doc.get_many([3, 1, 99, 1], chunk_size=2)
+        self.assertEqual(sorted(found.keys()), [1, 3])
+        self.assertEqual(found[3].name, 'd3')
+        self.assertEqual(self.statements(), 2)
+        docs = Doc.get_many([3, 99, 1, 3], ordered=True)
+        self.assertEqual([d and d.id for d in docs], [3, None, 1, 3])
+        self.assertTrue(docs[0] is docs[3])
+        self.assertEqual(self.statements(), 1)
+        self.assertEqual(Doc.get_many([2]).keys(), [2])
+        self.assertEqual(Doc.get_many([]), {})
+
+    def test_get_many_cached(self):
+        Doc.enable_object_cache()
+        try:
+            self.assertEqual(sorted(Doc.get_many([1, 2, 99]).keys()), [1, 2])
+            self.assertEqual(self.statements(), 1)
+            self.assertEqual(sorted(Doc.get_many([1, 2, 99]).keys()), [1, 2])
+            self.assertEqual(self.statements(), 0)
+        finally:
+            Doc.disable_object_cache()
+
+    def test_conflict(self):
+        a, b = Doc.get(1), Doc.get(1)
+        a.name = 'a'
+        a.update()
+        b.name = 'b'
+        self.assertRaises(orm.ConflictError, b.update)
+
+
+class UnitOfWorkTest(SqliteTestCase):
+
+    def setUp(self):
+        super(UnitOfWorkTest, self).setUp()
+        self.create_tables(Doc)
+        Doc.insert_all([Doc(id=i, name='d%d' % i, body='') for i in range(1, 51)])
+        self.statements()
+
+    def test_batched_updates(self):
+        with orm.unit_of_work():
+            docs = Doc.find_by('where id<=? order by id', 40)
+            for d in docs:
+                d.name = 'n%d' % d.id
+                d.update()
+            docs[0].body = 'x'
+            docs[0].update()
+            self.assertTrue(Doc.get(1) is docs[0])
+        stats = db.stats(reset=True)
+        updates = [k for k in stats if k.startswith('update')]
+        self.assertEqual(sum([stats[k].count for k in updates]), 2)
+        self.assertEqual([(d.name, d.version) for d in Doc.find_by('where id in (?,?,?)', 1, 40, 41)],
+                         [('n1', 1), ('n40', 1), ('d41', 0)])
+        self.assertEqual(Doc.get(1).body, 'x')
+        self.assertEqual(docs[5]._changed(), [])
+
+    def test_batched_conflict(self):
+        try:
+            with orm.unit_of_work():
+                docs = Doc.find_by('where id<=?', 3)
+                for d in docs:
+                    d.name = 'x'
+                    d.update()
+                db.update('update docs set version=5 where id=?', 2)
+                orm.flush()
+        except orm.ConflictError:
+            pass
+        else:
+            self.fail('no conflict')
+        self.assertEqual([d.name for d in Doc.find_by('where id<=?', 3)], ['d1', 'd2', 'd3'])
+        self.assertEqual(docs[0].version, 0)
+
+    def test_retry_on_conflict(self):
+        calls = []
+
+        @orm.retry_on_conflict
+        def rename(name):
+            with db.transaction():
+                d = Doc.get(1)
+                if not calls:
+                    # 第一次读出以后 别人改了这一行
+                    db.update('update docs set version=version+1 where id=?', 1)
+                calls.append(1)
+                d.name = name
+                d.update()
+        rename('r')
+        self.assertEqual((len(calls), Doc.get(1).name), (2, 'r'))
+        with db.transaction():
+            self.assertRaises(db.DBError, rename, 'r')
+
+    def test_conflict_evicts_identity(self):
+        with db.transaction():
+            d = Doc.get(1)
+            db.update('update docs set version=version+1 where id=?', 1)
+            d.name = 'x'
+            self.assertRaises(orm.ConflictError, d.update)
+            e = Doc.get(1)
+            self.assertTrue(e is not d)
+            e.name = 'x'
+            e.update()
+        self.assertEqual((Doc.get(1).name, Doc.get(1).version), ('x', 2))
+
+
+class CounterTest(SqliteTestCase):
+
+    def setUp(self):
+        super(CounterTest, self).setUp()
+        self.create_tables(Post, Reply)
+        Post.insert_all([Post(id=1, title='a'), Post(id=2, title='b')])
+
+    def tearDown(self):
+        Post.disable_object_cache()
+        super(CounterTest, self).tearDown()
+
+    def counts(self):
+        return [Post.get(1).reply_count, Post.get(2).reply_count]
+
+    def test_counters(self):
+        r = Reply(id=1, post_id=1).insert()
+        Reply.insert_all([Reply(id=2, post_id=1), Reply(id=3, post_id=2)])
+        self.assertEqual(self.counts(), [2, 1])
+        r.delete()
+        with orm.unit_of_work():
+            Reply(id=4, post_id=2).insert()
+            Reply.get(2).delete()
+        self.assertEqual(self.counts(), [0, 2])
+        self.execute('update posts set reply_count=9')
+        self.assertEqual(Post.rebuild_counters(), 2)
+        self.assertEqual(self.counts(), [0, 2])
+
+    def test_stale_update_does_not_cache_count(self):
+        Post.enable_object_cache()
+        p = Post.get(1)
+        Reply(id=1, post_id=1).insert()
+        p.title = 'x'
+        p.update()
+        self.assertEqual(p.reply_count, 0)
+        self.assertEqual((Post.get(1).title, Post.get(1).reply_count), ('x', 1))
+
+    def test_sync_counters(self):
+        self.execute('drop table posts', 'create table posts (id integer primary key, title text)',
+                     'insert into posts values (1, "a")', 'insert into posts values (2, "b")',
+                     'insert into replies values (1, 1)')
+        self.statements()
+        sqls = Post.sync_counters()
+        self.assertEqual(sqls, ['alter table `posts` add column `reply_count` bigint not null default 0'])
+        self.assertEqual([k for k, s in db.stats().iteritems() if s.errors], [])
+        self.assertEqual(self.counts(), [1, 0])
+        self.assertEqual(Post.sync_counters(), [])
+
+    def test_unit_of_work_order(self):
+        # sqlite 检查外键时 先 insert 被引用的行 先 delete 引用它的行
+        path = self.path
+        def connect():
+            c = sqlite3.connect(path, check_same_thread=False)
+            c.execute('pragma foreign_keys=on')
+            return c
+        db.engine.dispose()
+        db.engine = db._Engine(connect, placeholder='?')
+        self.execute('drop table replies', 'create table replies (id integer primary key, post_id bigint references posts(id))')
+        with orm.unit_of_work():
+            Reply(id=1, post_id=3).insert()
+            Post(id=3, title='c').insert()
+        self.assertEqual(Post.get(3).reply_count, 1)
+        with orm.unit_of_work():
+            p, r = Post.get(3), Reply.get(1)
+            p.delete()
+            r.delete()
+        self.assertEqual((Post.count_all(), Reply.count_all()), (2, 0))
+
+
+class ExplainTest(SqliteTestCase):
+
+    def test_cli(self):
+        # 只建表 不建声明过的索引
+        self.execute(Entry().__sql__().split('\n', 1)[1].split(';')[0])
+        log = os.path.join(self.dir, 'app.log')
+        with open(log, 'w') as f:
+            f.write('WARNING:root:[PROFILING] [DB] slow sql 0.300s:'
+                    'select * from entries where feed_id=? order by created_at desc limit ?\n')
+            f.write('select * from entries where id=?;\n')
+            f.write('update entries set feed_id=?\n')
+        out = StringIO()
+        entries = explain.main(['--sqlite', self.path, log], out)
+        self.assertEqual(len(entries), 2)
+        s = entries[0].suggestions[0]
+        self.assertEqual((s.columns, s.fields, s.declared),
+                         (('feed_id', 'created_at'), ['Entry.feed_id', 'Entry.created_at'], True))
+        self.assertEqual(entries[1].suggestions, [])
+        self.assertTrue('run Entry.sync_indexes()' in out.getvalue())
+
+    def test_cli_models(self):
+        # 真实的 model.py 用 from db.orm import ... 导入  Model 要注册到同一个 orm 中
+        self.execute('create table comments (id varchar(50) primary key, blog_id varchar(50), created_at real)')
+        log = os.path.join(self.dir, 'app.log')
+        with open(log, 'w') as f:
+            f.write('select * from comments where blog_id=? order by created_at desc\n')
+        entries = explain.main(['--sqlite', self.path, '--models', 'model', log], StringIO())
+        model = sys.modules['model']
+        self.assertTrue(model.Model is orm.Model)
+        self.assertTrue(orm._model('Comment') is model.Comment)
+        s = entries[0].suggestions[0]
+        self.assertEqual((s.fields, s.declared), (['Comment.blog_id', 'Comment.created_at'], True))
+
+
+
+class PrefetchTest(SqliteTestCase):
+
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.create_tables(Author, Book, Review)
+        Author.insert_all([Author(id=i, name='a%d' % i) for i in range(1, 4)])
+        # 第 4 本书的作者不存在
+        Book.insert_all([Book(id=i, author_id=i % 3 + 1, title='b%d' % i) for i in range(1, 4)] +
+                        [Book(id=4, author_id=9, title='b4')])
+        Review.insert_all([Review(id=i, book_id=i % 2 + 1, author_id=i % 3 + 1) for i in range(1, 7)])
+        self.statements()
+
+    def test_prefetch_paths(self):
+        books = Book.find_by('order by id').prefetch('author', 'reviews.author')
+        self.assertEqual(self.statements(), 4)
+        self.assertEqual([b.author and b.author.name for b in books], ['a2', 'a3', 'a1', None])
+        self.assertEqual([len(b.reviews) for b in books], [3, 3, 0, 0])
+        self.assertEqual(sorted([r.author.name for r in books[0].reviews]), ['a1', 'a2', 'a3'])
+        self.assertTrue(books[0].reviews[0].author is books[0].reviews[0].author)
+        self.assertEqual(self.statements(), 0)
+        # 已经加载过的关联不再查询
+        Book.prefetch(books, 'author', 'reviews')
+        self.assertEqual(self.statements(), 0)
+
+    def test_lazy_access(self):
+        b = Book.get(1)
+        self.statements()
+        self.assertEqual(b.author.name, 'a2')
+        self.assertEqual([x.title for x in b.author.books], ['b1'])
+        self.assertEqual(self.statements(), 2)
+        self.assertEqual(b.author.name, 'a2')
+        self.assertEqual(self.statements(), 0)
+        self.assertFalse('author' in b)
+        self.assertRaises(AttributeError, getattr, b, 'nothing')
+        self.assertRaises(AttributeError, Book.prefetch, [b], 'nothing')
+
+
+
+class QueryTest(SqliteTestCase):
+
+    def setUp(self):
+        super(QueryTest, self).setUp()
+        self.create_tables(Entry)
+        # created_at 每三行相同  翻页时要靠主键区分
+        Entry.insert_all([Entry(id=i, feed_id='f%d' % (i % 2), created_at=float(i // 3)) for i in range(1, 21)])
+        self.entries = Entry.find_all()
+        self.statements()
+
+    def pages(self, q, size=4):
+        ids = []
+        page = q.limit(size).all()
+        while page:
+            ids.extend([e.id for e in page])
+            page = q.after(q.cursor(page[-1])).limit(size).all()
+        return ids
+
+    def expect(self, key, reverse=False):
+        return [e.id for e in sorted(self.entries, key=key, reverse=reverse)]
+
+    def test_keyset_ascending(self):
+        q = Entry.query().order_by('created_at')
+        self.assertEqual(self.pages(q), self.expect(lambda e: (e.created_at, e.id)))
+
+    def test_keyset_descending(self):
+        q = Entry.query().order_by('-created_at')
+        self.assertEqual(self.pages(q, 5), self.expect(lambda e: (e.created_at, e.id), True))
+
+    def test_keyset_mixed_directions(self):
+        q = Entry.query().where(feed_id=['f0', 'f1']).order_by('feed_id', '-created_at')
+        ids = self.pages(q, 3)
+        self.assertEqual(ids, self.expect(lambda e: (e.feed_id, -e.created_at, -e.id)))
+
+    def test_cursor_with_only(self):
+        q = Entry.query().only('id').order_by('-created_at')
+        page = q.limit(4).all()
+        self.assertEqual(q.cursor(page[-1]), (page[-1].created_at, page[-1].id))
+        self.assertEqual(self.statements(), 1)
+        self.assertEqual(self.pages(q), self.expect(lambda e: (e.created_at, e.id), True))
+        # 来自另一个查询 没有读取排序字段的实例
+        e = Entry.query().only('feed_id').where(id=7).first()
+        self.assertFalse('created_at' in e)
+        self.assertEqual(q.cursor(e), (2.0, 7))
+        self.assertRaises(ValueError, q.cursor, Entry(id=7))
+        self.assertRaises(ValueError, q.after, (1.0, ))
+
+    def test_where(self):
+        q = Entry.query()
+        self.assertEqual(q.where(feed_id='f1').count(), 10)
+        self.assertEqual(q.where(feed_id=None).count(), 0)
+        self.assertEqual(q.where(id=[]).all(), [])
+        self.assertEqual([e.id for e in q.where('created_at<?', 1).order_by('-id')], [2, 1])
+        self.assertEqual([e.id for e in q.order_by('id').limit(2, 3).all()], [4, 5])
+        self.assertEqual(q.where(id=(3, 4)).order_by('-id').first().id, 4)
+        self.assertRaises(AttributeError, q.where, missing=1)
+
+
+
+class ProjectionTest(SqliteTestCase):
+
+    def setUp(self):
+        super(ProjectionTest, self).setUp()
+        self.create_tables(Doc)
+        Doc.insert_all([Doc(id=i, name='d%d' % i, body='b%d' % i) for i in range(1, 5)])
+        self.statements()
+
+    def test_only(self):
+        docs = Doc.query().only('name').order_by('id').all()
+        self.assertEqual(docs[0].keys(), ['id', 'name'])
+        self.assertEqual(self.statements(), 1)
+        # 第一次访问时 同一次查询的实例一起读取
+        self.assertEqual([d.version for d in docs], [0] * 4)
+        self.assertEqual([d.body for d in docs], ['b1', 'b2', 'b3', 'b4'])
+        self.assertEqual(self.statements(), 2)
+        for d in docs:
+            d.update()
+        self.assertEqual(self.statements(), 0)
+
+    def test_defer(self):
+        d = Doc.query().defer('name').where(id=2).first()
+        self.assertEqual(sorted(d.keys()), ['id', 'version'])
+        self.assertEqual((d.name, d.body), ('d2', 'b2'))
+        self.assertEqual(self.statements(), 3)
+        d.name = 'x'
+        d.update()
+        self.assertEqual(Doc.get(2).name, 'x')
+
+    def test_lazy_field(self):
+        d = Doc.get(3)
+        self.assertFalse('body' in d)
+        self.assertEqual(d.body, 'b3')
+        self.assertEqual(self.statements(), 2)
+        self.assertRaises(AttributeError, Doc.query().only, 'missing')
+
+
+
+class CompactModelTest(SqliteTestCase):
+
+    def setUp(self):
+        super(CompactModelTest, self).setUp()
+        self.create_tables(Author, Note)
+        Author(id=1, name='a').insert()
+        Note(id=1, author_id=1, title='t', body='b').insert()
+        self.statements()
+
+    def test_storage(self):
+        n = Note.get(1)
+        self.assertFalse(hasattr(n, '__dict__'))
+        self.assertEqual((n.id, n['title']), (1, 't'))
+        self.assertTrue('title' in n)
+        self.assertFalse('body' in n)
+        self.assertRaises(KeyError, lambda: n['body'])
+        self.assertRaises(AttributeError, setattr, n, 'extra', 1)
+        self.assertRaises(KeyError, n.__setitem__, 'extra', 1)
+        self.assertRaises(AttributeError, getattr, n, 'extra')
+        self.assertEqual(n.to_dict(), dict(id=1, author_id=1, title='t'))
+        self.assertEqual(n, dict(id=1, author_id=1, title='t'))
+        self.assertEqual(n, Note(id=1, author_id=1, title='t'))
+        self.assertNotEqual(n, Note(id=1, author_id=1, title='x'))
+        self.assertEqual(pickle.loads(pickle.dumps(n, 2)), n)
+
+    def test_deferred_and_relation(self):
+        n = Note.get(1)
+        self.assertEqual(n.body, 'b')
+        self.assertEqual(n.author.name, 'a')
+        self.assertEqual([x.id for x in Author.get(1).notes], [1])
+        self.assertEqual(self.statements(), 5)
+
+    def test_update(self):
+        n = Note.get(1)
+        n.update()
+        self.assertEqual(self.statements(), 1)
+        n.title = 'x'
+        n.update()
+        self.assertEqual(Note.get(1).title, 'x')
+        self.assertEqual(Note.get(1).body, 'b')
+        n.delete()
+        self.assertEqual(Note.get(1), None)
+
+
+
+class IndexTest(SqliteTestCase):
+
+    def setUp(self):
+        super(IndexTest, self).setUp()
+        # 只建表 不建声明过的索引
+        self.execute(Entry().__sql__().split('\n', 1)[1].split(';')[0])
+        Entry.insert_all([Entry(id=i, feed_id='f%d' % (i % 5), created_at=float(i)) for i in range(50)])
+        self.statements()
+
+    def tearDown(self):
+        db.disable_explain()
+        super(IndexTest, self).tearDown()
+
+    def test_sync_indexes(self):
+        self.assertEqual(len(Entry.sync_indexes()), 1)
+        self.assertEqual([c for n, c, u in Entry._existing_indexes()], [('feed_id', 'created_at')])
+        self.assertEqual(Entry.sync_indexes(), [])
+        # 按 dialect 选择语句 不会先试一次 show index 再失败
+        self.assertEqual([k for k, s in db.stats().iteritems() if s.errors], [])
+
+    def test_advisor(self):
+        db.enable_explain(threshold=0)
+        where = 'where feed_id=? order by created_at desc'
+        Entry.find_by(where, 'f1')
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            entries = orm.slow_query_report(out=None)
+            if entries and entries[0].explained:
+                break
+            time.sleep(0.01)
+        s = entries[0].suggestions[0]
+        self.assertEqual((s.columns, s.declared), (('feed_id', 'created_at'), True))
+        out = StringIO()
+        orm.slow_query_report(out=out)
+        self.assertTrue('run Entry.sync_indexes()' in out.getvalue())
+        Entry.sync_indexes()
+        self.assertEqual(db.explain('select * from `entries` ' + where, 'f1').suggestions, [])
+
+
+
+class ObjectCacheTest(SqliteTestCase):
+
+    def setUp(self):
+        super(ObjectCacheTest, self).setUp()
+        self.create_tables(Profile)
+        Profile.enable_object_cache()
+        Profile(id=1, name='a', image='x').insert()
+        self.statements()
+
+    def tearDown(self):
+        orm.disable_invalidation()
+        Profile.disable_object_cache()
+        super(ObjectCacheTest, self).tearDown()
+
+    def test_insert_writes_through(self):
+        self.assertEqual(Profile.get(1).image, 'x')
+        self.assertEqual(self.statements(), 0)
+
+    def test_stale_instance_update(self):
+        # update 只写入变化的字段  不能把实例中过期的 image 放入缓存
+        a, b = Profile.get(1), Profile.get(1)
+        b.image = 'y'
+        b.update()
+        a.name = 'n'
+        a.update()
+        p = Profile.get(1)
+        self.assertEqual((p.name, p.image), ('n', 'y'))
+        self.assertEqual(dict(Profile.find_first('where id=?', 1)), dict(p))
+
+    def test_invalidation_across_processes(self):
+        path = os.path.join(self.dir, 'sockets')
+        orm.enable_invalidation(path)
+        self.assertEqual(Profile.get(1).name, 'a')
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                db.engine = self.make_engine()
+                orm.enable_invalidation(path)
+                p = Profile.get(1)
+                p.name = 'child'
+                p.update()
+                code = 0
+            finally:
+                os._exit(code)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        deadline = time.time() + 5
+        while orm._invalidator.received == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(Profile.get(1).name, 'child')
+        self.assertTrue(os.path.exists(orm._invalidator.name))
+
+
+if __name__ == '__main__':
+    unittest.main()